@@ -0,0 +1,66 @@
+"""
+Дайджест для админов: выполненные, частичные и неудачные заказы за окно одним сообщением
+"""
+
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from metrics import metrics
+
+admin_digest_events = metrics.counter('admin_digest_events_total', 'События, собранные в дайджест')
+
+EVENT_TITLES = {
+    'completed': '✅ Выполнено',
+    'partial': '⚠️ Частично',
+    'failed': '❌ Ошибки',
+    'parked': '⏸ Отложено',
+}
+
+
+class AdminDigest:
+    def __init__(self, max_order_ids: int = 10):
+        self.max_order_ids = max_order_ids
+        self._reset()
+
+    def _reset(self):
+        self.started_at = datetime.now()
+        self.counts: Dict[str, int] = {}
+        self.order_ids: Dict[str, List[str]] = {}
+        self.stars = 0
+        self.revenue_rub = 0.0
+
+    def record(self, event: str, order_id: str = None, stars: int = 0, revenue_rub: float = 0.0):
+        """Учёт события в текущем окне"""
+        self.counts[event] = self.counts.get(event, 0) + 1
+        if order_id:
+            ids = self.order_ids.setdefault(event, [])
+            if len(ids) < self.max_order_ids:
+                ids.append(order_id)
+        self.stars += stars
+        self.revenue_rub += revenue_rub
+        admin_digest_events.inc(event=event)
+
+    def flush(self) -> Optional[str]:
+        """Сводка за окно (None, если событий не было); окно начинается заново"""
+        if not self.counts:
+            self.started_at = datetime.now()
+            return None
+
+        message = (f"📬 <b>Дайджест заказов</b> "
+                   f"{self.started_at.strftime('%H:%M')}–{datetime.now().strftime('%H:%M')}\n\n")
+        for event, title in EVENT_TITLES.items():
+            count = self.counts.get(event)
+            if not count:
+                continue
+            message += f"{title}: <b>{count}</b>"
+            ids = self.order_ids.get(event)
+            if ids and event != 'completed':
+                more = f" и ещё {count - len(ids)}" if count > len(ids) else ""
+                message += f" ({', '.join(ids)}{more})"
+            message += "\n"
+
+        if self.stars or self.revenue_rub:
+            message += f"\n⭐ Отправлено: {self.stars:,}\n💰 Доход: {self.revenue_rub:,.2f} ₽"
+
+        self._reset()
+        return message
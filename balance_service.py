@@ -0,0 +1,156 @@
+"""
+Баланс Fragment: фоновое обновление и локальный реестр резервов под заказы
+"""
+
+import asyncio
+import time
+from typing import Dict, Optional
+
+from config import BALANCE_REFRESH_INTERVAL_SEC, BALANCE_MAX_AGE_SEC
+from circuit_breaker import breakers
+from integrations import fragment
+from metrics import metrics
+
+balance_observed = metrics.gauge('fragment_balance_observed_stars', 'Последний реальный баланс Fragment')
+balance_reserved = metrics.gauge('fragment_balance_reserved_stars', 'Звёзды, зарезервированные под выполняемые заказы')
+balance_refreshes = metrics.counter('fragment_balance_refreshes_total', 'Чтения реального баланса по причинам')
+
+
+class BalanceService:
+    """Кэш баланса Fragment; доступно = наблюдаемый баланс - резервы"""
+
+    def __init__(self, fragment_api, refresh_interval: float = BALANCE_REFRESH_INTERVAL_SEC,
+                 max_age: float = BALANCE_MAX_AGE_SEC):
+        self.fragment = fragment_api
+        self.refresh_interval = refresh_interval
+        self.max_age = max_age
+
+        self.observed: Optional[Dict] = None
+        self.observed_at = 0.0
+        self.reservations: Dict[str, int] = {}  # {order_id: stars, ещё не отправленные}
+        self.stale = True
+        self._sent_total = 0  # Всего отправлено звёзд, для переводов во время чтения баланса
+
+        self._resync_event = None
+        self._task = None
+
+    @property
+    def reserved(self) -> int:
+        return sum(self.reservations.values())
+
+    def available(self) -> Optional[int]:
+        """Сколько звёзд ещё можно пообещать заказам"""
+        if self.observed is None:
+            return None
+        return self.observed['stars_balance'] - self.reserved
+
+    def snapshot(self) -> Dict:
+        """Баланс для сообщений и админских команд"""
+        observed = self.observed or {'stars_balance': 0, 'daily_limit_left': 0}
+        return {
+            'stars_balance': observed['stars_balance'],
+            'daily_limit_left': observed['daily_limit_left'],
+            'reserved': self.reserved,
+            'available': observed['stars_balance'] - self.reserved,
+            'age_sec': round(time.monotonic() - self.observed_at) if self.observed else None
+        }
+
+    async def refresh(self, reason: str = 'manual') -> Dict:
+        """Чтение реального баланса со страницы Fragment"""
+        sent_before = self._sent_total
+        balance = await self.fragment.get_balance()
+        # Нули от упавшего парсера - не баланс: прежнее значение остаётся, следующее чтение повторит попытку
+        failed = breakers['fragment_balance'].is_failure(balance)
+        if failed and self.observed is not None:
+            balance_refreshes.inc(reason='failed')
+            self.stale = True
+            return self.snapshot()
+        sent_during = self._sent_total - sent_before
+        if sent_during:
+            # Страница могла быть прочитана до этих переводов: считаем их не учтёнными
+            balance = dict(balance)
+            balance['stars_balance'] = max(0, balance['stars_balance'] - sent_during)
+            balance['daily_limit_left'] = max(0, balance['daily_limit_left'] - sent_during)
+        self.observed = balance
+        self.observed_at = time.monotonic()
+        self.stale = failed
+        balance_refreshes.inc(reason=reason)
+        balance_observed.set(balance['stars_balance'])
+        return self.snapshot()
+
+    async def ensure_fresh(self):
+        """Чтение по требованию, только если фоновое значение отсутствует или устарело"""
+        if self.stale or time.monotonic() - self.observed_at > self.max_age:
+            await self.refresh('stale')
+
+    async def try_reserve(self, order_id: str, stars: int) -> bool:
+        """Резерв звёзд под заказ; False - баланса не хватает"""
+        await self.ensure_fresh()
+
+        if order_id in self.reservations:
+            return True
+
+        # Между проверкой и записью нет await, поэтому параллельные заказы не перерасходуют баланс
+        if self.available() < stars:
+            return False
+
+        self.reservations[order_id] = stars
+        balance_reserved.set(self.reserved)
+        return True
+
+    def record_sent(self, order_id: str, sent: int):
+        """Батч отправлен: резерв заказа и наблюдаемый баланс уменьшаются на отправленное сразу,
+        поэтому обновление баланса посреди выдачи не учитывает эти звёзды дважды"""
+        if not sent:
+            return
+        self._sent_total += sent
+        if order_id in self.reservations:
+            self.reservations[order_id] = max(0, self.reservations[order_id] - sent)
+        if self.observed is not None:
+            self.observed = dict(self.observed)
+            self.observed['stars_balance'] = max(0, self.observed['stars_balance'] - sent)
+            self.observed['daily_limit_left'] = max(0, self.observed['daily_limit_left'] - sent)
+            balance_observed.set(self.observed['stars_balance'])
+        balance_reserved.set(self.reserved)
+
+    def release(self, order_id: str):
+        """Снятие остатка резерва (заказ выполнен, отправленное уже учтено record_sent, или не выполнялся)"""
+        if self.reservations.pop(order_id, None) is not None:
+            balance_reserved.set(self.reserved)
+
+    def request_resync(self):
+        """Принудительное чтение реального баланса (например, после ошибки перевода)"""
+        self.stale = True
+        if self._resync_event:
+            self._resync_event.set()
+
+    async def start(self):
+        self._resync_event = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._resync_event.wait(), timeout=self.refresh_interval)
+                reason = 'resync'
+            except asyncio.TimeoutError:
+                reason = 'background'
+            self._resync_event.clear()
+
+            try:
+                await self.refresh(reason)
+            except Exception as e:
+                print(f"⚠️ Ошибка обновления баланса Fragment: {e}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+# Глобальный экземпляр
+balance_service = BalanceService(fragment)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк блокировки ресурсов: время загрузки страниц и RSS Chrome с блокировкой и без.
+
+Страницы берутся из benchmarks/fixtures и отдаются локальным HTTP-сервером,
+поэтому сеть не нужна. Ресурсы, на которые ссылаются фикстуры (картинки,
+шрифты, скрипты, трекеры), сервер генерирует на лету нужного размера.
+
+    python3 benchmarks/bench_resource_blocking.py --rounds 5 --json bench_blocking.json
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import threading
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from browser import apply_resource_blocking, process_tree_rss
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PAGES = ['funpay_orders.html', 'funpay_order.html', 'fragment_balance.html']
+
+# Размер и тип генерируемых ресурсов по расширению
+ASSETS = {
+    '.png': (150_000, 'image/png'),
+    '.jpg': (120_000, 'image/jpeg'),
+    '.webp': (60_000, 'image/webp'),
+    '.svg': (8_000, 'image/svg+xml'),
+    '.gif': (100, 'image/gif'),
+    '.mp4': (2_000_000, 'video/mp4'),
+    '.woff2': (90_000, 'font/woff2'),
+    '.css': (60_000, 'text/css'),
+    '.js': (180_000, 'application/javascript'),
+}
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, directory=FIXTURES_DIR, **kwargs)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if os.path.isfile(os.path.join(FIXTURES_DIR, path.lstrip('/'))):
+            return super().do_GET()
+
+        extension = os.path.splitext(path)[1] or '.js'
+        size, content_type = ASSETS.get(extension, ASSETS['.js'])
+        if extension in ('.css', '.js'):
+            body = (b'/* fixture */' + b' ' * size)[:size]
+        else:
+            body = b'\0' * size
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fixture_server() -> ThreadingHTTPServer:
+    """Локальный сервер фикстур на свободном порту"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FixtureHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_profile(base_url: str, resource_types, rounds: int, headless: bool) -> dict:
+    """Загрузка всех страниц в свежем Chrome с заданным профилем блокировки"""
+    import undetected_chromedriver as uc
+
+    options = uc.ChromeOptions()
+    if headless:
+        options.add_argument('--headless')
+    options.add_argument('--no-sandbox')
+    options.add_argument('--disable-dev-shm-usage')
+    options.add_argument('--disable-gpu')
+    options.add_argument('--window-size=1920,1080')
+
+    driver = uc.Chrome(options=options)
+    try:
+        apply_resource_blocking(driver, resource_types)
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setCacheDisabled', {'cacheDisabled': True})
+
+        load_ms = {}
+        for page in PAGES:
+            samples = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                driver.get(f"{base_url}/{page}")
+                samples.append((time.perf_counter() - start) * 1000)
+            load_ms[page] = round(statistics.median(samples), 1)
+
+        rss_mb = process_tree_rss(driver.browser_pid) / (1024 * 1024)
+    finally:
+        driver.quit()
+
+    return {'load_ms': load_ms, 'rss_mb': round(rss_mb, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк блокировки ресурсов Chrome')
+    parser.add_argument('--rounds', type=int, default=5, help='Загрузок каждой страницы')
+    parser.add_argument('--block', default='images,media,fonts,analytics',
+                        help='Типы ресурсов для блокировки (images,media,fonts,analytics,css)')
+    parser.add_argument('--no-headless', action='store_true', help='Запуск с окном браузера')
+    parser.add_argument('--json', help='Сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    server = start_fixture_server()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    block = [r.strip() for r in args.block.split(',') if r.strip()]
+
+    try:
+        results = {
+            'baseline': run_profile(base_url, [], args.rounds, not args.no_headless),
+            'blocked': run_profile(base_url, block, args.rounds, not args.no_headless),
+            'block': block,
+            'rounds': args.rounds
+        }
+    finally:
+        server.shutdown()
+
+    print(f"{'Страница':<24}{'без блокировки, мс':>20}{'с блокировкой, мс':>20}")
+    for page in PAGES:
+        print(f"{page:<24}{results['baseline']['load_ms'][page]:>20}{results['blocked']['load_ms'][page]:>20}")
+    print(f"{'RSS Chrome, МБ':<24}{results['baseline']['rss_mb']:>20}{results['blocked']['rss_mb']:>20}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"✅ Результаты сохранены в {args.json}")
+
+
+if __name__ == '__main__':
+    main()
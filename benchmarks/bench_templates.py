@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк шаблонов сообщений: стоимость рендера по типам сообщений.
+
+Для каждого типа меряется полный рендер (кэш сброшен перед каждым вызовом)
+и вызов с тёплым кэшем, как при повторных /price и /order.
+
+    python3 benchmarks/bench_templates.py --number 20000 --json bench_templates.json
+"""
+
+import os
+import sys
+import json
+import argparse
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import OrderStatus, FulfillmentStatus
+from message_templates import MessageTemplates, clear_template_caches
+
+OFFERS = [
+    {'offer_id': f'offer_{i}', 'title': f'{stars} Telegram Stars', 'stars_amount': stars,
+     'price': stars * 1.5, 'currency': 'RUB', 'is_active': True}
+    for i, stars in enumerate([50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000])
+]
+ORDER = {
+    'order_id': 'bench_order_001', 'status': OrderStatus.FULFILLING, 'stars_amount_total': 5000,
+    'total_price': 7500.0, 'currency': 'RUB', 'created_at': '2024-01-01T12:00:00',
+    'attached_telegram_username': '@bench_user'
+}
+FULFILLMENT = {'status': FulfillmentStatus.PENDING, 'batches': [{'status': 'ok'}] * 5 + [{'status': 'pending'}] * 5}
+
+
+def cases(templates: MessageTemplates) -> dict:
+    """{тип сообщения: (полный рендер, вызов через публичный метод)}"""
+    return {
+        'start': (templates._render_start_message, templates.start_message),
+        'help': (templates._render_help_message, templates.help_message),
+        'terms': (templates._render_terms_message, templates.terms_message),
+        'price': (lambda: templates._render_price_message(OFFERS), lambda: templates.price_message(OFFERS)),
+        'order_status': (lambda: templates._render_order_status(ORDER, FULFILLMENT),
+                         lambda: templates.order_status(ORDER, FULFILLMENT)),
+    }
+
+
+def measure(func, number: int) -> float:
+    """Лучшее из трёх повторов, микросекунд на вызов"""
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк рендера шаблонов сообщений')
+    parser.add_argument('--number', type=int, default=20000, help='Вызовов на замер')
+    parser.add_argument('--json', help='Сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    templates = MessageTemplates()
+    clear_template_caches()
+    results = {}
+    for name, (render, cached) in cases(templates).items():
+        cached()  # прогрев кэша
+        results[name] = {
+            'render_us': round(measure(render, args.number), 3),
+            'cached_us': round(measure(cached, args.number), 3),
+        }
+
+    print(f"{'Сообщение':<16}{'рендер, мкс':>14}{'из кэша, мкс':>14}{'ускорение':>12}")
+    for name, result in results.items():
+        speedup = result['render_us'] / result['cached_us'] if result['cached_us'] else 0
+        print(f"{name:<16}{result['render_us']:>14}{result['cached_us']:>14}{speedup:>11.1f}x")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'number': args.number, 'results': results}, f, ensure_ascii=False, indent=2)
+        print(f"✅ Результаты сохранены в {args.json}")
+
+
+if __name__ == '__main__':
+    main()
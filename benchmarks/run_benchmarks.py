@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+"""
+Офлайн-набор бенчмарков: база данных, разбор HTML-фикстур, разбиение на батчи,
+шаблоны сообщений и полный OrderProcessor.process_order на парсерах без задержек.
+
+Сеть и браузер не нужны: база создаётся во временном каталоге, страницы FunPay/Fragment
+берутся из benchmarks/fixtures. Все результаты - микросекунды на операцию (меньше - лучше),
+сравнение с сохранённым baseline показывает разницу в процентах.
+
+    python3 benchmarks/run_benchmarks.py --json bench_results.json
+    python3 benchmarks/run_benchmarks.py --sizes 10000 --baseline benchmarks/baseline.json
+    python3 benchmarks/run_benchmarks.py --save-baseline benchmarks/baseline.json
+"""
+
+import os
+import sys
+import io
+import json
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import platform
+import tempfile
+import contextlib
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+WORK_DIR = tempfile.mkdtemp(prefix='stars-bench-')
+
+# Окружение задаётся до импорта config: временная база и логи, без лимитов темпа переводов
+os.environ.update({
+    'DATABASE_PATH': os.path.join(WORK_DIR, 'e2e.db'),
+    'LOG_DIR': os.path.join(WORK_DIR, 'logs'),
+    'LOG_LEVEL': 'WARNING',
+    'TRACE_FILE': '',
+    'SELECTOR_STATS_PATH': os.path.join(WORK_DIR, 'selector_stats.json'),
+    'USE_MOCK_PARSERS': 'true',
+    'FRAGMENT_TRANSFERS_PER_SEC': '1000000000',
+    'FRAGMENT_TRANSFER_BURST': '1000000000',
+    'FRAGMENT_DAILY_STARS_LIMIT': '0',
+})
+
+sys.path.append(os.path.dirname(BENCH_DIR))
+
+from bs4 import BeautifulSoup
+
+import database
+from config import FRAGMENT_MAX, ORDER_WORKERS, OrderStatus
+from funpay_parser import FunPayParser
+from fragment_parser import FragmentParser
+from selector_cache import SelectorResolver
+from integrations import funpay, fragment, utils
+from message_templates import MessageTemplates, clear_template_caches
+from bench_templates import cases as template_cases
+
+DEFAULT_SIZES = '10000,100000,1000000'
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+
+
+def per_op(func, number: int, repeat: int = 3) -> float:
+    """Лучшее из repeat замеров, микросекунд на вызов"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / number * 1e6
+
+
+# --- База данных ---------------------------------------------------------------
+
+def seed_orders(path: str, rows: int, chunk: int = 50000) -> float:
+    """Массовая вставка заказов одной транзакцией на пачку; микросекунд на строку"""
+    now = datetime.now().isoformat()
+    statuses = [OrderStatus.FULFILLED] * 8 + [OrderStatus.WAITING_PAYMENT, OrderStatus.FAILED]
+    start = time.perf_counter()
+    with sqlite3.connect(path) as conn:
+        for offset in range(0, rows, chunk):
+            conn.executemany('''
+                INSERT INTO orders
+                (order_id, offer_id, quantity, buyer_username, buyer_funpay_login,
+                 total_price, currency, status, attached_telegram_username,
+                 created_at, updated_at, stars_amount_total)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', [
+                (f"SEED{i:08d}", 'stars_500', 1, f"buyer_{i % 1000}", f"buyer_{i % 1000}", 450.0, 'RUB',
+                 statuses[i % len(statuses)], '@stars_user', now, now, 500)
+                for i in range(offset, min(rows, offset + chunk))
+            ])
+            conn.commit()
+    return (time.perf_counter() - start) / rows * 1e6
+
+
+def bench_database(rows: int, ops: int) -> dict:
+    path = os.path.join(WORK_DIR, f"db_{rows}.db")
+    if os.path.exists(path):
+        os.remove(path)
+
+    # Database() читает путь из модуля database при создании
+    database.DATABASE_PATH = path
+    db = database.Database()
+    results = {'bulk_insert': seed_orders(path, rows)}
+
+    start = time.perf_counter()
+    db.rebuild_order_filter()
+    results['rebuild_order_filter'] = (time.perf_counter() - start) * 1e6
+
+    rng = random.Random(rows)
+    existing = [f"SEED{rng.randrange(rows):08d}" for _ in range(ops)]
+    template = {
+        'offer_id': 'stars_500', 'quantity': 1, 'buyer_username': 'bench', 'buyer_funpay_login': 'bench',
+        'total_price': 450.0, 'currency': 'RUB', 'status': OrderStatus.NEW,
+        'created_at': datetime.now().isoformat(), 'attached_telegram_username': '@bench_user',
+        'stars_amount_total': 500
+    }
+
+    counter = iter(range(10 ** 9))
+    results['save_order'] = per_op(lambda: db.save_order(dict(template, order_id=f"NEW{next(counter):09d}")),
+                                   ops, repeat=1)
+    ids = iter(existing * 3)
+    results['get_order'] = per_op(lambda: db.get_order(next(ids)), ops)
+    missing = iter(range(10 ** 9))
+    results['get_order_missing'] = per_op(lambda: db.get_order(f"MISSING{next(missing)}"), ops)
+    ids = iter(existing)
+    results['update_order_status'] = per_op(lambda: db.update_order_status(next(ids), OrderStatus.FULFILLED),
+                                            ops, repeat=1)
+    results['get_recent_orders'] = per_op(lambda: db.get_recent_orders(10), max(1, ops // 20))
+    results['count_orders_by_status'] = per_op(db.count_orders_by_status, 3, repeat=1)
+
+    os.remove(path)
+    return results
+
+
+# --- Разбор HTML-фикстур ---------------------------------------------------------
+
+class SoupElement:
+    """Элемент BeautifulSoup с интерфейсом WebElement, который используют парсеры"""
+
+    def __init__(self, tag):
+        self.tag = tag
+
+    @property
+    def text(self) -> str:
+        return self.tag.get_text()
+
+    def is_enabled(self) -> bool:
+        return not self.tag.has_attr('disabled')
+
+    def find_element(self, by, value):
+        found = self.tag.select_one(value)
+        if found is None:
+            raise LookupError(value)
+        return SoupElement(found)
+
+    def find_elements(self, by, value):
+        return [SoupElement(tag) for tag in self.tag.select(value)]
+
+
+class SoupDriver(SoupElement):
+    """Вместо Chrome - разобранная фикстура; поддерживаются только CSS-селекторы"""
+
+    def find_elements(self, by, value):
+        if by != 'css selector':
+            return []
+        return super().find_elements(by, value)
+
+    def implicitly_wait(self, seconds):
+        pass
+
+
+def load_fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def bench_parsing(number: int) -> dict:
+    orders_html = load_fixture('funpay_orders.html')
+    order_html = load_fixture('funpay_order.html')
+    balance_html = load_fixture('fragment_balance.html')
+
+    results = {
+        'soup.funpay_orders': per_op(lambda: BeautifulSoup(orders_html, 'html.parser'), max(1, number // 10)),
+        'soup.funpay_order': per_op(lambda: BeautifulSoup(order_html, 'html.parser'), number),
+        'soup.fragment_balance': per_op(lambda: BeautifulSoup(balance_html, 'html.parser'), number),
+    }
+
+    funpay_parser = FunPayParser('bench', 'bench')
+    orders_page = SoupDriver(BeautifulSoup(orders_html, 'html.parser'))
+    rows = orders_page.find_elements('css selector', '.order-row')
+    assert rows and funpay_parser._parse_order_element(rows[0])['attached_telegram_username'], "Фикстура не разобрана"
+    results['funpay.order_rows'] = per_op(
+        lambda: [funpay_parser._parse_order_element(row) for row in rows], max(1, number // 10)
+    ) / len(rows)
+
+    funpay_parser.driver = SoupDriver(BeautifulSoup(order_html, 'html.parser'))
+    assert funpay_parser._parse_order_page()['payment_status'], "Фикстура не разобрана"
+    results['funpay.order_page'] = per_op(funpay_parser._parse_order_page, number)
+
+    fragment_parser = FragmentParser('bench')
+    fragment_parser.resolver = SelectorResolver(stats_path=os.path.join(WORK_DIR, 'selector_stats.json'))
+    fragment_parser.driver = SoupDriver(BeautifulSoup(balance_html, 'html.parser'))
+
+    async def find_balance():
+        element = await fragment_parser._find('balance', 'stars_balance')
+        return int(''.join(ch for ch in element.text if ch.isdigit()))
+
+    async def balance_loop(count: int) -> float:
+        assert await find_balance() == 48750, "Фикстура не разобрана"
+        start = time.perf_counter()
+        for _ in range(count):
+            await find_balance()
+        return (time.perf_counter() - start) / count * 1e6
+
+    results['fragment.balance'] = asyncio.run(balance_loop(number))
+    return results
+
+
+# --- Батчи и шаблоны ---------------------------------------------------------------
+
+def bench_batching(number: int) -> dict:
+    results = {}
+    for stars in (FRAGMENT_MAX // 2, 1_000_000, 100_000_000):
+        count = max(1, number // max(1, stars // (FRAGMENT_MAX * 10)))
+        results[f"split.{stars}"] = per_op(lambda: utils.split_stars_into_batches(stars, FRAGMENT_MAX), count)
+    return results
+
+
+def bench_templates(number: int) -> dict:
+    templates = MessageTemplates()
+    clear_template_caches()
+    results = {}
+    for name, (render, cached) in template_cases(templates).items():
+        cached()
+        results[f"{name}.render"] = per_op(render, number)
+        results[f"{name}.cached"] = per_op(cached, number)
+    return results
+
+
+# --- Полный конвейер --------------------------------------------------------------
+
+class FastFunPayParser:
+    """Ответы как у MockFunPayParser, но без искусственных задержек и вывода"""
+
+    is_logged_in = True
+
+    def _order(self, order_id: str) -> dict:
+        return {
+            'order_id': order_id, 'offer_id': 'stars_500', 'quantity': 1,
+            'buyer_username': 'bench_buyer', 'buyer_funpay_login': 'bench_buyer',
+            'total_price': 450.0, 'currency': 'RUB', 'status': 'PAID',
+            'created_at': datetime.now().isoformat(), 'attached_telegram_username': '@bench_user',
+            'stars_amount_total': 500, 'payment_status': True
+        }
+
+    async def get_orders(self):
+        return [self._order('BENCH_OFFER')]
+
+    async def get_order_details(self, order_id: str):
+        return self._order(order_id)
+
+    async def send_message(self, order_id: str, message: str) -> bool:
+        return True
+
+    def close(self):
+        pass
+
+
+class FastFragmentParser:
+    is_logged_in = True
+
+    async def get_balance(self) -> dict:
+        return {'stars_balance': 10 ** 12, 'daily_limit_left': 10 ** 12}
+
+    async def transfer_stars(self, to_username: str, stars_amount: int, idempotency_key: str) -> dict:
+        return {'ok': True, 'transfer_id': f"bench_{idempotency_key}", 'error_code': None, 'error_message': None}
+
+    def close(self):
+        pass
+
+
+class NullNotificationService:
+    async def notify_user(self, chat_id, message, **kwargs):
+        pass
+
+    async def notify_admin(self, message, **kwargs):
+        pass
+
+
+def bench_pipeline(orders: int) -> dict:
+    from order_processor import OrderProcessor
+
+    funpay.parser = FastFunPayParser()
+    fragment.parser = FastFragmentParser()
+    processor = OrderProcessor(NullNotificationService())
+
+    async def run() -> dict:
+        # Прогрев: офферы, баланс, ленивые структуры
+        await processor.process_order('BENCH_WARMUP', 1)
+        assert database.db.get_order('BENCH_WARMUP')['status'] == OrderStatus.FULFILLED, "Прогон не дошёл до выдачи"
+
+        start = time.perf_counter()
+        for i in range(orders):
+            await processor.process_order(f"BENCH_SEQ{i:07d}", 1)
+        sequential = (time.perf_counter() - start) / orders * 1e6
+
+        semaphore = asyncio.Semaphore(ORDER_WORKERS)
+
+        async def worker(order_id: str):
+            async with semaphore:
+                await processor.process_order(order_id, 1)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(f"BENCH_CON{i:07d}") for i in range(orders)))
+        concurrent = (time.perf_counter() - start) / orders * 1e6
+        return {'process_order.sequential': sequential, f"process_order.concurrent_{ORDER_WORKERS}": concurrent}
+
+    # Код конвейера печатает ход обработки; в консоль бенчмарка это не выводится
+    with contextlib.redirect_stdout(io.StringIO()):
+        return asyncio.run(run())
+
+
+# --- Отчёт -----------------------------------------------------------------------
+
+def flatten(groups: dict) -> dict:
+    return {f"{group}.{name}": round(value, 3) for group, values in groups.items() for name, value in values.items()}
+
+
+def compare(results: dict, baseline: dict) -> list:
+    """[(имя, значение, baseline, разница %)]; положительная разница - стало медленнее"""
+    rows = []
+    for name, value in results.items():
+        base = baseline.get(name)
+        diff = (value - base) / base * 100 if base else None
+        rows.append((name, value, base, diff))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Офлайн-бенчмарки бота')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='Размеры таблицы заказов через запятую')
+    parser.add_argument('--db-ops', type=int, default=2000, help='Операций на замер базы')
+    parser.add_argument('--number', type=int, default=2000, help='Повторов на замер разбора/шаблонов/батчей')
+    parser.add_argument('--orders', type=int, default=200, help='Заказов в прогоне process_order')
+    parser.add_argument('--only', help='Только группы: db,parsing,batching,templates,pipeline')
+    parser.add_argument('--json', help='Сохранить результаты в JSON')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE if os.path.exists(DEFAULT_BASELINE) else None,
+                        help='JSON с baseline для сравнения (по умолчанию benchmarks/baseline.json)')
+    parser.add_argument('--save-baseline', help='Сохранить результаты как baseline')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Замедление в %%, считающееся регрессией')
+    parser.add_argument('--fail-on-regression', action='store_true', help='Код выхода 1 при регрессии')
+    args = parser.parse_args()
+
+    only = set(args.only.split(',')) if args.only else {'db', 'parsing', 'batching', 'templates', 'pipeline'}
+    groups = {}
+    if 'db' in only:
+        for size in (int(s) for s in args.sizes.split(',') if s.strip()):
+            print(f"⏱ База: {size:,} строк...")
+            groups[f"db.{size}"] = bench_database(size, args.db_ops)
+    if 'parsing' in only:
+        print("⏱ Разбор фикстур...")
+        groups['parsing'] = bench_parsing(args.number)
+    if 'batching' in only:
+        print("⏱ Разбиение на батчи...")
+        groups['batching'] = bench_batching(args.number)
+    if 'templates' in only:
+        print("⏱ Шаблоны...")
+        groups['templates'] = bench_templates(args.number)
+    if 'pipeline' in only:
+        print(f"⏱ process_order x{args.orders}...")
+        groups['pipeline'] = bench_pipeline(args.orders)
+
+    results = flatten(groups)
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'unit': 'us_per_op',
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+
+    regressions = []
+    print(f"\n{'Замер':<48}{'мкс/оп':>14}{'baseline':>14}{'разница':>10}")
+    for name, value, base, diff in compare(results, baseline):
+        mark = ''
+        if diff is not None and diff > args.threshold:
+            mark = ' ⚠️'
+            regressions.append(name)
+        base_text = f"{base:>14}" if base is not None else f"{'-':>14}"
+        diff_text = f"{diff:>+9.1f}%" if diff is not None else f"{'-':>10}"
+        print(f"{name:<48}{value:>14}{base_text}{diff_text}{mark}")
+
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"✅ Результаты сохранены в {path}")
+
+    if regressions:
+        print(f"⚠️ Медленнее baseline более чем на {args.threshold:g}%: {', '.join(regressions)}")
+        if args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
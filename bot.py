@@ -1,41 +1,86 @@
 import asyncio
+import io
 import logging
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+import time
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import (
+    Application, CallbackQueryHandler, CommandHandler, MessageHandler, TypeHandler, filters, ContextTypes
+)
 from typing import Dict, List
 
-from config import TELEGRAM_TOKEN, ADMIN_IDS, OrderStatus
+from config import (
+    TELEGRAM_TOKEN, ADMIN_IDS, OrderStatus, TELEGRAM_WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN,
+    ORDER_WEBHOOK_TOKEN, METRICS_ENABLED, PROFILE_MAX_SEC
+)
 from database import db
 from integrations import funpay, fragment, utils, NotificationService
 from order_processor import OrderProcessor
+from logging_system import OrderLogger, setup_logging, shutdown_logging
+from outbox import OutboxDispatcher
 from message_templates import MessageTemplates
+from session_store import SessionKeeper
+from browser_supervisor import BrowserSupervisor
+from balance_service import balance_service
+from http_client import http_client
+from circuit_breaker import breakers
+from webhook_server import WebhookServer, telegram_updates
+from update_processor import UserOrderedUpdateProcessor
+from state_store import UserStateStore
+from order_queue import OrderJobQueue
+from rate_limiter import CommandRateLimiter
+from metrics import metrics
+from profiler import LoopMonitor, profile
+import tracing
+
+telegram_update_seconds = metrics.histogram('telegram_update_seconds', 'Update handling time (receipt to last handler)')
+telegram_update_lag_seconds = metrics.histogram('telegram_update_lag_seconds', 'Webhook receipt to first handler')
 
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
 logger = logging.getLogger(__name__)
 
 class TelegramStarsBot:
     def __init__(self):
-        self.application = Application.builder().token(TELEGRAM_TOKEN).build()
+        # Users are served concurrently; each user's updates are still handled in order
+        self.application = (
+            Application.builder()
+            .token(TELEGRAM_TOKEN)
+            .concurrent_updates(UserOrderedUpdateProcessor())
+            .build()
+        )
         self.notification_service = NotificationService(self.application.bot)
         self.order_processor = OrderProcessor(self.notification_service)
+        self.order_queue = OrderJobQueue(self.order_processor)
+        self.outbox_dispatcher = OutboxDispatcher(self.notification_service)
         self.message_templates = MessageTemplates()
+        self.command_limiter = CommandRateLimiter()
         
         # Initialize logging system
-        from logging_system import OrderLogger
         self.order_logger = OrderLogger(self.notification_service)
         
-        # User states for username confirmation
-        self.user_states = {}  # {user_id: {'state': 'waiting_username', 'order_id': '...'}}
+        # User states for username confirmation: {'state': 'waiting_username', 'order_id': '...'}
+        self.user_states = UserStateStore()
+        
+        # Browser sessions are restored on startup and refreshed in the background
+        self.session_keeper = SessionKeeper([funpay.parser, fragment.parser])
+        self.browser_supervisor = BrowserSupervisor([funpay.parser, fragment.parser])
+        self._stop_event = None
+        
+        # Webhook mode and the order intake endpoint share one aiohttp server
+        self.webhook_server = WebhookServer(self.application, order_handler=self.process_order_webhook)
+        self._update_started_at: Dict[int, float] = {}
+        
+        # Event loop lag, slow callbacks and task lifetimes for /admin loopstats
+        self.loop_monitor = LoopMonitor()
+        self._profiling = False
         
         self._setup_handlers()
     
     def _setup_handlers(self):
         """Setup command and message handlers"""
         
+        # Latency: group -1 runs before every handler, group 100 after all of them
+        self.application.add_handler(TypeHandler(Update, self._on_update_start), group=-1)
+        self.application.add_handler(TypeHandler(Update, self._on_update_done), group=100)
+        
         # User commands
         self.application.add_handler(CommandHandler("start", self.start_command))
         self.application.add_handler(CommandHandler("price", self.price_command))
@@ -49,6 +94,23 @@ class TelegramStarsBot:
         
         # Message handler for username input
         self.application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        self.application.add_handler(CallbackQueryHandler(self.handle_username_callback, pattern=r'^username:'))
+    
+    async def _on_update_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Record update handling start (and webhook queueing lag)"""
+        now = time.monotonic()
+        received_at = self.webhook_server.pop_received_at(update.update_id)
+        if received_at is not None:
+            telegram_update_lag_seconds.observe(now - received_at)
+        else:
+            telegram_updates.inc(source='polling')
+        self._update_started_at[update.update_id] = received_at or now
+    
+    async def _on_update_done(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Record total update handling time"""
+        started_at = self._update_started_at.pop(update.update_id, None)
+        if started_at is not None:
+            telegram_update_seconds.observe(time.monotonic() - started_at)
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -57,8 +119,19 @@ class TelegramStarsBot:
             parse_mode='HTML'
         )
     
+    async def _rate_limited(self, update: Update, command: str) -> bool:
+        """Reply with a cooldown when the user or everyone together runs a scraping command too often"""
+        retry_in = self.command_limiter.check(command, update.effective_user.id)
+        if not retry_in:
+            return False
+        await update.effective_message.reply_text(self.message_templates.rate_limited(retry_in))
+        return True
+    
     async def price_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /price command"""
+        if await self._rate_limited(update, 'price'):
+            return
+        
         try:
             offers = await funpay.list_offers()
             db.save_offers(offers)  # Cache offers
@@ -92,8 +165,13 @@ class TelegramStarsBot:
             )
             return
         
-        order_id = context.args[0]
+        await self._show_order_status(update, context.args[0])
+    
+    async def _show_order_status(self, update: Update, order_id: str):
+        """Reply with order status (may scrape FunPay for unknown orders)"""
         user_id = update.effective_user.id
+        if await self._rate_limited(update, 'order'):
+            return
         
         try:
             # Get order from database first
@@ -115,6 +193,11 @@ class TelegramStarsBot:
             message = self.message_templates.order_status(order_data, fulfillment_data)
             await update.message.reply_text(message, parse_mode='HTML')
             
+            # Start the username flow for orders that can't be delivered yet
+            if order_data.get('status') == OrderStatus.NEEDS_USERNAME:
+                self.user_states.set(user_id, {'state': 'waiting_username', 'order_id': order_id})
+                await update.message.reply_text(self.message_templates.needs_username(order_data), parse_mode='HTML')
+            
         except Exception as e:
             logger.error(f"Error in order command: {e}")
             await update.message.reply_text("❌ Ошибка получения статуса заказа.")
@@ -134,7 +217,10 @@ class TelegramStarsBot:
                 "/admin fulfill [ID] — принудительная выдача\n"
                 "/admin balance — баланс Fragment\n"
                 "/admin offers — список офферов\n"
-                "/admin ping — статус сервисов\n\n"
+                "/admin ping — статус сервисов\n"
+                "/admin perf — задержки этапов обработки (p50/p95/p99)\n"
+                "/admin profile [сек] — профиль event loop (flamegraph)\n"
+                "/admin loopstats [debug on|off] — задержка event loop и медленные колбэки\n\n"
                 "📊 <b>Статистика:</b>\n"
                 "/stats — статистика за текущий месяц\n"
                 "/stats month [YYYY-MM] — статистика за месяц\n"
@@ -146,6 +232,11 @@ class TelegramStarsBot:
         
         subcommand = context.args[0].lower()
         
+        # These hit FunPay/Fragment directly
+        if subcommand in ("fulfill", "balance", "offers", "ping"):
+            if await self._rate_limited(update, f"admin_{subcommand}"):
+                return
+        
         try:
             if subcommand == "orders":
                 await self._handle_admin_orders(update, context)
@@ -157,6 +248,12 @@ class TelegramStarsBot:
                 await self._handle_admin_offers(update, context)
             elif subcommand == "ping":
                 await self._handle_admin_ping(update, context)
+            elif subcommand == "perf":
+                await self._handle_admin_perf(update, context)
+            elif subcommand == "profile":
+                await self._handle_admin_profile(update, context)
+            elif subcommand == "loopstats":
+                await self._handle_admin_loopstats(update, context)
             else:
                 await update.message.reply_text("❌ Неизвестная команда.")
                 
@@ -232,7 +329,7 @@ class TelegramStarsBot:
     
     async def _handle_admin_balance(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle admin balance command"""
-        balance = await fragment.get_balance()
+        balance = await balance_service.refresh()
         message = self.message_templates.admin_balance(balance)
         await update.message.reply_text(message, parse_mode='HTML')
     
@@ -275,7 +372,48 @@ class TelegramStarsBot:
         except Exception as e:
             services_status['Database'] = {'ok': False, 'error': str(e)}
         
-        message = self.message_templates.admin_ping(services_status)
+        breakers_status = {name: breaker.status() for name, breaker in breakers.items()}
+        message = self.message_templates.admin_ping(services_status, breakers_status)
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    async def _handle_admin_perf(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle admin perf command"""
+        message = self.message_templates.admin_perf(tracing.tracer.summary())
+        await update.message.reply_text(message, parse_mode='HTML')
+    
+    async def _handle_admin_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle admin profile command: sample the event loop thread and send collapsed stacks"""
+        try:
+            seconds = float(context.args[1]) if len(context.args) > 1 else 10
+        except ValueError:
+            await update.message.reply_text("❌ Укажите длительность в секундах: /admin profile 10")
+            return
+        if not 0 < seconds <= PROFILE_MAX_SEC:
+            await update.message.reply_text(f"❌ Длительность от 0 до {PROFILE_MAX_SEC:g} с.")
+            return
+        if self._profiling:
+            await update.message.reply_text("⏳ Профилирование уже идёт.")
+            return
+        
+        self._profiling = True
+        try:
+            await update.message.reply_text(f"⏱ Профилирую event loop {seconds:g} с...")
+            profiler = await profile(seconds)
+        finally:
+            self._profiling = False
+        
+        document = io.BytesIO(profiler.collapsed().encode('utf-8'))
+        await update.message.reply_document(
+            document=document,
+            filename=f"profile-{time.strftime('%Y%m%d-%H%M%S')}.folded",
+            caption=self.message_templates.admin_profile(profiler.samples, seconds, profiler.top_functions())
+        )
+    
+    async def _handle_admin_loopstats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle admin loopstats command"""
+        if len(context.args) > 2 and context.args[1].lower() == "debug":
+            self.loop_monitor.set_debug(context.args[2].lower() == "on")
+        message = self.message_templates.admin_loopstats(self.loop_monitor.stats())
         await update.message.reply_text(message, parse_mode='HTML')
     
     async def _handle_stats_current_month(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -386,16 +524,24 @@ class TelegramStarsBot:
         text = update.message.text.strip()
         
         # Check if user is in waiting state
-        if user_id in self.user_states:
-            state = self.user_states[user_id]
-            
+        state = self.user_states.get(user_id)
+        if state:
             if state['state'] == 'waiting_username':
                 await self._handle_username_input(update, text, state['order_id'])
                 return
+            
+            if state['state'] == 'confirming_username':
+                if text.lower() in ('да', 'yes'):
+                    await self._confirm_username(user_id, state)
+                    await update.message.reply_text(self._username_confirmed_message(state))
+                else:
+                    # Any other text is a corrected username
+                    await self._handle_username_input(update, text, state['order_id'])
+                return
         
         # Check if message looks like an order ID
         if self._looks_like_order_id(text):
-            await self.order_command(update, context)
+            await self._show_order_status(update, text)
             return
         
         # Default response
@@ -427,19 +573,52 @@ class TelegramStarsBot:
         order_data = db.get_order(order_id)
         if not order_data:
             await update.message.reply_text("❌ Заказ не найден.")
-            del self.user_states[user_id]
+            self.user_states.delete(user_id)
             return
         
-        # Confirm username
-        message = self.message_templates.confirm_username(order_data, normalized_username)
-        await update.message.reply_text(message, parse_mode='HTML')
-        
         # Update state to waiting confirmation
-        self.user_states[user_id] = {
+        self.user_states.set(user_id, {
             'state': 'confirming_username',
             'order_id': order_id,
             'username': normalized_username
-        }
+        })
+        
+        # Confirm username
+        message = self.message_templates.confirm_username(order_data, normalized_username)
+        keyboard = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Да", callback_data=f"username:yes:{order_id}"),
+            InlineKeyboardButton("✏️ Нет", callback_data=f"username:no:{order_id}")
+        ]])
+        await update.message.reply_text(message, parse_mode='HTML', reply_markup=keyboard)
+    
+    async def handle_username_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle Yes/No buttons under the username confirmation"""
+        query = update.callback_query
+        user_id = update.effective_user.id
+        _, answer, order_id = query.data.split(':', 2)
+        
+        state = self.user_states.get(user_id)
+        if not state or state['state'] != 'confirming_username' or state['order_id'] != order_id:
+            await query.answer("Подтверждение устарело")
+            await query.edit_message_reply_markup(reply_markup=None)
+            return
+        
+        await query.answer()
+        if answer == 'yes':
+            await self._confirm_username(user_id, state)
+            await query.edit_message_text(self._username_confirmed_message(state))
+        else:
+            self.user_states.set(user_id, {'state': 'waiting_username', 'order_id': order_id})
+            await query.edit_message_text("✏️ Пришлите правильный @юзернейм для доставки.")
+    
+    async def _confirm_username(self, user_id: int, state: Dict):
+        """Attach the confirmed username and hand the order to the job queue"""
+        db.update_order_username(state['order_id'], state['username'])
+        self.user_states.delete(user_id)
+        self.order_queue.submit(state['order_id'], user_id)
+    
+    def _username_confirmed_message(self, state: Dict) -> str:
+        return f"✅ Stars будут отправлены на {state['username']}. Заказ №{state['order_id']} передан в обработку."
     
     def _looks_like_order_id(self, text: str) -> bool:
         """Check if text looks like an order ID"""
@@ -452,8 +631,8 @@ class TelegramStarsBot:
         return bool(re.match(r'^[a-zA-Z0-9_-]+$', text))
     
     async def process_order_webhook(self, order_id: str, chat_id: int = None):
-        """Process order from webhook (external call)"""
-        await self.order_processor.process_order(order_id, chat_id)
+        """Process order from webhook (POST ORDER_WEBHOOK_PATH)"""
+        self.order_queue.submit(order_id, chat_id)
     
     async def start(self):
         """Start the bot"""
@@ -462,13 +641,71 @@ class TelegramStarsBot:
         # Initialize database
         db.init_database()
         
-        # Setup logging
-        self.order_logger.setup_logging()
+        # Conversations outlive restarts, expired ones are dropped
+        self.user_states.prune()
+        
+        # Open the shared HTTP connection pool
+        await http_client.start()
         
-        logger.info("Bot started successfully!")
+        # Resume saved FunPay/Fragment sessions so no manual login is needed
+        await self.session_keeper.start()
+        await self.browser_supervisor.start()
+        await balance_service.start()
         
-        # Keep the bot running
-        await self.application.run_polling()
+        self._stop_event = asyncio.Event()
+        
+        await self.loop_monitor.start()
+        
+        async with self.application:
+            await self.application.start()
+            if TELEGRAM_WEBHOOK_URL:
+                if not WEBHOOK_SECRET_TOKEN:
+                    logger.warning("WEBHOOK_SECRET_TOKEN is empty: webhook requests are not authenticated")
+                # Updates are pushed to our aiohttp server instead of long polling
+                await self.application.bot.set_webhook(
+                    url=TELEGRAM_WEBHOOK_URL + WEBHOOK_PATH,
+                    secret_token=WEBHOOK_SECRET_TOKEN or None,
+                    allowed_updates=Update.ALL_TYPES
+                )
+            else:
+                await self.application.updater.start_polling()
+            if TELEGRAM_WEBHOOK_URL or ORDER_WEBHOOK_TOKEN or METRICS_ENABLED:
+                await self.webhook_server.start()
+            await self.notification_service.start()
+            await self.outbox_dispatcher.start()
+            await self.order_queue.start()
+            parked = self.order_processor.load_parked()
+            for order_id, chat_id in parked:
+                self.order_queue.submit(order_id, chat_id)
+            if parked:
+                logger.info("Re-driving %d orders parked before restart", len(parked))
+            logger.info("Bot started successfully!")
+            
+            try:
+                # Keep the bot running
+                await self._stop_event.wait()
+            finally:
+                if self.application.updater.running:
+                    await self.application.updater.stop()
+                await self.webhook_server.stop()
+                await self.order_queue.stop()
+                await self.outbox_dispatcher.stop()
+                await self.notification_service.stop()
+                self.outbox_dispatcher.flush()
+                tracing.tracer.flush()
+                await self.application.stop()
+                await self.session_keeper.stop()
+                await self.browser_supervisor.stop()
+                await balance_service.stop()
+                await self.loop_monitor.stop()
+                await http_client.close()
+                funpay.parser.close()
+                fragment.parser.close()
+    
+    def stop(self):
+        """Request graceful shutdown"""
+        if self._stop_event:
+            self._stop_event.set()
 
 # Global bot instance
 bot_instance = None
@@ -476,8 +713,13 @@ bot_instance = None
 async def main():
     """Main function"""
     global bot_instance
-    bot_instance = TelegramStarsBot()
-    await bot_instance.start()
+    # File and console output go through a background thread, not the event loop
+    setup_logging()
+    try:
+        bot_instance = TelegramStarsBot()
+        await bot_instance.start()
+    finally:
+        shutdown_logging()
 
 if __name__ == '__main__':
     asyncio.run(main())
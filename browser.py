@@ -0,0 +1,217 @@
+"""
+Общие утилиты браузера для парсеров FunPay и Fragment
+"""
+
+import os
+import time
+import asyncio
+import functools
+from typing import Iterable, List
+from urllib.parse import urlsplit
+from selenium.common.exceptions import WebDriverException
+
+from config import BROWSER_BLOCK_RESOURCES
+from metrics import metrics
+
+browser_navigations = metrics.counter('browser_navigations_total', 'Переходы браузера по страницам')
+browser_restarts = metrics.counter('browser_restarts_total', 'Перезапуски браузера по причинам')
+browser_rss_bytes = metrics.gauge('browser_rss_bytes', 'RSS Chrome вместе с chromedriver')
+browser_page_load_seconds = metrics.histogram('browser_page_load_seconds', 'Загрузка страницы по браузеру и типу страницы')
+
+# Шаблоны URL для Network.setBlockedURLs (CDP) по типам ресурсов
+RESOURCE_PATTERNS = {
+    'images': ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp', '*.avif', '*.svg', '*.ico', '*.bmp'],
+    'media': ['*.mp4', '*.webm', '*.ogg', '*.mp3', '*.wav', '*.m4a', '*.m3u8'],
+    'fonts': ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'],
+    'css': ['*.css'],
+    'analytics': [
+        '*google-analytics.com*', '*googletagmanager.com*', '*doubleclick.net*',
+        '*mc.yandex.ru*', '*top-fwz1.mail.ru*', '*connect.facebook.net*',
+        '*hotjar.com*', '*vk.com/rtrg*', '*sentry-cdn.com*'
+    ]
+}
+
+
+def exclusive(method):
+    """Сериализует операции парсера над одним браузером (повторный вход из той же задачи разрешён)"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        task = asyncio.current_task()
+        if getattr(self, '_browser_owner', None) is task:
+            return await method(self, *args, **kwargs)
+
+        lock = self.__dict__.get('_browser_lock')
+        if lock is None:
+            lock = self._browser_lock = asyncio.Lock()
+
+        async with lock:
+            self._browser_owner = task
+            try:
+                return await method(self, *args, **kwargs)
+            finally:
+                self._browser_owner = None
+
+    return wrapper
+
+
+class SupervisedBrowser:
+    """Учёт навигаций, RSS и перезапуск браузера парсера с сохранением сессии"""
+
+    browser_name = 'browser'
+    navigations = 0
+    rate_limiter = None
+    _restarting = False
+
+    async def _navigate(self, url: str):
+        """Переход по URL с подсчётом навигаций и прозрачным перезапуском упавшего браузера"""
+        if not self.driver and not self.setup_driver():
+            raise WebDriverException("Браузер не запущен")
+        
+        if self.rate_limiter:
+            await self.rate_limiter.acquire()
+
+        start = time.monotonic()
+        try:
+            self.driver.get(url)
+        except WebDriverException as e:
+            if self._restarting or self.is_browser_alive():
+                raise
+            print(f"⚠️ Браузер {self.browser_name} упал, перезапуск...")
+            await self.restart_browser('crash')
+            if not self.driver:
+                raise WebDriverException(f"Браузер {self.browser_name} недоступен: перезапуск не удался") from e
+            self.driver.get(url)
+        browser_page_load_seconds.observe(time.monotonic() - start, browser=self.browser_name, page=page_type(url))
+
+        self.navigations += 1
+        browser_navigations.inc(browser=self.browser_name)
+        if self.rate_limiter:
+            self.rate_limiter.record()
+
+    def is_browser_alive(self) -> bool:
+        """Жив ли процесс Chrome и сессия chromedriver"""
+        if not self.driver:
+            return False
+        browser_pid = getattr(self.driver, 'browser_pid', None)
+        if browser_pid and not os.path.exists(f'/proc/{browser_pid}'):
+            return False
+        try:
+            self.driver.window_handles
+            return True
+        except Exception:
+            return False
+
+    def browser_rss(self) -> int:
+        """RSS дерева процессов Chrome и chromedriver в байтах"""
+        if not self.driver:
+            return 0
+        total = 0
+        browser_pid = getattr(self.driver, 'browser_pid', None)
+        if browser_pid:
+            total += process_tree_rss(browser_pid)
+        service = getattr(self.driver, 'service', None)
+        process = getattr(service, 'process', None)
+        if process:
+            total += _process_rss(process.pid)
+        return total
+
+    @exclusive
+    async def restart_browser(self, reason: str):
+        """Перезапуск браузера между операциями; cookie сохраняются и восстанавливаются"""
+        self._restarting = True
+        try:
+            if self.is_logged_in and self.is_browser_alive():
+                self.save_session()
+
+            if self.driver:
+                try:
+                    self.driver.quit()
+                except Exception:
+                    pass
+                self.driver = None
+
+            self.is_logged_in = False
+            self.navigations = 0
+            browser_restarts.inc(browser=self.browser_name, reason=reason)
+            print(f"♻️ Перезапуск браузера {self.browser_name} ({reason})")
+
+            if self.setup_driver():
+                await self.restore_session()
+        finally:
+            self._restarting = False
+
+
+def page_type(url: str) -> str:
+    """Метка страницы для метрик: путь без хоста, ID заменены на :id (funpay.com/orders/123/ -> orders/:id)"""
+    path = urlsplit(url).path.strip('/')
+    if not path:
+        return 'home'
+    return '/'.join(':id' if any(c.isdigit() for c in part) else part for part in path.split('/'))
+
+
+def blocked_url_patterns(resource_types: Iterable[str] = None) -> List[str]:
+    """Шаблоны блокировки для списка типов ресурсов (по умолчанию BROWSER_BLOCK_RESOURCES)"""
+    if resource_types is None:
+        resource_types = BROWSER_BLOCK_RESOURCES
+    patterns = []
+    for resource_type in resource_types:
+        if resource_type not in RESOURCE_PATTERNS:
+            print(f"⚠️ Неизвестный тип ресурсов для блокировки: {resource_type}")
+            continue
+        patterns.extend(RESOURCE_PATTERNS[resource_type])
+    return patterns
+
+
+def apply_resource_blocking(driver, resource_types: Iterable[str] = None) -> List[str]:
+    """Блокировка картинок, шрифтов, медиа и трекеров через Chrome DevTools Protocol"""
+    patterns = blocked_url_patterns(resource_types)
+    if not patterns:
+        return []
+    try:
+        driver.execute_cdp_cmd('Network.enable', {})
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': patterns})
+    except Exception as e:
+        print(f"⚠️ Не удалось включить блокировку ресурсов: {e}")
+        return []
+    return patterns
+
+
+def process_tree_rss(pid: int) -> int:
+    """Суммарный RSS процесса и всех его потомков в байтах (по /proc)"""
+    children = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return 0
+
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as f:
+                stat = f.read()
+            # Имя процесса в скобках может содержать пробелы, поля идут после ')'
+            ppid = int(stat.rsplit(')', 1)[1].split()[1])
+            children.setdefault(ppid, []).append(int(entry))
+        except (OSError, ValueError, IndexError):
+            continue
+
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        total += _process_rss(current)
+        stack.extend(children.get(current, []))
+    return total
+
+
+def _process_rss(pid: int) -> int:
+    """RSS одного процесса в байтах"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return 0
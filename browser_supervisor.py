@@ -0,0 +1,61 @@
+"""
+Сторож браузеров: RSS и число навигаций по /proc, плановый перезапуск Chrome
+"""
+
+import asyncio
+from typing import List
+
+from config import BROWSER_MAX_NAVIGATIONS, BROWSER_MAX_RSS_MB, BROWSER_WATCHDOG_INTERVAL_SEC
+from browser import browser_rss_bytes
+
+
+class BrowserSupervisor:
+    def __init__(self, parsers: List, max_navigations: int = BROWSER_MAX_NAVIGATIONS,
+                 max_rss_mb: int = BROWSER_MAX_RSS_MB,
+                 interval_seconds: float = BROWSER_WATCHDOG_INTERVAL_SEC):
+        # Mock парсеры без браузера не отслеживаются
+        self.parsers = [parser for parser in parsers if hasattr(parser, 'restart_browser')]
+        self.max_navigations = max_navigations
+        self.max_rss_bytes = max_rss_mb * 1024 * 1024
+        self.interval_seconds = interval_seconds
+        self._task = None
+
+    async def start(self):
+        if self.parsers:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            for parser in self.parsers:
+                try:
+                    await self.check(parser)
+                except Exception as e:
+                    print(f"⚠️ Ошибка проверки браузера {parser.browser_name}: {e}")
+
+    async def check(self, parser):
+        """Проверка одного браузера и перезапуск при падении или превышении лимитов"""
+        if not parser.driver:
+            return
+
+        if not parser.is_browser_alive():
+            await parser.restart_browser('crash')
+            return
+
+        rss = parser.browser_rss()
+        browser_rss_bytes.set(rss, browser=parser.browser_name)
+
+        if self.max_rss_bytes and rss > self.max_rss_bytes:
+            print(f"⚠️ Браузер {parser.browser_name} занимает {rss / (1024 * 1024):.0f} МБ")
+            await parser.restart_browser('memory')
+        elif self.max_navigations and parser.navigations >= self.max_navigations:
+            await parser.restart_browser('navigations')
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,166 @@
+"""
+Circuit breaker для FunPay и Fragment: размыкание по доле ошибок, быстрый отказ, пробный запрос
+"""
+
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from config import CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW, CIRCUIT_OPEN_SEC
+from metrics import metrics
+
+circuit_state = metrics.gauge('circuit_state', 'Состояние breaker: 0 closed, 1 half_open, 2 open')
+circuit_transitions = metrics.counter('circuit_transitions_total', 'Переходы breaker между состояниями')
+circuit_rejected = metrics.counter('circuit_rejected_total', 'Вызовы, отклонённые разомкнутым breaker')
+
+
+class CircuitOpenError(Exception):
+    """Breaker разомкнут: вызов отклонён без обращения к сервису"""
+
+    def __init__(self, breaker: str, retry_in: float):
+        super().__init__(f"Сервис {breaker} временно недоступен (повтор через {retry_in:.0f} с)")
+        self.breaker = breaker
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    HALF_OPEN = 'half_open'
+    OPEN = 'open'
+
+    _STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_rate: float = CIRCUIT_FAILURE_RATE,
+                 min_calls: int = CIRCUIT_MIN_CALLS, window: int = CIRCUIT_WINDOW,
+                 open_seconds: float = CIRCUIT_OPEN_SEC,
+                 is_failure: Callable[[Any], bool] = None):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.is_failure = is_failure or (lambda result: False)
+
+        self._outcomes = deque(maxlen=window)  # True - успех, False - ошибка
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._close_listeners: List[Callable[[str], None]] = []
+        circuit_state.set(0, breaker=name)
+
+    @property
+    def state(self) -> str:
+        """Текущее состояние; OPEN сам переходит в HALF_OPEN по истечении open_seconds"""
+        if self._state == self.OPEN and self.retry_in() <= 0:
+            self._transition(self.HALF_OPEN)
+        return self._state
+
+    @property
+    def probe_in_flight(self) -> bool:
+        """Пробный запрос HALF_OPEN уже выполняется, остальные вызовы сейчас отклоняются"""
+        return self._probe_in_flight
+
+    def retry_in(self) -> float:
+        """Секунд до пробного запроса (0, если breaker не разомкнут)"""
+        if self._state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def error_rate(self) -> float:
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def on_close(self, callback: Callable[[str], None]):
+        """Подписка на восстановление сервиса (callback получает имя breaker)"""
+        self._close_listeners.append(callback)
+
+    def check(self):
+        """Быстрый отказ без вызова: CircuitOpenError, если сейчас запрос не пропустят"""
+        state = self.state
+        if state == self.OPEN or (state == self.HALF_OPEN and self._probe_in_flight):
+            circuit_rejected.inc(breaker=self.name)
+            raise CircuitOpenError(self.name, self.retry_in())
+
+    async def call(self, fn: Callable[[], Awaitable], is_failure: Callable[[Any], bool] = None) -> Any:
+        """Вызов через breaker; в HALF_OPEN пропускается ровно один пробный запрос"""
+        self.check()
+
+        probe = self._state == self.HALF_OPEN
+        if probe:
+            self._probe_in_flight = True
+
+        try:
+            result = await fn()
+        except CircuitOpenError:
+            raise
+        except Exception:
+            self._record(False, probe)
+            raise
+        finally:
+            if probe:
+                self._probe_in_flight = False
+
+        self._record(not (is_failure or self.is_failure)(result), probe)
+        return result
+
+    def _record(self, success: bool, probe: bool):
+        if probe or self._state == self.HALF_OPEN:
+            if success:
+                self._outcomes.clear()
+                self._transition(self.CLOSED)
+            else:
+                self._open()
+            return
+
+        self._outcomes.append(success)
+        if (self._state == self.CLOSED and len(self._outcomes) >= self.min_calls
+                and self.error_rate() >= self.failure_rate):
+            self._open()
+
+    def _open(self):
+        self._opened_at = time.monotonic()
+        self._transition(self.OPEN)
+        print(f"⚠️ Breaker {self.name} разомкнут на {self.open_seconds:.0f} с")
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        previous, self._state = self._state, state
+        circuit_state.set(self._STATE_VALUES[state], breaker=self.name)
+        circuit_transitions.inc(breaker=self.name, to=state)
+
+        if state == self.CLOSED and previous != self.CLOSED:
+            print(f"✅ Breaker {self.name} замкнут, сервис восстановлен")
+            for callback in list(self._close_listeners):
+                try:
+                    callback(self.name)
+                except Exception as e:
+                    print(f"⚠️ Ошибка обработчика восстановления {self.name}: {e}")
+
+    def status(self) -> Dict:
+        """Состояние для /admin ping"""
+        return {
+            'state': self.state,
+            'error_rate': round(self.error_rate(), 2),
+            'calls': len(self._outcomes),
+            'retry_in': round(self.retry_in())
+        }
+
+
+def _balance_failed(balance: Optional[Dict]) -> bool:
+    # Парсер Fragment при ошибке возвращает нулевой баланс и нулевой дневной лимит
+    return not balance or (balance.get('stars_balance') == 0 and balance.get('daily_limit_left') == 0)
+
+
+def _transfer_failed(result: Optional[Dict]) -> bool:
+    return not result or not result.get('ok')
+
+
+# Breaker на каждый внешний сервис
+breakers: Dict[str, CircuitBreaker] = {
+    # None от FunPay - «заказа нет» (например, ID с опечаткой); сбоем считаются только исключения
+    'funpay_read': CircuitBreaker('funpay_read'),
+    'funpay_chat': CircuitBreaker('funpay_chat', is_failure=lambda sent: not sent),
+    'fragment_balance': CircuitBreaker('fragment_balance', is_failure=_balance_failed),
+    'fragment_transfer': CircuitBreaker('fragment_transfer', is_failure=_transfer_failed),
+}
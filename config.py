@@ -7,6 +7,33 @@ load_dotenv()
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 ADMIN_IDS = [int(id.strip()) for id in os.getenv('ADMIN_IDS', '').split(',') if id.strip()]
 
+# Webhook mode (polling when TELEGRAM_WEBHOOK_URL is empty)
+TELEGRAM_WEBHOOK_URL = os.getenv('TELEGRAM_WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN', '')
+# Update processing (handlers run concurrently, one user's updates stay in order)
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '16'))
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '256'))
+# Conversation state (username flow) and order job queue
+USER_STATE_TTL_SEC = float(os.getenv('USER_STATE_TTL_SEC', '3600'))
+USER_STATE_MAX_ENTRIES = int(os.getenv('USER_STATE_MAX_ENTRIES', '10000'))
+ORDER_WORKERS = int(os.getenv('ORDER_WORKERS', '4'))
+ORDER_QUEUE_MAX = int(os.getenv('ORDER_QUEUE_MAX', '1000'))
+# Expensive bot commands (/order, /price, admin scrapes): sliding window limits
+COMMAND_RATE_WINDOW_SEC = float(os.getenv('COMMAND_RATE_WINDOW_SEC', '60'))
+COMMAND_USER_LIMIT = int(os.getenv('COMMAND_USER_LIMIT', '5'))
+COMMAND_GLOBAL_LIMIT = int(os.getenv('COMMAND_GLOBAL_LIMIT', '60'))
+# Order intake endpoint (served by the same HTTP server, disabled without a token)
+ORDER_WEBHOOK_PATH = os.getenv('ORDER_WEBHOOK_PATH', '/orders')
+ORDER_WEBHOOK_TOKEN = os.getenv('ORDER_WEBHOOK_TOKEN', '')
+ORDER_WEBHOOK_MAX_BATCH = int(os.getenv('ORDER_WEBHOOK_MAX_BATCH', '100'))
+# Prometheus text endpoint on the same HTTP server (optional bearer token)
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'false').lower() == 'true'
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 # Business Rules
 CURRENCY = os.getenv('CURRENCY', 'RUB')
 PAYMENT_WAIT_MINUTES = int(os.getenv('PAYMENT_WAIT_MINUTES', '30'))
@@ -18,6 +45,16 @@ MAX_RETRY = int(os.getenv('MAX_RETRY', '5'))
 MAX_RETRY_VERIFY = int(os.getenv('MAX_RETRY_VERIFY', '5'))
 RETRY_AFTER_MIN = int(os.getenv('RETRY_AFTER_MIN', '30'))
 
+# Retry Policy (decorrelated jitter, overall deadline, global retry budget)
+RETRY_MAX_DELAY_SEC = float(os.getenv('RETRY_MAX_DELAY_SEC', '30'))
+RETRY_MAX_ELAPSED_SEC = float(os.getenv('RETRY_MAX_ELAPSED_SEC', '120'))
+RETRY_BUDGET_CAPACITY = float(os.getenv('RETRY_BUDGET_CAPACITY', '20'))
+RETRY_BUDGET_REFILL_PER_SEC = float(os.getenv('RETRY_BUDGET_REFILL_PER_SEC', '0.5'))
+# Fragment error codes that are safe to retry (raised before the transfer form is submitted)
+TRANSFER_RETRYABLE_CODES = [code.strip() for code in os.getenv(
+    'TRANSFER_RETRYABLE_CODES', 'rate_limited,auth_failed,form_not_found,send_button_not_found'
+).split(',') if code.strip()]
+
 # FunPay Parser Configuration
 FUNPAY_LOGIN = os.getenv('FUNPAY_LOGIN')
 FUNPAY_PASSWORD = os.getenv('FUNPAY_PASSWORD')
@@ -25,10 +62,110 @@ FUNPAY_PASSWORD = os.getenv('FUNPAY_PASSWORD')
 # Fragment Parser Configuration
 FRAGMENT_PHONE = os.getenv('FRAGMENT_PHONE')
 
+# HTTP APIs (optional, used alongside the parsers)
+FUNPAY_API_URL = os.getenv('FUNPAY_API_URL', '')
+FUNPAY_API_KEY = os.getenv('FUNPAY_API_KEY', '')
+FRAGMENT_API_URL = os.getenv('FRAGMENT_API_URL', '')
+FRAGMENT_API_KEY = os.getenv('FRAGMENT_API_KEY', '')
+
+# Shared HTTP Client (connection pool)
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '10'))
+HTTP_DNS_CACHE_TTL_SEC = int(os.getenv('HTTP_DNS_CACHE_TTL_SEC', '300'))
+HTTP_KEEPALIVE_SEC = float(os.getenv('HTTP_KEEPALIVE_SEC', '30'))
+HTTP_TIMEOUT_SEC = float(os.getenv('HTTP_TIMEOUT_SEC', '30'))
+
 # Parser Settings
 USE_MOCK_PARSERS = os.getenv('USE_MOCK_PARSERS', 'true').lower() == 'true'
 BROWSER_HEADLESS = os.getenv('BROWSER_HEADLESS', 'true').lower() == 'true'
 
+# Browser Resource Blocking (images, media, fonts, analytics, css)
+BROWSER_BLOCK_RESOURCES = [r.strip() for r in os.getenv('BROWSER_BLOCK_RESOURCES', 'images,media,fonts,analytics').split(',') if r.strip()]
+
+# Browser Watchdog
+BROWSER_MAX_NAVIGATIONS = int(os.getenv('BROWSER_MAX_NAVIGATIONS', '300'))
+BROWSER_MAX_RSS_MB = int(os.getenv('BROWSER_MAX_RSS_MB', '1024'))
+BROWSER_WATCHDOG_INTERVAL_SEC = int(os.getenv('BROWSER_WATCHDOG_INTERVAL_SEC', '60'))
+
+# Browser Sessions
+SESSION_DIR = os.getenv('SESSION_DIR', 'sessions')
+BROWSER_PERSISTENT_PROFILE = os.getenv('BROWSER_PERSISTENT_PROFILE', 'true').lower() == 'true'
+SESSION_REFRESH_INTERVAL_MIN = int(os.getenv('SESSION_REFRESH_INTERVAL_MIN', '30'))
+SESSION_REFRESH_BEFORE_MIN = int(os.getenv('SESSION_REFRESH_BEFORE_MIN', '120'))
+
+# Selector Cache
+SELECTOR_STATS_PATH = os.getenv('SELECTOR_STATS_PATH', 'selector_stats.json')
+SELECTOR_MIN_HIT_RATE = float(os.getenv('SELECTOR_MIN_HIT_RATE', '0.8'))
+
+# Lookup Coalescing (single-flight result TTL, seconds)
+OFFERS_CACHE_TTL_SEC = float(os.getenv('OFFERS_CACHE_TTL_SEC', '30'))
+BALANCE_CACHE_TTL_SEC = float(os.getenv('BALANCE_CACHE_TTL_SEC', '5'))
+ORDER_DETAILS_TTL_SEC = float(os.getenv('ORDER_DETAILS_TTL_SEC', '60'))
+# Unknown order IDs: negative cache of FunPay misses and Bloom filter of IDs in the database
+MISSING_ORDER_TTL_SEC = float(os.getenv('MISSING_ORDER_TTL_SEC', '600'))
+MISSING_ORDER_MAX_ENTRIES = int(os.getenv('MISSING_ORDER_MAX_ENTRIES', '10000'))
+ORDER_BLOOM_CAPACITY = int(os.getenv('ORDER_BLOOM_CAPACITY', '100000'))
+ORDER_BLOOM_ERROR_RATE = float(os.getenv('ORDER_BLOOM_ERROR_RATE', '0.01'))
+
+# Rate Limits (per upstream account; daily usage persists in the database, 0 = unlimited)
+FRAGMENT_TRANSFERS_PER_SEC = float(os.getenv('FRAGMENT_TRANSFERS_PER_SEC', '0.5'))
+FRAGMENT_TRANSFER_BURST = float(os.getenv('FRAGMENT_TRANSFER_BURST', '1'))
+FRAGMENT_DAILY_STARS_LIMIT = int(os.getenv('FRAGMENT_DAILY_STARS_LIMIT', '100000'))
+FRAGMENT_PAGE_LOADS_PER_SEC = float(os.getenv('FRAGMENT_PAGE_LOADS_PER_SEC', '1'))
+FRAGMENT_PAGE_LOAD_BURST = float(os.getenv('FRAGMENT_PAGE_LOAD_BURST', '3'))
+FUNPAY_PAGE_LOADS_PER_SEC = float(os.getenv('FUNPAY_PAGE_LOADS_PER_SEC', '1'))
+FUNPAY_PAGE_LOAD_BURST = float(os.getenv('FUNPAY_PAGE_LOAD_BURST', '3'))
+FUNPAY_DAILY_PAGE_LOADS = int(os.getenv('FUNPAY_DAILY_PAGE_LOADS', '0'))
+
+# Telegram Outbound Queue
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '25'))
+TELEGRAM_PER_CHAT_INTERVAL_SEC = float(os.getenv('TELEGRAM_PER_CHAT_INTERVAL_SEC', '1'))
+TELEGRAM_SEND_RETRIES = int(os.getenv('TELEGRAM_SEND_RETRIES', '3'))
+
+# Admin Digest (summarize completions/partials/failures instead of one message per order)
+ADMIN_DIGEST_ENABLED = os.getenv('ADMIN_DIGEST_ENABLED', 'false').lower() == 'true'
+ADMIN_DIGEST_WINDOW_MIN = float(os.getenv('ADMIN_DIGEST_WINDOW_MIN', '15'))
+
+# Circuit Breakers (per upstream: funpay_read, funpay_chat, fragment_balance, fragment_transfer)
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', '5'))
+CIRCUIT_WINDOW = int(os.getenv('CIRCUIT_WINDOW', '20'))
+CIRCUIT_OPEN_SEC = float(os.getenv('CIRCUIT_OPEN_SEC', '60'))
+
+# Fragment Balance (background refresh and reservation ledger)
+BALANCE_REFRESH_INTERVAL_SEC = float(os.getenv('BALANCE_REFRESH_INTERVAL_SEC', '60'))
+BALANCE_MAX_AGE_SEC = float(os.getenv('BALANCE_MAX_AGE_SEC', '120'))
+
+# Notification Outbox (written with order status changes, drained in the background)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_POLL_INTERVAL_SEC = float(os.getenv('OUTBOX_POLL_INTERVAL_SEC', '1'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+OUTBOX_RETENTION_DAYS = int(os.getenv('OUTBOX_RETENTION_DAYS', '7'))
+
+# Logging (JSON file written by a background thread, rotated by size and age, gzip-compressed)
+LOG_DIR = os.getenv('LOG_DIR', 'logs')
+LOG_FILE = os.getenv('LOG_FILE', 'bot_operations.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL_HOURS = float(os.getenv('LOG_ROTATE_INTERVAL_HOURS', '24'))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '14'))
+LOG_RETENTION_DAYS = float(os.getenv('LOG_RETENTION_DAYS', '30'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Profiling (/admin profile, /admin loopstats)
+PROFILE_SAMPLE_INTERVAL_SEC = float(os.getenv('PROFILE_SAMPLE_INTERVAL_SEC', '0.005'))
+PROFILE_MAX_SEC = float(os.getenv('PROFILE_MAX_SEC', '60'))
+LOOP_MONITOR_INTERVAL_SEC = float(os.getenv('LOOP_MONITOR_INTERVAL_SEC', '0.5'))
+LOOP_SLOW_CALLBACK_SEC = float(os.getenv('LOOP_SLOW_CALLBACK_SEC', '0.1'))
+LOOP_DEBUG = os.getenv('LOOP_DEBUG', 'false').lower() == 'true'
+
+# Tracing (per-stage order pipeline spans, exported to JSONL and summarized by /admin perf)
+TRACE_ENABLED = os.getenv('TRACE_ENABLED', 'true').lower() == 'true'
+TRACE_FILE = os.getenv('TRACE_FILE', 'logs/traces.jsonl')
+TRACE_WINDOW = int(os.getenv('TRACE_WINDOW', '1000'))
+TRACE_FLUSH_BATCH = int(os.getenv('TRACE_FLUSH_BATCH', '100'))
+TRACE_FLUSH_INTERVAL_SEC = float(os.getenv('TRACE_FLUSH_INTERVAL_SEC', '5'))
+
 # Database Configuration
 DATABASE_PATH = os.getenv('DATABASE_PATH', 'bot_database.db')
 
@@ -43,6 +180,7 @@ class OrderStatus:
     NEEDS_BALANCE = "NEEDS_BALANCE"
     FAILED = "FAILED"
     PARTIALLY_FULFILLED = "PARTIALLY_FULFILLED"
+    PARKED = "PARKED"
 
 # Fulfillment Statuses
 class FulfillmentStatus:
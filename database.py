@@ -1,13 +1,34 @@
 import sqlite3
+import functools
 import json
+import time
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional
-from config import DATABASE_PATH, OrderStatus, FulfillmentStatus
+from config import DATABASE_PATH, OrderStatus, FulfillmentStatus, ORDER_BLOOM_CAPACITY, ORDER_BLOOM_ERROR_RATE
+from bloom_filter import BloomFilter
+from metrics import metrics
+
+order_filter_checks = metrics.counter('order_filter_checks_total', 'Order lookups by Bloom filter answer: absent/maybe')
+db_query_seconds = metrics.histogram('db_query_seconds', 'Database method latency by operation')
+order_status_changes = metrics.counter('order_status_changes_total', 'Order status updates by new status')
+orders_by_status = metrics.gauge('orders_by_status', 'Orders in the database by status (computed on scrape)')
+
+def _timed(method):
+    """Report a query method's latency to db_query_seconds under op=<method name>"""
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            db_query_seconds.observe(time.perf_counter() - start, op=method.__name__)
+    return wrapper
 
 class Database:
     def __init__(self):
         self.db_path = DATABASE_PATH
+        self.known_orders: Optional[BloomFilter] = None
         self.init_database()
     
     def init_database(self):
@@ -80,8 +101,67 @@ class Database:
                 )
             ''')
             
+            # Outbox: notifications written with the status change, delivered by OutboxDispatcher
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dedupe_key TEXT UNIQUE,
+                    audience TEXT,
+                    chat_id INTEGER,
+                    text TEXT,
+                    meta TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at TEXT,
+                    created_at TEXT,
+                    sent_at TEXT,
+                    result TEXT
+                )
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (sent_at, next_attempt_at)
+            ''')
+            
+            # Daily usage of rate-limited upstream accounts
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS rate_limit_usage (
+                    limiter TEXT,
+                    day TEXT,
+                    used INTEGER,
+                    PRIMARY KEY (limiter, day)
+                )
+            ''')
+            
+            # Conversation state of users in the username flow (cached by UserStateStore)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_states (
+                    user_id INTEGER PRIMARY KEY,
+                    state TEXT,
+                    expires_at REAL
+                )
+            ''')
+            
             conn.commit()
+        
+        self.rebuild_order_filter()
     
+    def rebuild_order_filter(self):
+        """Load every known order ID into the in-memory Bloom filter"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT order_id FROM orders')
+            order_ids = [row[0] for row in cursor.fetchall()]
+        
+        # Room to grow before the false positive rate degrades
+        capacity = max(ORDER_BLOOM_CAPACITY, 2 * len(order_ids))
+        self.known_orders = BloomFilter.from_items(order_ids, capacity, ORDER_BLOOM_ERROR_RATE)
+    
+    def might_have_order(self, order_id: str) -> bool:
+        """False means the order is definitely not in the database"""
+        present = order_id in self.known_orders
+        order_filter_checks.inc(result='maybe' if present else 'absent')
+        return present
+    
+    @_timed
     def create_fulfillment(self, record: Dict) -> str:
         """Create a new fulfillment record"""
         fulfillment_id = record.get('fulfillment_id', str(uuid.uuid4()))
@@ -107,6 +187,7 @@ class Database:
         
         return fulfillment_id
     
+    @_timed
     def update_fulfillment_status(self, fulfillment_id: str, status: str, meta: Dict = None):
         """Update fulfillment status and metadata"""
         with sqlite3.connect(self.db_path) as conn:
@@ -134,6 +215,7 @@ class Database:
             
             conn.commit()
     
+    @_timed
     def get_fulfillment(self, fulfillment_id: str) -> Optional[Dict]:
         """Get fulfillment by ID"""
         with sqlite3.connect(self.db_path) as conn:
@@ -160,6 +242,7 @@ class Database:
                 }
         return None
     
+    @_timed
     def get_fulfillment_by_order(self, order_id: str) -> Optional[Dict]:
         """Get fulfillment by order ID"""
         with sqlite3.connect(self.db_path) as conn:
@@ -188,6 +271,7 @@ class Database:
                 }
         return None
     
+    @_timed
     def save_order(self, order_data: Dict):
         """Save or update order data"""
         with sqlite3.connect(self.db_path) as conn:
@@ -213,9 +297,14 @@ class Database:
                 order_data.get('stars_amount_total', 0)
             ))
             conn.commit()
+        self.known_orders.add(order_data['order_id'])
     
+    @_timed
     def get_order(self, order_id: str) -> Optional[Dict]:
         """Get order by ID"""
+        if not self.might_have_order(order_id):
+            return None
+        
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -244,8 +333,9 @@ class Database:
                 }
         return None
     
-    def update_order_status(self, order_id: str, status: str):
-        """Update order status"""
+    @_timed
+    def update_order_status(self, order_id: str, status: str, notifications: List[Dict] = None):
+        """Update order status (and enqueue its notifications in the same transaction)"""
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.cursor()
             cursor.execute('''
@@ -253,8 +343,107 @@ class Database:
                 SET status = ?, updated_at = ?
                 WHERE order_id = ?
             ''', (status, datetime.now().isoformat(), order_id))
+            if notifications:
+                self._insert_outbox(cursor, notifications)
+            conn.commit()
+        order_status_changes.inc(status=status)
+    
+    @_timed
+    def update_order_username(self, order_id: str, username: str):
+        """Attach the Telegram username confirmed by the buyer"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE orders 
+                SET attached_telegram_username = ?, updated_at = ?
+                WHERE order_id = ?
+            ''', (username, datetime.now().isoformat(), order_id))
+            conn.commit()
+    
+    @_timed
+    def enqueue_notifications(self, notifications: List[Dict]):
+        """Add notifications to the outbox"""
+        with sqlite3.connect(self.db_path) as conn:
+            self._insert_outbox(conn.cursor(), notifications)
+            conn.commit()
+    
+    def _insert_outbox(self, cursor, notifications: List[Dict]):
+        now = datetime.now().isoformat()
+        for notification in notifications:
+            # Same dedupe key twice (e.g. a replayed transition) is stored once
+            cursor.execute('''
+                INSERT OR IGNORE INTO outbox
+                (dedupe_key, audience, chat_id, text, meta, next_attempt_at, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (
+                notification['dedupe_key'],
+                notification['audience'],
+                notification.get('chat_id'),
+                notification['text'],
+                json.dumps(notification.get('meta', {})),
+                now,
+                now
+            ))
+    
+    @_timed
+    def get_pending_outbox(self, limit: int = 50, exclude: List[int] = None) -> List[Dict]:
+        """Get undelivered notifications that are due"""
+        exclude = list(exclude or [])
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            placeholders = ', '.join('?' * len(exclude))
+            exclude_clause = f"AND id NOT IN ({placeholders})" if exclude else ""
+            cursor.execute(f'''
+                SELECT id, dedupe_key, audience, chat_id, text, meta, attempts
+                FROM outbox
+                WHERE sent_at IS NULL AND next_attempt_at <= ? {exclude_clause}
+                ORDER BY id
+                LIMIT ?
+            ''', [datetime.now().isoformat()] + exclude + [limit])
+            
+            rows = cursor.fetchall()
+            return [{
+                'id': row[0],
+                'dedupe_key': row[1],
+                'audience': row[2],
+                'chat_id': row[3],
+                'text': row[4],
+                'meta': json.loads(row[5]) if row[5] else {},
+                'attempts': row[6]
+            } for row in rows]
+    
+    @_timed
+    def mark_outbox_sent(self, results: List[tuple]):
+        """Mark notifications delivered: [(id, result), ...]"""
+        now = datetime.now().isoformat()
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE outbox SET sent_at = ?, result = ?, attempts = attempts + 1 WHERE id = ?
+            ''', [(now, result, outbox_id) for outbox_id, result in results])
+            conn.commit()
+    
+    @_timed
+    def reschedule_outbox(self, retries: List[tuple]):
+        """Schedule another delivery attempt: [(id, delay_seconds), ...]"""
+        now = datetime.now()
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.executemany('''
+                UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?
+            ''', [((now + timedelta(seconds=delay)).isoformat(), outbox_id) for outbox_id, delay in retries])
             conn.commit()
     
+    @_timed
+    def prune_outbox(self, days: int):
+        """Delete delivered notifications older than N days"""
+        cutoff = (datetime.now() - timedelta(days=days)).isoformat()
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM outbox WHERE sent_at IS NOT NULL AND sent_at < ?', (cutoff,))
+            conn.commit()
+    
+    @_timed
     def get_recent_orders(self, limit: int = 10) -> List[Dict]:
         """Get recent orders for admin panel"""
         with sqlite3.connect(self.db_path) as conn:
@@ -280,6 +469,7 @@ class Database:
                 'stars_amount_total': row[8]
             } for row in rows]
     
+    @_timed
     def save_offers(self, offers: List[Dict]):
         """Save or update offers"""
         with sqlite3.connect(self.db_path) as conn:
@@ -300,6 +490,7 @@ class Database:
                 ))
             conn.commit()
     
+    @_timed
     def get_active_offers(self) -> List[Dict]:
         """Get active offers"""
         with sqlite3.connect(self.db_path) as conn:
@@ -321,9 +512,107 @@ class Database:
                 'is_active': bool(row[5])
             } for row in rows]
     
+    @_timed
+    def get_rate_usage(self, limiter: str, day: str) -> int:
+        """Get daily usage of a rate limiter"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT used FROM rate_limit_usage WHERE limiter = ? AND day = ?
+            ''', (limiter, day))
+            row = cursor.fetchone()
+            return row[0] if row else 0
+    
+    @_timed
+    def add_rate_usage(self, limiter: str, day: str, amount: int):
+        """Add to daily usage of a rate limiter"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO rate_limit_usage (limiter, day, used) VALUES (?, ?, ?)
+                ON CONFLICT (limiter, day) DO UPDATE SET used = used + excluded.used
+            ''', (limiter, day, amount))
+            conn.commit()
+    
+    @_timed
+    def get_user_state(self, user_id: int) -> Optional[tuple]:
+        """Get (state, expires_at) of a user"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT state, expires_at FROM user_states WHERE user_id = ?', (user_id,))
+            row = cursor.fetchone()
+            if row:
+                return json.loads(row[0]), row[1]
+        return None
+    
+    @_timed
+    def save_user_state(self, user_id: int, state: Dict, expires_at: float):
+        """Save conversation state of a user"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT OR REPLACE INTO user_states (user_id, state, expires_at)
+                VALUES (?, ?, ?)
+            ''', (user_id, json.dumps(state), expires_at))
+            conn.commit()
+    
+    @_timed
+    def delete_user_state(self, user_id: int):
+        """Delete conversation state of a user"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM user_states WHERE user_id = ?', (user_id,))
+            conn.commit()
+    
+    @_timed
+    def prune_user_states(self, now: float) -> int:
+        """Delete expired conversation states"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM user_states WHERE expires_at <= ?', (now,))
+            conn.commit()
+            return cursor.rowcount
+    
+    @_timed
+    def get_orders_with_chat(self, status: str) -> List[tuple]:
+        """Orders in a status with the chat last notified about each: [(order_id, chat_id or None)]"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            # Outbox dedupe keys start with "<order_id>:", so the chat comes from the latest user notification
+            cursor.execute('''
+                SELECT o.order_id, (
+                    SELECT chat_id FROM outbox
+                    WHERE substr(dedupe_key, 1, length(o.order_id) + 1) = o.order_id || ':'
+                          AND chat_id IS NOT NULL
+                    ORDER BY id DESC LIMIT 1
+                )
+                FROM orders o
+                WHERE o.status = ?
+                ORDER BY o.updated_at
+            ''', (status,))
+            return cursor.fetchall()
+    
+    @_timed
+    def count_orders_by_status(self) -> Dict[str, int]:
+        """Number of orders per status"""
+        with sqlite3.connect(self.db_path) as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT status, COUNT(*) FROM orders GROUP BY status')
+            return dict(cursor.fetchall())
+    
+    def collect_metrics(self):
+        """Refresh orders_by_status before metrics are rendered"""
+        # Statuses without rows (e.g. the last PARKED order resumed) must drop to 0, not keep their old value
+        counts = {status: 0 for name, status in vars(OrderStatus).items() if not name.startswith('_')}
+        counts.update((labels['status'], 0) for labels, _ in orders_by_status.samples())
+        counts.update(self.count_orders_by_status())
+        for status, count in counts.items():
+            orders_by_status.set(count, status=status)
+    
     def get_connection(self):
         """Get database connection"""
         return sqlite3.connect(self.db_path)
 
 # Global database instance
 db = Database()
+metrics.register_collector(db.collect_metrics)
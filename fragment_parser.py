@@ -15,12 +15,26 @@ from selenium.common.exceptions import TimeoutException, NoSuchElementException
 import undetected_chromedriver as uc
 import re
 
-class FragmentParser:
+from config import BROWSER_PERSISTENT_PROFILE
+from browser import SupervisedBrowser, exclusive, apply_resource_blocking
+from selector_cache import SelectorResolver
+from session_store import SessionStore
+from rate_limiter import page_load_limiter
+from tracing import traced
+
+class FragmentParser(SupervisedBrowser):
+    browser_name = 'fragment'
+    
     def __init__(self, phone_number: str, headless: bool = True):
         self.phone_number = phone_number
         self.headless = headless
         self.driver = None
         self.is_logged_in = False
+        self.implicit_wait = 10
+        self.resolver = SelectorResolver(implicit_wait=self.implicit_wait)
+        self.session_store = SessionStore()
+        self._session_restore_attempted = False
+        self.rate_limiter = page_load_limiter('fragment', phone_number)
         
         # Селекторы для элементов страницы Fragment
         self.selectors = {
@@ -58,8 +72,14 @@ class FragmentParser:
             }
             options.add_experimental_option("prefs", prefs)
             
-            self.driver = uc.Chrome(options=options)
-            self.driver.implicitly_wait(10)
+            # Отдельный профиль Chrome на аккаунт, чтобы не вводить SMS-код после перезапуска
+            user_data_dir = None
+            if BROWSER_PERSISTENT_PROFILE:
+                user_data_dir = self.session_store.profile_dir('fragment', self.phone_number)
+            
+            self.driver = uc.Chrome(options=options, user_data_dir=user_data_dir)
+            apply_resource_blocking(self.driver)
+            self.driver.implicitly_wait(self.implicit_wait)
             
             print("✅ Браузер для Fragment инициализирован")
             return True
@@ -68,9 +88,14 @@ class FragmentParser:
             print(f"❌ Ошибка инициализации браузера Fragment: {e}")
             return False
     
+    @exclusive
     async def login(self) -> bool:
         """Авторизация в Fragment через номер телефона"""
         try:
+            # Сохранённая сессия позволяет обойтись без ручного ввода кода
+            if not self._session_restore_attempted and await self.restore_session():
+                return True
+            
             if not self.driver:
                 if not self.setup_driver():
                     return False
@@ -78,7 +103,7 @@ class FragmentParser:
             print("🔐 Авторизация в Fragment...")
             
             # Переход на Fragment
-            self.driver.get("https://fragment.com/")
+            await self._navigate("https://fragment.com/")
             await asyncio.sleep(3)
             
             # Поиск кнопки входа
@@ -89,14 +114,18 @@ class FragmentParser:
             await asyncio.sleep(2)
             
             # Ввод номера телефона
-            phone_input = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, self.selectors['phone_input']))
-            )
+            phone_input = await self._find('login', 'phone_input', timeout=10)
+            if not phone_input:
+                print("❌ Поле ввода телефона не найдено")
+                return False
             phone_input.clear()
             phone_input.send_keys(self.phone_number)
             
             # Нажатие кнопки продолжить
-            continue_button = self.driver.find_element(By.CSS_SELECTOR, self.selectors['continue_button'])
+            continue_button = await self._find('login', 'continue_button')
+            if not continue_button:
+                print("❌ Кнопка продолжения не найдена")
+                return False
             continue_button.click()
             
             print("📱 Код отправлен на телефон. Ожидание ввода кода...")
@@ -110,6 +139,7 @@ class FragmentParser:
             # Проверка успешного входа
             if "fragment.com" in self.driver.current_url and "login" not in self.driver.current_url:
                 self.is_logged_in = True
+                self.save_session()
                 print("✅ Авторизация в Fragment успешна")
                 return True
             else:
@@ -120,6 +150,74 @@ class FragmentParser:
             print(f"❌ Ошибка авторизации в Fragment: {e}")
             return False
     
+    @exclusive
+    async def restore_session(self) -> bool:
+        """Восстановление сохранённой сессии без SMS-кода"""
+        self._session_restore_attempted = True
+        if self.is_logged_in:
+            return True
+        
+        cookies = self.session_store.load_cookies('fragment', self.phone_number)
+        if not cookies and not BROWSER_PERSISTENT_PROFILE:
+            return False
+        
+        if not self.driver:
+            if not self.setup_driver():
+                return False
+        
+        if cookies:
+            await self._navigate("https://fragment.com/")
+            for cookie in cookies:
+                try:
+                    self.driver.add_cookie(cookie)
+                except Exception:
+                    pass
+        
+        if await self._check_session():
+            self.is_logged_in = True
+            self.save_session()
+            print("✅ Сессия Fragment восстановлена")
+            return True
+        
+        print("⚠️ Сохранённая сессия Fragment недействительна")
+        return False
+    
+    @exclusive
+    async def refresh_session(self):
+        """Продление сессии до истечения: заход на сайт обновляет cookie"""
+        if not self.driver or not self.is_logged_in:
+            return
+        if not self.session_store.needs_refresh('fragment', self.phone_number):
+            return
+        
+        if await self._check_session():
+            self.save_session()
+            print("✅ Сессия Fragment продлена")
+        else:
+            # Повторный вход требует SMS-кода, поэтому только сообщаем об истечении
+            self.is_logged_in = False
+            print("⚠️ Сессия Fragment истекла, требуется повторная авторизация")
+    
+    async def _check_session(self) -> bool:
+        """Дешёвая проверка авторизации: на главной нет кнопки входа"""
+        await self._navigate("https://fragment.com/")
+        await asyncio.sleep(2)
+        login_button = await self.resolver.find(
+            self.driver, 'login', 'login_button',
+            [(By.XPATH, "//button[contains(text(), 'Log in')]")],
+            required=False
+        )
+        return login_button is None
+    
+    def save_session(self):
+        """Сохранение cookie текущей сессии на диск"""
+        try:
+            self.session_store.save_cookies('fragment', self.phone_number, self.driver.get_cookies())
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить сессию Fragment: {e}")
+    
+    @traced('fragment.balance_page')
+    @exclusive
     async def get_balance(self) -> Dict:
         """Получение баланса Stars"""
         if not self.is_logged_in:
@@ -130,21 +228,19 @@ class FragmentParser:
             print("💰 Получение баланса Stars...")
             
             # Переход на страницу баланса
-            self.driver.get("https://fragment.com/balance")
+            await self._navigate("https://fragment.com/balance")
             await asyncio.sleep(3)
             
-            # Поиск баланса Stars
+            # Поиск баланса Stars (основные селекторы, затем текстовый поиск)
             balance_text = "0"
-            try:
-                balance_element = self.driver.find_element(By.CSS_SELECTOR, self.selectors['stars_balance'])
+            balance_element = await self._find(
+                'balance', 'stars_balance',
+                extra=[(By.XPATH, "//*[contains(text(), 'Stars') or contains(text(), '⭐')]")],
+                predicate=lambda element: re.search(r'\d+', element.text),
+                timeout=5
+            )
+            if balance_element:
                 balance_text = balance_element.text
-            except:
-                # Альтернативные селекторы
-                balance_elements = self.driver.find_elements(By.XPATH, "//*[contains(text(), 'Stars') or contains(text(), '⭐')]")
-                for element in balance_elements:
-                    if re.search(r'\d+', element.text):
-                        balance_text = element.text
-                        break
             
             # Парсинг числа из текста баланса
             balance_match = re.search(r'([\d,]+)', balance_text.replace(',', ''))
@@ -161,6 +257,8 @@ class FragmentParser:
             print(f"❌ Ошибка получения баланса: {e}")
             return {'stars_balance': 0, 'daily_limit_left': 0}
     
+    @traced('fragment.transfer')
+    @exclusive
     async def transfer_stars(self, to_username: str, stars_amount: int, idempotency_key: str) -> Dict:
         """Отправка Stars пользователю"""
         if not self.is_logged_in:
@@ -175,22 +273,19 @@ class FragmentParser:
             print(f"⭐ Отправка {stars_amount} Stars пользователю {to_username}...")
             
             # Переход на страницу отправки Stars
-            self.driver.get("https://fragment.com/stars")
+            await self._navigate("https://fragment.com/stars")
             await asyncio.sleep(3)
             
             # Поиск кнопки "Send Stars" или аналогичной
-            send_button = None
-            try:
-                send_button = WebDriverWait(self.driver, 10).until(
-                    EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Send') or contains(text(), 'Transfer')]"))
-                )
-            except:
-                # Альтернативные варианты поиска кнопки
-                send_buttons = self.driver.find_elements(By.TAG_NAME, "button")
-                for btn in send_buttons:
-                    if any(word in btn.text.lower() for word in ['send', 'transfer', 'отправить']):
-                        send_button = btn
-                        break
+            send_button = await self._find(
+                'stars', 'send_stars_button',
+                extra=[
+                    (By.XPATH, "//button[contains(text(), 'Send') or contains(text(), 'Transfer')]"),
+                    (By.TAG_NAME, "button")
+                ],
+                predicate=self._is_send_button,
+                timeout=10
+            )
             
             if not send_button:
                 return {
@@ -203,43 +298,50 @@ class FragmentParser:
             await asyncio.sleep(2)
             
             # Ввод получателя
-            recipient_input = WebDriverWait(self.driver, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, self.selectors['recipient_input']))
-            )
+            recipient_input = await self._find('stars', 'recipient_input', timeout=10)
+            if not recipient_input:
+                return {
+                    'ok': False,
+                    'error_code': 'form_not_found',
+                    'error_message': 'Форма отправки не найдена'
+                }
             recipient_input.clear()
             recipient_input.send_keys(to_username.replace('@', ''))  # Убираем @ если есть
             
             # Ввод количества Stars
-            amount_input = self.driver.find_element(By.CSS_SELECTOR, self.selectors['amount_input'])
+            amount_input = await self._find('stars', 'amount_input', timeout=2)
+            final_send_button = await self._find('stars', 'send_button', timeout=2)
+            if not amount_input or not final_send_button:
+                return {
+                    'ok': False,
+                    'error_code': 'form_not_found',
+                    'error_message': 'Форма отправки не найдена'
+                }
             amount_input.clear()
             amount_input.send_keys(str(stars_amount))
             
             # Отправка
-            final_send_button = self.driver.find_element(By.CSS_SELECTOR, self.selectors['send_button'])
             final_send_button.click()
             
             await asyncio.sleep(5)
             
             # Проверка результата
-            try:
-                success_element = self.driver.find_element(By.CSS_SELECTOR, self.selectors['success_message'])
-                if success_element:
-                    transfer_id = f"fragment_{idempotency_key}_{int(time.time())}"
-                    print(f"✅ Stars отправлены успешно. ID: {transfer_id}")
-                    
-                    return {
-                        'ok': True,
-                        'transfer_id': transfer_id,
-                        'error_code': None,
-                        'error_message': None
-                    }
-            except:
-                pass
+            success_element = await self._find('stars', 'success_message', required=False)
+            if success_element:
+                transfer_id = f"fragment_{idempotency_key}_{int(time.time())}"
+                print(f"✅ Stars отправлены успешно. ID: {transfer_id}")
+                
+                return {
+                    'ok': True,
+                    'transfer_id': transfer_id,
+                    'error_code': None,
+                    'error_message': None
+                }
             
             # Проверка на ошибку
-            try:
-                error_element = self.driver.find_element(By.CSS_SELECTOR, self.selectors['error_message'])
-                error_message = error_element.text if error_element else "Неизвестная ошибка"
+            error_element = await self._find('stars', 'error_message', required=False)
+            if error_element:
+                error_message = error_element.text or "Неизвестная ошибка"
                 
                 print(f"❌ Ошибка отправки Stars: {error_message}")
                 
@@ -248,8 +350,6 @@ class FragmentParser:
                     'error_code': 'transfer_failed',
                     'error_message': error_message
                 }
-            except:
-                pass
             
             # Если нет явного сообщения об успехе или ошибке
             print("⚠️ Статус отправки неопределён")
@@ -267,8 +367,23 @@ class FragmentParser:
                 'error_message': str(e)
             }
     
+    async def _find(self, page_type: str, key: str, extra: list = None, **kwargs):
+        """Поиск элемента через кэш селекторов (альтернативы из self.selectors + extra)"""
+        candidates = self.resolver.split_css(self.selectors[key]) + (extra or [])
+        return await self.resolver.find(self.driver, page_type, key, candidates, **kwargs)
+    
+    @staticmethod
+    def _is_send_button(element) -> bool:
+        """Кнопка отправки: активна и подписана как отправка"""
+        try:
+            text = element.text.lower()
+            return element.is_enabled() and any(word in text for word in ['send', 'transfer', 'отправить'])
+        except Exception:
+            return False
+    
     def close(self):
         """Закрытие браузера"""
+        self.resolver.save()
         if self.driver:
             try:
                 self.driver.quit()
@@ -290,6 +405,12 @@ class MockFragmentParser:
         print("✅ Mock: Авторизация в Fragment успешна")
         return True
     
+    async def restore_session(self) -> bool:
+        return self.is_logged_in
+    
+    async def refresh_session(self):
+        pass
+    
     async def get_balance(self) -> Dict:
         print("💰 Mock: Получение баланса Stars...")
         await asyncio.sleep(1)
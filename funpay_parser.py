@@ -18,14 +18,47 @@ from bs4 import BeautifulSoup
 import requests
 import re
 
-class FunPayParser:
+from config import BROWSER_PERSISTENT_PROFILE
+from browser import SupervisedBrowser, exclusive, apply_resource_blocking
+from session_store import SessionStore
+from rate_limiter import page_load_limiter
+from tracing import traced
+
+class OrderPageError(Exception):
+    """Страница заказа загрузилась, но не разобрана (вход, истёкшая сессия, новая вёрстка)"""
+
+
+def payment_status_from_details(order_id: str, order_details: Optional[Dict]) -> Dict:
+    """Статус оплаты по уже загруженной странице заказа"""
+    if order_details:
+        paid = order_details.get('payment_status', False)
+        return {
+            'paid': paid,
+            'paid_at': datetime.now().isoformat() if paid else None,
+            'method': 'funpay',
+            'tx_id': f"funpay_{order_id}"
+        }
+    
+    return {
+        'paid': False,
+        'paid_at': None,
+        'method': 'funpay',
+        'tx_id': None
+    }
+
+class FunPayParser(SupervisedBrowser):
+    browser_name = 'funpay'
+    
     def __init__(self, login: str, password: str, headless: bool = True):
-        self.login = login
+        self.login_cred = login
         self.password = password
         self.headless = headless
         self.driver = None
         self.session = requests.Session()
         self.is_logged_in = False
+        self.session_store = SessionStore()
+        self._session_restore_attempted = False
+        self.rate_limiter = page_load_limiter('funpay', login)
         
         # Селекторы для элементов страницы
         self.selectors = {
@@ -42,7 +75,8 @@ class FunPayParser:
             'order_description': '.order-description',
             'chat_messages': '.chat-message',
             'message_input': 'textarea[name="message"]',
-            'send_button': 'button[type="submit"]'
+            'send_button': 'button[type="submit"]',
+            'not_found': '.page-404, .error-404'
         }
     
     def setup_driver(self):
@@ -68,7 +102,13 @@ class FunPayParser:
             }
             options.add_experimental_option("prefs", prefs)
             
-            self.driver = uc.Chrome(options=options)
+            # Отдельный профиль Chrome на аккаунт, чтобы cookie переживали перезапуск
+            user_data_dir = None
+            if BROWSER_PERSISTENT_PROFILE:
+                user_data_dir = self.session_store.profile_dir('funpay', self.login_cred)
+            
+            self.driver = uc.Chrome(options=options, user_data_dir=user_data_dir)
+            apply_resource_blocking(self.driver)
             self.driver.implicitly_wait(10)
             
             print("✅ Браузер инициализирован")
@@ -78,9 +118,14 @@ class FunPayParser:
             print(f"❌ Ошибка инициализации браузера: {e}")
             return False
     
+    @exclusive
     async def login(self) -> bool:
         """Авторизация на FunPay"""
         try:
+            # Сначала пробуем сохранённую сессию, чтобы не отправлять пароль заново
+            if not self._session_restore_attempted and await self.restore_session():
+                return True
+            
             if not self.driver:
                 if not self.setup_driver():
                     return False
@@ -88,7 +133,7 @@ class FunPayParser:
             print("🔐 Авторизация на FunPay...")
             
             # Переход на страницу входа
-            self.driver.get("https://funpay.com/account/login/")
+            await self._navigate("https://funpay.com/account/login/")
             await asyncio.sleep(3)
             
             # Ввод логина
@@ -96,7 +141,7 @@ class FunPayParser:
                 EC.presence_of_element_located((By.CSS_SELECTOR, self.selectors['login_input']))
             )
             login_input.clear()
-            login_input.send_keys(self.login)
+            login_input.send_keys(self.login_cred)
             
             # Ввод пароля
             password_input = self.driver.find_element(By.CSS_SELECTOR, self.selectors['password_input'])
@@ -112,6 +157,7 @@ class FunPayParser:
             # Проверка успешного входа
             if "account/login" not in self.driver.current_url:
                 self.is_logged_in = True
+                self.save_session()
                 print("✅ Авторизация успешна")
                 return True
             else:
@@ -122,6 +168,69 @@ class FunPayParser:
             print(f"❌ Ошибка авторизации: {e}")
             return False
     
+    @exclusive
+    async def restore_session(self) -> bool:
+        """Восстановление сохранённой сессии без ввода пароля"""
+        self._session_restore_attempted = True
+        if self.is_logged_in:
+            return True
+        
+        cookies = self.session_store.load_cookies('funpay', self.login_cred)
+        if not cookies and not BROWSER_PERSISTENT_PROFILE:
+            return False
+        
+        if not self.driver:
+            if not self.setup_driver():
+                return False
+        
+        if cookies:
+            await self._navigate("https://funpay.com/")
+            for cookie in cookies:
+                try:
+                    self.driver.add_cookie(cookie)
+                except Exception:
+                    pass
+        
+        if await self._check_session():
+            self.is_logged_in = True
+            self.save_session()
+            print("✅ Сессия FunPay восстановлена")
+            return True
+        
+        print("⚠️ Сохранённая сессия FunPay недействительна")
+        return False
+    
+    @exclusive
+    async def refresh_session(self):
+        """Продление сессии до истечения: заход на сайт обновляет cookie"""
+        if not self.driver or not self.is_logged_in:
+            return
+        if not self.session_store.needs_refresh('funpay', self.login_cred):
+            return
+        
+        if await self._check_session():
+            self.save_session()
+            print("✅ Сессия FunPay продлена")
+        else:
+            print("⚠️ Сессия FunPay истекла, повторная авторизация...")
+            self.is_logged_in = False
+            await self.login()
+    
+    async def _check_session(self) -> bool:
+        """Дешёвая проверка авторизации: страница заказов не редиректит на вход"""
+        await self._navigate("https://funpay.com/orders/")
+        await asyncio.sleep(1)
+        return "account/login" not in self.driver.current_url
+    
+    def save_session(self):
+        """Сохранение cookie текущей сессии на диск"""
+        try:
+            self.session_store.save_cookies('funpay', self.login_cred, self.driver.get_cookies())
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить сессию FunPay: {e}")
+    
+    @traced('funpay.orders_page')
+    @exclusive
     async def get_orders(self) -> List[Dict]:
         """Получение списка заказов"""
         if not self.is_logged_in:
@@ -132,7 +241,7 @@ class FunPayParser:
             print("📋 Получение заказов...")
             
             # Переход к заказам
-            self.driver.get("https://funpay.com/orders/")
+            await self._navigate("https://funpay.com/orders/")
             await asyncio.sleep(3)
             
             orders = []
@@ -226,30 +335,43 @@ class FunPayParser:
         # Значение по умолчанию
         return 100
     
+    @traced('funpay.order_page')
+    @exclusive
     async def get_order_details(self, order_id: str) -> Optional[Dict]:
-        """Получение деталей конкретного заказа"""
+        """Получение деталей конкретного заказа: None - FunPay ответил «заказа нет»,
+        исключение - страница не загрузилась или не разобрана"""
+        print(f"📋 Получение деталей заказа {order_id}...")
+        
+        # Ошибка перехода пробрасывается: для breaker это сбой FunPay, а не отсутствующий заказ
+        order_url = f"https://funpay.com/orders/{order_id}/"
         try:
-            print(f"📋 Получение деталей заказа {order_id}...")
-            
-            # Переход к заказу
-            order_url = f"https://funpay.com/orders/{order_id}/"
-            self.driver.get(order_url)
-            await asyncio.sleep(3)
-            
-            # Парсинг деталей заказа
-            order_details = self._parse_order_page()
-            
-            if order_details:
-                order_details['order_id'] = order_id
-                print("✅ Детали заказа получены")
-                return order_details
-            else:
-                print("❌ Не удалось получить детали заказа")
-                return None
-                
+            await self._navigate(order_url)
         except Exception as e:
-            print(f"❌ Ошибка получения деталей заказа: {e}")
+            print(f"❌ Ошибка загрузки страницы заказа: {e}")
+            raise
+        await asyncio.sleep(3)
+        
+        # Парсинг деталей заказа
+        order_details = self._parse_order_page()
+        
+        if order_details:
+            order_details['order_id'] = order_id
+            print("✅ Детали заказа получены")
+            return order_details
+        
+        # Только подтверждённое отсутствие попадает в негативный кэш; сбой разбора - ошибка
+        if self._is_missing_order_page():
+            print("❌ Заказ не найден на FunPay")
             return None
+        raise OrderPageError(f"Не удалось разобрать страницу заказа {order_id} ({self.driver.current_url})")
+    
+    def _is_missing_order_page(self) -> bool:
+        """Страница FunPay «заказ не найден», а не редирект на вход или изменившаяся вёрстка"""
+        if "account/login" in self.driver.current_url:
+            return False
+        if self.driver.find_elements(By.CSS_SELECTOR, self.selectors['not_found']):
+            return True
+        return '404' in (self.driver.title or '')
     
     def _parse_order_page(self) -> Optional[Dict]:
         """Парсинг страницы заказа"""
@@ -283,26 +405,14 @@ class FunPayParser:
             print(f"Ошибка парсинга страницы заказа: {e}")
             return None
     
+    @traced('funpay.verify_payment')
+    @exclusive
     async def verify_payment(self, order_id: str) -> Dict:
         """Проверка оплаты заказа"""
         try:
             order_details = await self.get_order_details(order_id)
+            return payment_status_from_details(order_id, order_details)
             
-            if order_details:
-                return {
-                    'paid': order_details.get('payment_status', False),
-                    'paid_at': datetime.now().isoformat() if order_details.get('payment_status') else None,
-                    'method': 'funpay',
-                    'tx_id': f"funpay_{order_id}"
-                }
-            else:
-                return {
-                    'paid': False,
-                    'paid_at': None,
-                    'method': 'funpay',
-                    'tx_id': None
-                }
-                
         except Exception as e:
             print(f"❌ Ошибка проверки оплаты: {e}")
             return {
@@ -312,6 +422,8 @@ class FunPayParser:
                 'tx_id': None
             }
     
+    @traced('funpay.send_message')
+    @exclusive
     async def send_message(self, order_id: str, message: str) -> bool:
         """Отправка сообщения в чат заказа"""
         try:
@@ -319,7 +431,7 @@ class FunPayParser:
             
             # Переход к заказу
             order_url = f"https://funpay.com/orders/{order_id}/"
-            self.driver.get(order_url)
+            await self._navigate(order_url)
             await asyncio.sleep(3)
             
             # Поиск поля ввода сообщения
@@ -368,6 +480,12 @@ class MockFunPayParser:
         print("✅ Mock: Авторизация успешна")
         return True
     
+    async def restore_session(self) -> bool:
+        return self.is_logged_in
+    
+    async def refresh_session(self):
+        pass
+    
     async def get_orders(self) -> List[Dict]:
         print("📋 Mock: Получение заказов...")
         await asyncio.sleep(1)
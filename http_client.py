@@ -0,0 +1,113 @@
+"""
+Общий HTTP-клиент: одна aiohttp-сессия на event loop с пулом keep-alive соединений
+"""
+
+import asyncio
+import time
+from typing import Any, Dict
+from urllib.parse import urlsplit
+
+import aiohttp
+
+from config import (
+    MAX_RETRY, HTTP_POOL_LIMIT, HTTP_POOL_LIMIT_PER_HOST, HTTP_DNS_CACHE_TTL_SEC,
+    HTTP_KEEPALIVE_SEC, HTTP_TIMEOUT_SEC
+)
+from metrics import metrics
+from retry_policy import RetryPolicy
+
+http_requests = metrics.counter('http_requests_total', 'Исходящие HTTP-запросы по хосту и статусу')
+http_request_seconds = metrics.histogram('http_request_seconds', 'Длительность исходящих HTTP-запросов')
+
+
+class HttpError(Exception):
+    """Неуспешный HTTP-ответ"""
+
+    def __init__(self, status: int, message: str = ''):
+        super().__init__(f"HTTP {status}: {message}" if message else f"HTTP {status}")
+        self.status = status
+
+
+class HttpClient:
+    def __init__(self, limit: int = HTTP_POOL_LIMIT, limit_per_host: int = HTTP_POOL_LIMIT_PER_HOST,
+                 dns_cache_ttl: int = HTTP_DNS_CACHE_TTL_SEC, keepalive_timeout: float = HTTP_KEEPALIVE_SEC,
+                 timeout: float = HTTP_TIMEOUT_SEC):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_cache_ttl = dns_cache_ttl
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        # aiohttp-сессия привязана к своему loop, поэтому храним по одной на loop
+        self._sessions: Dict[asyncio.AbstractEventLoop, aiohttp.ClientSession] = {}
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_cache_ttl,
+            keepalive_timeout=self.keepalive_timeout
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={'Accept-Encoding': 'gzip, deflate'},
+            auto_decompress=True
+        )
+
+    def session(self) -> aiohttp.ClientSession:
+        """Сессия текущего event loop (создаётся при первом обращении)"""
+        loop = asyncio.get_running_loop()
+
+        # Сессии завершившихся loop уже не закрыть, просто забываем их
+        for stale_loop in [l for l in self._sessions if l.is_closed()]:
+            del self._sessions[stale_loop]
+
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            session = self._sessions[loop] = self._create_session()
+        return session
+
+    async def start(self):
+        """Создание пула соединений при запуске бота"""
+        self.session()
+
+    async def close(self):
+        """Закрытие сессии текущего loop при остановке бота"""
+        loop = asyncio.get_running_loop()
+        session = self._sessions.pop(loop, None)
+        if session and not session.closed:
+            await session.close()
+
+    async def request_json(self, method: str, url: str, headers: Dict = None, json: Any = None,
+                           retries: int = MAX_RETRY) -> Any:
+        """HTTP-запрос с JSON-ответом; 429, 5xx и сетевые ошибки повторяются по http_retry"""
+        return await http_retry.run(lambda: self._request_json(method, url, headers, json),
+                                    max_attempts=retries)
+
+    async def _request_json(self, method: str, url: str, headers: Dict = None, json: Any = None) -> Any:
+        host = urlsplit(url).hostname or ''
+        start = time.monotonic()
+        try:
+            async with self.session().request(method.upper(), url, headers=headers, json=json) as response:
+                http_requests.inc(host=host, status=response.status)
+                http_request_seconds.observe(time.monotonic() - start, host=host)
+
+                if response.status != 200:
+                    raise HttpError(response.status, response.reason or '')
+                return await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            http_requests.inc(host=host, status='error')
+            raise
+
+
+def is_retryable_http_error(error: Exception) -> bool:
+    """Повторяются 429, 5xx и сетевые ошибки; остальные 4xx - нет"""
+    if isinstance(error, HttpError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+http_retry = RetryPolicy('http', max_attempts=MAX_RETRY, base_delay=0.5, retry_if=is_retryable_http_error)
+
+# Глобальный экземпляр
+http_client = HttpClient()
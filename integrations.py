@@ -1,27 +1,102 @@
-import aiohttp
 import asyncio
 import hashlib
 import uuid
 import os
+import copy
+import time
 from datetime import datetime
-from typing import Dict, List, Optional
-from config import MAX_RETRY, FRAGMENT_MAX, FRAGMENT_MIN
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from config import (
+    MAX_RETRY, FRAGMENT_MAX, FRAGMENT_MIN, ADMIN_DIGEST_ENABLED, ADMIN_DIGEST_WINDOW_MIN,
+    FUNPAY_API_URL, FUNPAY_API_KEY, FRAGMENT_API_URL, FRAGMENT_API_KEY,
+    OFFERS_CACHE_TTL_SEC, BALANCE_CACHE_TTL_SEC, ORDER_DETAILS_TTL_SEC,
+    MISSING_ORDER_TTL_SEC, MISSING_ORDER_MAX_ENTRIES
+)
+from metrics import metrics
+from http_client import http_client
+from circuit_breaker import breakers, CircuitOpenError
+from rate_limiter import transfer_limiter, RateLimitExceeded
+from message_queue import OutboundQueue, PRIORITY_USER, PRIORITY_ADMIN
+from admin_digest import AdminDigest
+import tracing
+
+singleflight_calls = metrics.counter('singleflight_calls_total', 'Вызовы через single-flight: leader/shared/cached')
+order_page_cache = metrics.counter('order_page_cache_total', 'Обращения к кэшу страниц заказов FunPay: hit/miss')
+fragment_transfers = metrics.counter('fragment_transfers_total', 'Переводы Stars по результату: ok или код ошибки')
+fragment_transferred_stars = metrics.counter('fragment_transferred_stars_total', 'Отправленные звёзды')
+missing_order_cache = metrics.counter('missing_order_cache_total', 'Запросы заказов, отсечённые негативным кэшем')
 
 # Импорт парсеров
 try:
-    from funpay_parser import FunPayParser, MockFunPayParser
+    from funpay_parser import FunPayParser, MockFunPayParser, payment_status_from_details
     from fragment_parser import FragmentParser, MockFragmentParser
     PARSERS_AVAILABLE = True
 except ImportError:
     print("⚠️ Парсеры не найдены, используются mock данные")
     PARSERS_AVAILABLE = False
 
+class SingleFlight:
+    """Coalesce concurrent identical calls into one in-flight future with optional result TTL"""
+    
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._results: Dict[Hashable, Tuple[float, Any]] = {}
+    
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable], ttl: float = 0,
+                 cache_if: Callable[[Any], bool] = None):
+        """Run fn once for all concurrent callers with the same key.
+        Results are cached for ttl seconds unless cache_if rejects them (e.g. fallback data)"""
+        operation = key[0] if isinstance(key, tuple) else key
+        
+        while True:
+            cached = self._results.get(key)
+            if cached and cached[0] > time.monotonic():
+                singleflight_calls.inc(operation=operation, result='cached')
+                return copy.deepcopy(cached[1])
+            
+            future = self._inflight.get(key)
+            if future is None:
+                break
+            singleflight_calls.inc(operation=operation, result='shared')
+            try:
+                return copy.deepcopy(await asyncio.shield(future))
+            except asyncio.CancelledError:
+                # The leader was cancelled, not us: try again (and possibly become the leader)
+                if not future.cancelled():
+                    raise
+        
+        singleflight_calls.inc(operation=operation, result='leader')
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved when nobody else is waiting
+            raise
+        else:
+            future.set_result(result)
+            if ttl > 0 and (cache_if is None or cache_if(result)):
+                self._results[key] = (time.monotonic() + ttl, result)
+            return copy.deepcopy(result)
+        finally:
+            self._inflight.pop(key, None)
+    
+    def forget(self, key: Hashable):
+        """Drop cached result for key"""
+        self._results.pop(key, None)
+
 class FunPayAPI:
     def __init__(self):
         # Получение данных для авторизации из переменных окружения
         self.funpay_login = os.getenv('FUNPAY_LOGIN', '')
         self.funpay_password = os.getenv('FUNPAY_PASSWORD', '')
         self.use_mock = os.getenv('USE_MOCK_PARSERS', 'true').lower() == 'true'
+        self.api_url = FUNPAY_API_URL.rstrip('/')
+        self.api_key = FUNPAY_API_KEY
         
         # Инициализация парсера
         if PARSERS_AVAILABLE and not self.use_mock and self.funpay_login and self.funpay_password:
@@ -30,6 +105,15 @@ class FunPayAPI:
         else:
             self.parser = MockFunPayParser(self.funpay_login, self.funpay_password, headless=True)
             print("🧪 Инициализирован Mock FunPay парсер")
+        
+        # Одновременные одинаковые запросы разделяют одну загрузку страницы
+        self._flight = SingleFlight()
+        
+        # Кэш страниц заказов: {order_id: (loaded_at, details)}
+        self._order_details: Dict[str, Tuple[float, Dict]] = {}
+        
+        # Негативный кэш: заказы, которых FunPay не нашёл {order_id: expires_at}
+        self._missing_orders: Dict[str, float] = {}
     
     def __del__(self):
         """Очистка ресурсов при удалении объекта"""
@@ -39,102 +123,22 @@ class FunPayAPI:
             except:
                 pass
     
-    async def _get_session(self):
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
-        return self.session
-    
     async def _make_request(self, method: str, endpoint: str, data: Dict = None, retries: int = MAX_RETRY):
-        """Make HTTP request with retry logic"""
-        session = await self._get_session()
-        
-        for attempt in range(retries):
-            try:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'Content-Type': 'application/json'
-                }
-                
-                if method.upper() == 'GET':
-                    async with session.get(f"{self.api_url}{endpoint}", headers=headers) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:  # Rate limit
-                            wait_time = 2 ** attempt
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            response.raise_for_status()
-                else:
-                    async with session.post(f"{self.api_url}{endpoint}", 
-                                          headers=headers, json=data) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:  # Rate limit
-                            wait_time = 2 ** attempt
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            response.raise_for_status()
-                            
-            except Exception as e:
-                if attempt == retries - 1:
-                    raise e
-                wait_time = 2 ** attempt
-                await asyncio.sleep(wait_time)
-        
-        raise Exception(f"Failed after {retries} attempts")
+        """Make HTTP request to the FunPay API through the shared connection pool"""
+        if not self.api_url:
+            raise Exception("FUNPAY_API_URL is not configured")
+        headers = {'Authorization': f'Bearer {self.api_key}'}
+        return await http_client.request_json(method, f"{self.api_url}{endpoint}",
+                                              headers=headers, json=data, retries=retries)
     
     async def list_offers(self) -> List[Dict]:
         """Get list of offers from FunPay"""
         try:
-            # Получение заказов через парсер
-            orders = await self.parser.get_orders()
-            
-            # Преобразование заказов в формат офферов для совместимости
-            offers = []
-            for order in orders:
-                if order.get('stars_amount_total', 0) > 0:
-                    offers.append({
-                        'offer_id': f"stars_{order['stars_amount_total']}",
-                        'title': f"{order['stars_amount_total']} Telegram Stars",
-                        'stars_amount': order['stars_amount_total'],
-                        'price': order['total_price'],
-                        'currency': order['currency'],
-                        'is_active': True
-                    })
-            
-            # Если нет заказов, возвращаем стандартные офферы
-            if not offers:
-                offers = [
-                    {
-                        'offer_id': 'offer_100',
-                        'title': '100 Telegram Stars',
-                        'stars_amount': 100,
-                        'price': 100.0,
-                        'currency': 'RUB',
-                        'is_active': True
-                    },
-                    {
-                        'offer_id': 'offer_500',
-                        'title': '500 Telegram Stars',
-                        'stars_amount': 500,
-                        'price': 450.0,
-                        'currency': 'RUB',
-                        'is_active': True
-                    },
-                    {
-                        'offer_id': 'offer_1000',
-                        'title': '1000 Telegram Stars',
-                        'stars_amount': 1000,
-                        'price': 850.0,
-                        'currency': 'RUB',
-                        'is_active': True
-                    }
-                ]
-            
-            return offers
-            
+            # Пустой список (FunPay не ответил заказами) не кэшируется
+            offers = await self._flight.do('list_offers', self._list_offers, ttl=OFFERS_CACHE_TTL_SEC, cache_if=bool)
+        except CircuitOpenError:
+            # FunPay недоступен: вместо выдуманного прайса ошибка, /admin ping видит сбой
+            raise
         except Exception as e:
             print(f"Ошибка получения офферов: {e}")
             # Возвращаем базовые офферы в случае ошибки
@@ -148,54 +152,141 @@ class FunPayAPI:
                     'is_active': True
                 }
             ]
-    
-    async def get_order(self, order_id: str) -> Dict:
-        """Get order details from FunPay"""
-        try:
-            # Получение деталей заказа через парсер
-            order_details = await self.parser.get_order_details(order_id)
-            
-            if order_details:
-                return order_details
-            else:
-                # Если заказ не найден, возвращаем базовые данные
-                return {
-                    'order_id': order_id,
-                    'offer_id': 'stars_offer',
-                    'quantity': 1,
-                    'buyer_username': 'unknown_user',
-                    'buyer_funpay_login': 'unknown_funpay',
-                    'total_price': 100.0,
+        
+        # Если нет заказов, возвращаем стандартные офферы
+        if not offers:
+            offers = [
+                {
+                    'offer_id': 'offer_100',
+                    'title': '100 Telegram Stars',
+                    'stars_amount': 100,
+                    'price': 100.0,
+                    'currency': 'RUB',
+                    'is_active': True
+                },
+                {
+                    'offer_id': 'offer_500',
+                    'title': '500 Telegram Stars',
+                    'stars_amount': 500,
+                    'price': 450.0,
                     'currency': 'RUB',
-                    'status': 'NEW',
-                    'created_at': datetime.now().isoformat(),
-                    'attached_telegram_username': '',
-                    'stars_amount_total': 100
+                    'is_active': True
+                },
+                {
+                    'offer_id': 'offer_1000',
+                    'title': '1000 Telegram Stars',
+                    'stars_amount': 1000,
+                    'price': 850.0,
+                    'currency': 'RUB',
+                    'is_active': True
                 }
-                
+            ]
+        
+        return offers
+    
+    async def _list_offers(self) -> List[Dict]:
+        """Offers built from FunPay orders; errors propagate so fallbacks are never cached"""
+        # Получение заказов через парсер
+        orders = await breakers['funpay_read'].call(self.parser.get_orders)
+        
+        # Преобразование заказов в формат офферов для совместимости
+        offers = []
+        for order in orders:
+            if order.get('stars_amount_total', 0) > 0:
+                offers.append({
+                    'offer_id': f"stars_{order['stars_amount_total']}",
+                    'title': f"{order['stars_amount_total']} Telegram Stars",
+                    'stars_amount': order['stars_amount_total'],
+                    'price': order['total_price'],
+                    'currency': order['currency'],
+                    'is_active': True
+                })
+        return offers
+    
+    async def _get_order_details(self, order_id: str, force_refresh: bool = False,
+                                 max_age: float = None) -> Optional[Dict]:
+        """Order page details, served from the per-order cache while fresh"""
+        if max_age is None:
+            max_age = ORDER_DETAILS_TTL_SEC
+        
+        cached = self._order_details.get(order_id)
+        if cached and not force_refresh and time.monotonic() - cached[0] <= max_age:
+            order_page_cache.inc(result='hit')
+            return copy.deepcopy(cached[1])
+        
+        order_page_cache.inc(result='miss')
+        order_details = await self._flight.do(
+            ('order_details', order_id),
+            lambda: breakers['funpay_read'].call(lambda: self.parser.get_order_details(order_id))
+        )
+        
+        if order_details:
+            self._prune_order_cache()
+            self._order_details[order_id] = (time.monotonic(), copy.deepcopy(order_details))
+        return order_details
+    
+    def _prune_order_cache(self):
+        """Drop expired order pages so the cache stays small"""
+        now = time.monotonic()
+        expired = [key for key, (loaded_at, _) in self._order_details.items()
+                   if now - loaded_at > ORDER_DETAILS_TTL_SEC]
+        for key in expired:
+            del self._order_details[key]
+    
+    def invalidate_order(self, order_id: str):
+        """Forget cached order page (status changed or must be re-read)"""
+        self._order_details.pop(order_id, None)
+        self._missing_orders.pop(order_id, None)
+    
+    def _is_known_missing(self, order_id: str) -> bool:
+        expires_at = self._missing_orders.get(order_id)
+        if expires_at is None:
+            return False
+        if expires_at <= time.monotonic():
+            del self._missing_orders[order_id]
+            return False
+        return True
+    
+    def _remember_missing(self, order_id: str):
+        now = time.monotonic()
+        if len(self._missing_orders) >= MISSING_ORDER_MAX_ENTRIES:
+            for key in [k for k, expires_at in self._missing_orders.items() if expires_at <= now]:
+                del self._missing_orders[key]
+            # Всё ещё полон: вытесняем самые старые записи
+            while len(self._missing_orders) >= MISSING_ORDER_MAX_ENTRIES:
+                del self._missing_orders[next(iter(self._missing_orders))]
+        self._missing_orders[order_id] = now + MISSING_ORDER_TTL_SEC
+    
+    async def get_order(self, order_id: str, force_refresh: bool = False) -> Optional[Dict]:
+        """Get order details from FunPay (None if FunPay has no such order)"""
+        if not force_refresh and self._is_known_missing(order_id):
+            missing_order_cache.inc(result='hit')
+            return None
+        
+        try:
+            # Получение деталей заказа через парсер (или из кэша страниц)
+            order_details = await self._get_order_details(order_id, force_refresh=force_refresh)
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Ошибка получения заказа {order_id}: {e}")
-            return {
-                'order_id': order_id,
-                'offer_id': 'stars_offer',
-                'quantity': 1,
-                'buyer_username': 'error_user',
-                'buyer_funpay_login': 'error_funpay',
-                'total_price': 0.0,
-                'currency': 'RUB',
-                'status': 'ERROR',
-                'created_at': datetime.now().isoformat(),
-                'attached_telegram_username': '',
-                'stars_amount_total': 0
-            }
+            return None
+        
+        if not order_details:
+            # Повторные запросы того же ID не загружают страницу до истечения TTL
+            self._remember_missing(order_id)
+            missing_order_cache.inc(result='stored')
+        return order_details
     
-    async def verify_payment(self, order_id: str) -> Dict:
-        """Verify payment status"""
+    async def verify_payment(self, order_id: str, force_refresh: bool = False,
+                             max_age: float = None) -> Dict:
+        """Verify payment status from the order page (cached unless stale or forced)"""
         try:
-            # Проверка оплаты через парсер
-            payment_status = await self.parser.verify_payment(order_id)
-            return payment_status
+            order_details = await self._get_order_details(order_id, force_refresh=force_refresh, max_age=max_age)
+            return payment_status_from_details(order_id, order_details)
             
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Ошибка проверки оплаты {order_id}: {e}")
             return {
@@ -204,12 +295,22 @@ class FunPayAPI:
                 'method': 'funpay',
                 'tx_id': None
             }
+    
+    async def send_message(self, order_id: str, message: str) -> bool:
+        """Send message to the FunPay order chat"""
+        try:
+            return await breakers['funpay_chat'].call(lambda: self.parser.send_message(order_id, message))
+        except Exception as e:
+            print(f"Ошибка отправки сообщения в заказ {order_id}: {e}")
+            return False
 
 class FragmentAPI:
     def __init__(self):
         # Получение данных для авторизации из переменных окружения
         self.fragment_phone = os.getenv('FRAGMENT_PHONE', '')
         self.use_mock = os.getenv('USE_MOCK_PARSERS', 'true').lower() == 'true'
+        self.api_url = FRAGMENT_API_URL.rstrip('/')
+        self.api_key = FRAGMENT_API_KEY
         
         # Инициализация парсера
         if PARSERS_AVAILABLE and not self.use_mock and self.fragment_phone:
@@ -218,6 +319,11 @@ class FragmentAPI:
         else:
             self.parser = MockFragmentParser(self.fragment_phone, headless=True)
             print("🧪 Инициализирован Mock Fragment парсер")
+        
+        self._flight = SingleFlight()
+        
+        # Pace transfers proactively instead of waiting for rate_limited errors
+        self.transfer_limiter = transfer_limiter(self.fragment_phone)
     
     def __del__(self):
         """Очистка ресурсов при удалении объекта"""
@@ -227,59 +333,23 @@ class FragmentAPI:
             except:
                 pass
     
-    async def _get_session(self):
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
-        return self.session
-    
     async def _make_request(self, method: str, endpoint: str, data: Dict = None, retries: int = MAX_RETRY):
-        """Make HTTP request with retry logic"""
-        session = await self._get_session()
-        
-        for attempt in range(retries):
-            try:
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                    'Content-Type': 'application/json'
-                }
-                
-                if method.upper() == 'GET':
-                    async with session.get(f"{self.api_url}{endpoint}", headers=headers) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:  # Rate limit
-                            wait_time = 2 ** attempt
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            response.raise_for_status()
-                else:
-                    async with session.post(f"{self.api_url}{endpoint}", 
-                                          headers=headers, json=data) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:  # Rate limit
-                            wait_time = 2 ** attempt
-                            await asyncio.sleep(wait_time)
-                            continue
-                        else:
-                            response.raise_for_status()
-                            
-            except Exception as e:
-                if attempt == retries - 1:
-                    raise e
-                wait_time = 2 ** attempt
-                await asyncio.sleep(wait_time)
-        
-        raise Exception(f"Failed after {retries} attempts")
+        """Make HTTP request to the Fragment API through the shared connection pool"""
+        if not self.api_url:
+            raise Exception("FRAGMENT_API_URL is not configured")
+        headers = {'Authorization': f'Bearer {self.api_key}'}
+        return await http_client.request_json(method, f"{self.api_url}{endpoint}",
+                                              headers=headers, json=data, retries=retries)
     
     async def get_balance(self) -> Dict:
         """Get Fragment balance"""
+        # Нулевой баланс от упавшего парсера не кэшируется: следующий вызов прочитает страницу заново
+        balance_breaker = breakers['fragment_balance']
         try:
-            # Получение баланса через парсер
-            balance = await self.parser.get_balance()
-            return balance
-            
+            return await self._flight.do('get_balance', self._get_balance, ttl=BALANCE_CACHE_TTL_SEC,
+                                         cache_if=lambda balance: not balance_breaker.is_failure(balance))
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Ошибка получения баланса Fragment: {e}")
             return {
@@ -287,15 +357,42 @@ class FragmentAPI:
                 'daily_limit_left': 0
             }
     
+    async def _get_balance(self) -> Dict:
+        # Получение баланса через парсер
+        return await breakers['fragment_balance'].call(self.parser.get_balance)
+    
     async def transfer_stars(self, to_username: str, stars_amount: int, idempotency_key: str) -> Dict:
         """Transfer stars via Fragment"""
         try:
-            # Отправка Stars через парсер
-            result = await self.parser.transfer_stars(to_username, stars_amount, idempotency_key)
+            await self.transfer_limiter.acquire(stars_amount)
+            
+            # Отправка Stars через парсер; баланс после перевода изменился
+            result = await breakers['fragment_transfer'].call(
+                lambda: self.parser.transfer_stars(to_username, stars_amount, idempotency_key)
+            )
+            self._flight.forget('get_balance')
+            
+            if result.get('ok'):
+                self.transfer_limiter.record(stars_amount)
+                fragment_transferred_stars.inc(stars_amount)
+            elif result.get('error_code') == 'rate_limited':
+                self.transfer_limiter.penalize()
+            fragment_transfers.inc(result='ok' if result.get('ok') else result.get('error_code') or 'error')
             return result
             
+        except RateLimitExceeded as e:
+            fragment_transfers.inc(result='daily_limit_exceeded')
+            return {
+                'ok': False,
+                'transfer_id': None,
+                'error_code': 'daily_limit_exceeded',
+                'error_message': str(e)
+            }
+        except CircuitOpenError:
+            raise
         except Exception as e:
             print(f"Ошибка отправки Stars: {e}")
+            fragment_transfers.inc(result='exception')
             return {
                 'ok': False,
                 'transfer_id': None,
@@ -304,24 +401,91 @@ class FragmentAPI:
             }
 
 class NotificationService:
-    def __init__(self, bot):
+    def __init__(self, bot, digest_enabled: bool = ADMIN_DIGEST_ENABLED,
+                 digest_window_sec: float = ADMIN_DIGEST_WINDOW_MIN * 60):
         self.bot = bot
+        # Outbound queue keeps us under Telegram's global and per-chat limits
+        self.queue = OutboundQueue(bot)
+        
+        # Digest mode: routine admin events are summarized once per window
+        self.digest = AdminDigest() if digest_enabled else None
+        self.digest_window_sec = digest_window_sec
+        self._digest_task = None
+        # Delivery results of events waiting in the digest: reported when the digest is actually sent
+        self._digest_acks: List[Callable[[str], None]] = []
+    
+    async def start(self):
+        await self.queue.start()
+        if self.digest:
+            self._digest_task = asyncio.create_task(self._digest_loop())
+    
+    async def stop(self):
+        """Send the last digest and flush queued messages on shutdown"""
+        if self._digest_task:
+            self._digest_task.cancel()
+            try:
+                await self._digest_task
+            except asyncio.CancelledError:
+                pass
+            self._digest_task = None
+            self.flush_digest()
+        await self.queue.stop()
+    
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_window_sec)
+            self.flush_digest()
+    
+    def flush_digest(self):
+        """Send accumulated digest to all admins"""
+        message = self.digest.flush() if self.digest else None
+        acks, self._digest_acks = self._digest_acks, []
+        if not message:
+            return
+        
+        def report(result: str):
+            for ack in acks:
+                ack(result)
+        
+        self._send_to_admins(message, report)
     
-    async def notify_user(self, chat_id: int, message: str):
+    async def notify_user(self, chat_id: int, message: str, on_result: Callable[[str], None] = None):
         """Send notification to user"""
-        try:
-            await self.bot.send_message(chat_id=chat_id, text=message, parse_mode='HTML')
-        except Exception as e:
-            print(f"Failed to notify user {chat_id}: {e}")
+        # The span lasts until Telegram accepts (or finally rejects) the message
+        on_result = tracing.finish_on_result(tracing.start_span('notify.user'), on_result)
+        self.queue.put(chat_id, message, priority=PRIORITY_USER, kind='user', on_result=on_result)
+    
+    async def notify_admin(self, message: str, event: str = None, urgent: bool = False,
+                           order_id: str = None, stars: int = 0, revenue_rub: float = 0.0,
+                           on_result: Callable[[str], None] = None):
+        """Send notification to all admins (routine events go to the digest when enabled)"""
+        on_result = tracing.finish_on_result(tracing.start_span('notify.admin', event=event), on_result)
+        if self.digest and event:
+            self.digest.record(event, order_id=order_id, stars=stars, revenue_rub=revenue_rub)
+            if not urgent:
+                # Outbox keeps the event pending until the digest is delivered (a crash re-sends it)
+                if on_result:
+                    self._digest_acks.append(on_result)
+                return
+        self._send_to_admins(message, on_result)
     
-    async def notify_admin(self, message: str):
-        """Send notification to all admins"""
+    def _send_to_admins(self, message: str, on_result: Callable[[str], None] = None):
+        """Fan out to every admin at once; the queue sends them concurrently"""
         from config import ADMIN_IDS
+        if not ADMIN_IDS:
+            if on_result:
+                on_result('sent')
+            return
+        
+        # Report once all admins are done: failed if any delivery failed
+        results = []
+        def collect(result: str):
+            results.append(result)
+            if len(results) == len(ADMIN_IDS) and on_result:
+                on_result('failed' if 'failed' in results else 'sent')
+        
         for admin_id in ADMIN_IDS:
-            try:
-                await self.bot.send_message(chat_id=admin_id, text=message, parse_mode='HTML')
-            except Exception as e:
-                print(f"Failed to notify admin {admin_id}: {e}")
+            self.queue.put(admin_id, message, priority=PRIORITY_ADMIN, kind='admin', on_result=collect)
 
 class Utils:
     @staticmethod
@@ -1,12 +1,168 @@
+import atexit
+import copy
+import glob
+import gzip
 import logging
 import json
+import os
+import queue
+import shutil
+import time
 from datetime import datetime, timedelta
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from typing import Dict, List, Optional
 from decimal import Decimal
 
-from config import CURRENCY
+from config import (
+    CURRENCY, LOG_DIR, LOG_FILE, LOG_LEVEL, LOG_MAX_BYTES, LOG_ROTATE_INTERVAL_HOURS,
+    LOG_BACKUP_COUNT, LOG_RETENTION_DAYS, LOG_QUEUE_SIZE
+)
 from database import db
 from integrations import utils
+from metrics import metrics
+import tracing
+
+log_records_dropped = metrics.counter('log_records_dropped_total', 'Записи лога, отброшенные из-за переполненной очереди')
+
+# Стандартные поля LogRecord; всё остальное (extra=...) попадает в JSON как есть
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'trace_id'}
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[QueueListener] = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'trace_id', None):
+            data['trace_id'] = record.trace_id
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exc'] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    """Ротация по размеру или по времени; старые файлы сжимаются в .gz и удаляются по сроку хранения"""
+
+    def __init__(self, filename: str, max_bytes: int = LOG_MAX_BYTES,
+                 interval_hours: float = LOG_ROTATE_INTERVAL_HOURS, backup_count: int = LOG_BACKUP_COUNT,
+                 retention_days: float = LOG_RETENTION_DAYS):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8', delay=True)
+        self.interval = interval_hours * 3600
+        self.retention_days = retention_days
+        self.rollover_at = time.time() + self.interval if self.interval else None
+        self.namer = lambda name: name + '.gz'
+        self.rotator = _gzip_rotator
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.rollover_at and time.time() >= self.rollover_at:
+            if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+                return True
+            # Пустой файл не ротируется, отсчёт начинается заново
+            self.rollover_at = time.time() + self.interval
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        super().doRollover()
+        if self.interval:
+            self.rollover_at = time.time() + self.interval
+        self._prune()
+
+    def _prune(self):
+        if not self.retention_days:
+            return
+        cutoff = time.time() - self.retention_days * 86400
+        for path in glob.glob(self.baseFilename + '.*.gz'):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Запись лога в event loop - только постановка в очередь; при переполнении запись отбрасывается"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Контекст трассировки доступен только в потоке, где пишется лог
+        record = copy.copy(record)
+        record.trace_id = getattr(record, 'trace_id', None) or tracing.current_trace_id()
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+def setup_logging(level: str = LOG_LEVEL, log_dir: str = LOG_DIR, filename: str = LOG_FILE) -> logging.Logger:
+    """Настройка логирования процесса; повторные вызовы ничего не добавляют"""
+    global _listener
+    logger = logging.getLogger('telegram_stars_bot')
+    if _listener is not None:
+        return logger
+
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = CompressingRotatingFileHandler(os.path.join(log_dir, filename))
+    file_handler.setFormatter(JsonFormatter())
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    # Файл и консоль пишет отдельный поток; все логгеры идут через корневой
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    _listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+        root.removeHandler(handler)
+    root.addHandler(NonBlockingQueueHandler(log_queue))
+    root.setLevel(level)
+    # Каждый запрос long polling логируется httpx на INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return logger
+
+
+def shutdown_logging():
+    """Запись оставшихся в очереди записей и остановка потока логирования"""
+    global _listener
+    if _listener is None:
+        return
+    listener, _listener = _listener, None
+    root = logging.getLogger()
+    for handler in [h for h in root.handlers if isinstance(h, NonBlockingQueueHandler)]:
+        root.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+atexit.register(shutdown_logging)
 
 class OrderLogger:
     def __init__(self, notification_service):
@@ -21,33 +177,8 @@ class OrderLogger:
         self.total_orders = 0
     
     def setup_logging(self):
-        """Настройка системы логирования"""
-        # Создание директории для логов
-        import os
-        os.makedirs('logs', exist_ok=True)
-        
-        # Настройка основного логгера
-        self.logger = logging.getLogger('telegram_stars_bot')
-        self.logger.setLevel(logging.INFO)
-        
-        # Хендлер для файла
-        file_handler = logging.FileHandler('logs/bot_operations.log', encoding='utf-8')
-        file_handler.setLevel(logging.INFO)
-        
-        # Хендлер для консоли
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        
-        # Форматтер
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
-        file_handler.setFormatter(formatter)
-        console_handler.setFormatter(formatter)
-        
-        # Добавление хендлеров
-        self.logger.addHandler(file_handler)
-        self.logger.addHandler(console_handler)
+        """Настройка системы логирования (общая для процесса, хендлеры не дублируются)"""
+        self.logger = setup_logging()
     
     async def log_order_completion(self, order_data: Dict, fulfillment_data: Dict):
         """Логирование выполненного заказа"""
@@ -75,7 +206,8 @@ class OrderLogger:
             'status': 'completed'
         }
         
-        self.logger.info(f"Order completed: {json.dumps(log_entry, ensure_ascii=False)}")
+        self.logger.info(f"Order completed: {json.dumps(log_entry, ensure_ascii=False)}",
+                         extra={'event': 'order_completed', 'data': log_entry})
         
         # Сохранение в базу данных
         self._save_order_log(log_entry)
@@ -150,7 +282,10 @@ class OrderLogger:
 • Всего звёзд: {self.total_stars_sold:,} ⭐
 • Общий доход: {self.total_revenue:,.2f} ₽"""
 
-        await self.notification_service.notify_admin(message)
+        await self.notification_service.notify_admin(
+            message, event='completed', order_id=log_entry['order_id'],
+            stars=log_entry['stars_amount'], revenue_rub=log_entry['price_rub']
+        )
     
     async def get_monthly_statistics(self, year: int = None, month: int = None) -> Dict:
         """Получение статистики за месяц"""
@@ -254,7 +389,8 @@ class OrderLogger:
             'context': context or {}
         }
         
-        self.logger.error(f"Error occurred: {json.dumps(log_data, ensure_ascii=False)}")
+        self.logger.error(f"Error occurred: {json.dumps(log_data, ensure_ascii=False)}",
+                          extra={'event': 'error', 'data': log_data})
     
     def log_admin_action(self, admin_id: int, action: str, details: Dict = None):
         """Логирование действий администратора"""
@@ -265,7 +401,8 @@ class OrderLogger:
             'details': details or {}
         }
         
-        self.logger.info(f"Admin action: {json.dumps(log_data, ensure_ascii=False)}")
+        self.logger.info(f"Admin action: {json.dumps(log_data, ensure_ascii=False)}",
+                         extra={'event': 'admin_action', 'data': log_data})
     
     def get_recent_orders(self, limit: int = 10) -> List[Dict]:
         """Получение последних заказов"""
@@ -0,0 +1,186 @@
+"""
+Очередь исходящих сообщений Telegram: глобальный и per-chat лимиты, RetryAfter, приоритеты
+"""
+
+import asyncio
+import itertools
+import time
+from datetime import timedelta
+from typing import Callable, Dict, List, Optional
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_PER_CHAT_INTERVAL_SEC, TELEGRAM_SEND_RETRIES
+from metrics import metrics
+from rate_limiter import TokenBucket
+
+telegram_messages = metrics.counter('telegram_messages_total', 'Исходящие сообщения по результату: sent/retry_after/retry/dropped')
+telegram_queue_depth = metrics.gauge('telegram_queue_depth', 'Сообщений в очереди на отправку')
+telegram_send_seconds = metrics.histogram('telegram_send_seconds', 'Длительность вызова send_message')
+telegram_queue_delay_seconds = metrics.histogram('telegram_queue_delay_seconds', 'Время от постановки в очередь до доставки')
+
+# Меньше - важнее
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+
+class OutboundMessage:
+    def __init__(self, chat_id: int, text: str, parse_mode: str, priority: int, kind: str, seq: int,
+                 on_result: Callable[[str], None] = None):
+        self.chat_id = chat_id
+        self.text = text
+        self.parse_mode = parse_mode
+        self.priority = priority
+        self.kind = kind
+        self.seq = seq
+        self.on_result = on_result  # вызывается с 'sent', 'dropped' или 'failed'
+        self.attempts = 0
+        self.enqueued_at = time.monotonic()
+        self.not_before = 0.0
+
+
+class OutboundQueue:
+    def __init__(self, bot, global_rate: float = TELEGRAM_GLOBAL_RATE,
+                 per_chat_interval: float = TELEGRAM_PER_CHAT_INTERVAL_SEC,
+                 max_attempts: int = TELEGRAM_SEND_RETRIES):
+        self.bot = bot
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self._global = TokenBucket(global_rate, capacity=1)
+
+        self._pending: List[OutboundMessage] = []
+        self._seq = itertools.count()
+        self._chat_next: Dict[int, float] = {}  # {chat_id: когда можно писать снова}
+        self._paused_until = 0.0
+        self._inflight = set()
+        self._wakeup = None
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending) + len(self._inflight)
+
+    def put(self, chat_id: int, text: str, parse_mode: str = 'HTML',
+            priority: int = PRIORITY_USER, kind: str = 'user', on_result: Callable[[str], None] = None):
+        """Постановка сообщения в очередь (без ожидания отправки)"""
+        self._pending.append(OutboundMessage(chat_id, text, parse_mode, priority, kind, next(self._seq), on_result))
+        telegram_queue_depth.set(len(self._pending))
+        self._ensure_started()
+        self._wakeup.set()
+
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def start(self):
+        self._ensure_started()
+
+    async def stop(self, timeout: float = 10):
+        """Досылка очереди при остановке бота, затем отмена диспетчера"""
+        deadline = time.monotonic() + timeout
+        while len(self) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._pending:
+            print(f"⚠️ Не доставлено сообщений Telegram: {len(self._pending)}")
+
+    def _next_ready(self):
+        """Самое приоритетное сообщение, которое можно отправить сейчас, или время до следующего"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+
+        best = None
+        wait = None
+        for message in self._pending:
+            ready_at = max(message.not_before, self._chat_next.get(message.chat_id, 0.0))
+            if ready_at > now:
+                wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                continue
+            if best is None or (message.priority, message.seq) < (best.priority, best.seq):
+                best = message
+        return best, wait
+
+    async def _run(self):
+        while True:
+            message, wait = self._next_ready()
+            if message is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._global.acquire()
+            self._pending.remove(message)
+            telegram_queue_depth.set(len(self._pending))
+            self._chat_next[message.chat_id] = time.monotonic() + self.per_chat_interval
+
+            task = asyncio.create_task(self._send(message))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def _requeue(self, message: OutboundMessage, delay: float):
+        message.not_before = time.monotonic() + delay
+        self._pending.append(message)
+        telegram_queue_depth.set(len(self._pending))
+        if self._wakeup:
+            self._wakeup.set()
+
+    async def _send(self, message: OutboundMessage):
+        message.attempts += 1
+        start = time.monotonic()
+        try:
+            await self.bot.send_message(chat_id=message.chat_id, text=message.text, parse_mode=message.parse_mode)
+        except RetryAfter as e:
+            # Flood control: пауза для всей очереди, сообщение уходит первым после неё
+            delay = _seconds(e.retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+            telegram_messages.inc(kind=message.kind, result='retry_after')
+            self._requeue(message, delay)
+        except (BadRequest, Forbidden) as e:
+            telegram_messages.inc(kind=message.kind, result='dropped')
+            print(f"Failed to notify {message.kind} {message.chat_id}: {e}")
+            _report(message, 'dropped')
+        except NetworkError as e:
+            if message.attempts < self.max_attempts:
+                telegram_messages.inc(kind=message.kind, result='retry')
+                self._requeue(message, 2 ** message.attempts)
+            else:
+                telegram_messages.inc(kind=message.kind, result='dropped')
+                print(f"Failed to notify {message.kind} {message.chat_id}: {e}")
+                _report(message, 'failed')
+        except Exception as e:
+            telegram_messages.inc(kind=message.kind, result='dropped')
+            print(f"Failed to notify {message.kind} {message.chat_id}: {e}")
+            _report(message, 'failed')
+        else:
+            now = time.monotonic()
+            telegram_messages.inc(kind=message.kind, result='sent')
+            telegram_send_seconds.observe(now - start, kind=message.kind)
+            telegram_queue_delay_seconds.observe(now - message.enqueued_at, kind=message.kind)
+            _report(message, 'sent')
+
+
+def _report(message: OutboundMessage, result: str):
+    """Итог доставки для отправителя (например, outbox)"""
+    if message.on_result:
+        try:
+            message.on_result(result)
+        except Exception as e:
+            print(f"⚠️ Ошибка обработчика доставки: {e}")
+
+
+def _seconds(retry_after) -> float:
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
@@ -1,9 +1,45 @@
+import html
+from collections import OrderedDict
+from datetime import datetime
+
 from config import CURRENCY, PAYMENT_WAIT_MINUTES, AUTO_CLOSE_MIN, FRAGMENT_MIN, FRAGMENT_MAX
 from integrations import utils
 
+# Memoized renders shared by every MessageTemplates instance
+ORDER_STATUS_CACHE_SIZE = 1024
+_price_cache = {'version': None, 'text': None}
+_order_status_cache: 'OrderedDict[tuple, str]' = OrderedDict()
+
+
+def catalog_version(offers: list) -> tuple:
+    """Fingerprint of the fields the price list shows; changes whenever the catalog does"""
+    return tuple((offer['title'], offer['stars_amount'], offer['price'], offer['currency'], offer['is_active'])
+                 for offer in offers)
+
+
+def clear_template_caches():
+    """Drop memoized renders (used by benchmarks and tests)"""
+    _price_cache.update(version=None, text=None)
+    _order_status_cache.clear()
+
+
 class MessageTemplates:
     def start_message(self) -> str:
         """Welcome message"""
+        return START_MESSAGE
+
+    def price_message(self, offers: list) -> str:
+        """Price list message (re-rendered only when the offer catalog changes)"""
+        if not offers:
+            return "❌ Офферы временно недоступны. Попробуйте позже."
+        
+        version = catalog_version(offers)
+        if _price_cache['version'] != version:
+            _price_cache['text'] = self._render_price_message(offers)
+            _price_cache['version'] = version
+        return _price_cache['text']
+
+    def _render_start_message(self) -> str:
         return f"""Привет! Я помогу купить и доставить Telegram Stars.
 
 1️⃣ Выберите оффер (количество звёзд) на FunPay
@@ -17,11 +53,7 @@ class MessageTemplates:
 /help — инструкции
 /terms — условия покупки"""
 
-    def price_message(self, offers: list) -> str:
-        """Price list message"""
-        if not offers:
-            return "❌ Офферы временно недоступны. Попробуйте позже."
-        
+    def _render_price_message(self, offers: list) -> str:
         message = f"<b>Актуальные офферы:</b>\n\n"
         
         for offer in offers:
@@ -66,7 +98,7 @@ class MessageTemplates:
         
         return f"""✅ Подтвердите: отправить {stars_total:,} ⭐ на {normalized_username}?
 
-Напишите «Да», если всё верно, или пришлите правильный @юзернейм."""
+Нажмите «Да», если всё верно, или пришлите правильный @юзернейм."""
 
     def needs_balance(self, order_data: dict) -> str:
         """Needs balance message"""
@@ -80,6 +112,20 @@ class MessageTemplates:
 
 Спасибо за терпение! 🙏"""
 
+    def order_parked(self, order_id: str) -> str:
+        """Order parked while an upstream service is unavailable"""
+        return f"""⏸ Заказ №{order_id} ненадолго отложен.
+
+Сервис выдачи временно недоступен. Мы продолжим автоматически,
+как только он восстановится, — ничего делать не нужно."""
+
+    def rate_limited(self, retry_in: float) -> str:
+        """Cooldown reply for too frequent expensive commands"""
+        seconds = max(1, int(retry_in + 0.999))
+        return f"""⏳ Слишком много запросов подряд.
+
+Пожалуйста, подождите {seconds} с и попробуйте снова."""
+
     def fulfillment_success(self, order_data: dict, fulfillment_data: dict = None) -> str:
         """Successful fulfillment message"""
         order_id = order_data['order_id']
@@ -140,6 +186,9 @@ class MessageTemplates:
 
     def help_message(self) -> str:
         """Help message"""
+        return HELP_MESSAGE
+
+    def _render_help_message(self) -> str:
         return f"""📖 <b>Как оформить заказ:</b>
 
 1️⃣ Перейдите на FunPay и выберите нужный оффер
@@ -161,6 +210,9 @@ class MessageTemplates:
 
     def terms_message(self) -> str:
         """Terms and conditions message"""
+        return TERMS_MESSAGE
+
+    def _render_terms_message(self) -> str:
         return f"""📋 <b>Условия покупки Telegram Stars:</b>
 
 <b>Цены и оплата:</b>
@@ -189,7 +241,25 @@ class MessageTemplates:
 • Время ответа: до 24 часов"""
 
     def order_status(self, order_data: dict, fulfillment_data: dict = None) -> str:
-        """Order status message"""
+        """Order status message (memoized by order and fulfillment state)"""
+        key = (
+            order_data['order_id'], order_data['status'], order_data['stars_amount_total'],
+            order_data['created_at'], order_data['total_price'], order_data['currency'],
+            order_data.get('attached_telegram_username'),
+            fulfillment_data and fulfillment_data['status'],
+            fulfillment_data and tuple(b['status'] for b in fulfillment_data.get('batches') or ())
+        )
+        message = _order_status_cache.get(key)
+        if message is None:
+            message = self._render_order_status(order_data, fulfillment_data)
+            _order_status_cache[key] = message
+            if len(_order_status_cache) > ORDER_STATUS_CACHE_SIZE:
+                _order_status_cache.popitem(last=False)
+        else:
+            _order_status_cache.move_to_end(key)
+        return message
+
+    def _render_order_status(self, order_data: dict, fulfillment_data: dict = None) -> str:
         order_id = order_data['order_id']
         status = order_data['status']
         stars_total = order_data['stars_amount_total']
@@ -197,7 +267,6 @@ class MessageTemplates:
         
         # Format date
         try:
-            from datetime import datetime
             dt = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
             formatted_date = dt.strftime('%d.%m.%Y %H:%M')
         except:
@@ -246,12 +315,18 @@ class MessageTemplates:
 
     def admin_balance(self, balance: dict) -> str:
         """Admin balance message"""
-        return f"""💰 <b>Баланс Fragment:</b>
+        message = f"""💰 <b>Баланс Fragment:</b>
 
 ⭐ Звёзд: {balance['stars_balance']:,}
 📊 Дневной лимит: {balance['daily_limit_left']:,}"""
+        
+        if balance.get('reserved'):
+            message += f"\n🔒 Зарезервировано: {balance['reserved']:,}"
+            message += f"\n✅ Доступно: {balance['available']:,}"
+        
+        return message
 
-    def admin_ping(self, services_status: dict) -> str:
+    def admin_ping(self, services_status: dict, breakers_status: dict = None) -> str:
         """Admin ping message"""
         message = "🏓 <b>Статус сервисов:</b>\n\n"
         
@@ -263,44 +338,108 @@ class MessageTemplates:
                 message += f" ({status['error']})"
             message += "\n"
         
+        if breakers_status:
+            message += "\n🔌 <b>Circuit breakers:</b>\n\n"
+            for name, status in breakers_status.items():
+                emoji = {'closed': '🟢', 'half_open': '🟡', 'open': '🔴'}[status['state']]
+                message += f"{emoji} <b>{name}:</b> {status['state']}, ошибок {status['error_rate']:.0%}"
+                if status['state'] == 'open':
+                    message += f", проба через {status['retry_in']} с"
+                message += "\n"
+        
+        return message
+
+    def admin_perf(self, summary: dict) -> str:
+        """Admin per-stage latency summary (milliseconds)"""
+        if not summary:
+            return "⏱ Спанов пока нет."
+        
+        rows = [f"{'этап':<24}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}"]
+        for name, stats in sorted(summary.items()):
+            rows.append(f"{name:<24}{stats['count']:>6}{stats['p50']:>9.1f}{stats['p95']:>9.1f}{stats['p99']:>9.1f}")
+        return "⏱ <b>Задержки по этапам, мс:</b>\n\n<pre>" + "\n".join(rows) + "</pre>"
+
+    def admin_profile(self, samples: int, seconds: float, top_functions: list) -> str:
+        """Caption for the collapsed-stack profile document"""
+        message = f"🔥 Профиль event loop: {samples} сэмплов за {seconds:g} с\n"
+        message += "Файл открывается в speedscope.app или flamegraph.pl\n"
+        for name, count in top_functions:
+            message += f"\n{count * 100 // max(samples, 1)}% {name}"
+        # Подпись к документу Telegram ограничена 1024 символами
+        return message[:1024]
+
+    def admin_loopstats(self, stats: dict) -> str:
+        """Admin event loop statistics message"""
+        message = "🔄 <b>Event loop:</b>\n\n"
+        lag = stats['lag_ms']
+        if lag:
+            message += f"Задержка, мс: сейчас {lag['last']:.1f}, p50 {lag['p50']:.1f}, "
+            message += f"p99 {lag['p99']:.1f}, макс {lag['max']:.1f}\n"
+        message += f"Задач: {stats['tasks']}\n"
+        
+        message += f"\n🐢 <b>Медленные колбэки</b> (debug {'вкл' if stats['debug'] else 'выкл'}):\n"
+        if not stats['debug']:
+            message += "Включите: /admin loopstats debug on\n"
+        for _, handle, duration in stats['slow_callbacks']:
+            message += f"• {duration * 1000:.0f} мс <code>{html.escape(handle[:120])}</code>\n"
+        
+        if stats['running']:
+            message += "\n⏳ <b>Дольше всех работают:</b>\n"
+            for age, name in stats['running']:
+                message += f"• {age:.1f} с <code>{html.escape(name)}</code>\n"
+        if stats['finished']:
+            message += "\n⏱ <b>Завершённые по суммарному времени:</b>\n"
+            for name, count, total, longest in stats['finished']:
+                message += f"• {total:.1f} с ×{count} (макс {longest:.2f} с) <code>{html.escape(name)}</code>\n"
+        
         return message
 
     def _format_status(self, status: str) -> str:
         """Format order status for display"""
-        status_map = {
-            'NEW': '🆕 Новый',
-            'WAITING_PAYMENT': '⏳ Ожидает оплаты',
-            'PAID': '✅ Оплачен',
-            'FULFILLING': '🚀 Выполняется',
-            'FULFILLED': '🎉 Выполнен',
-            'NEEDS_USERNAME': '❓ Нужен юзернейм',
-            'NEEDS_BALANCE': '💰 Ожидает пополнения',
-            'FAILED': '❌ Ошибка',
-            'PARTIALLY_FULFILLED': '⚠️ Частично выполнен'
-        }
-        return status_map.get(status, status)
+        return STATUS_NAMES.get(status, status)
 
     def _format_fulfillment_status(self, status: str) -> str:
         """Format fulfillment status for display"""
-        status_map = {
-            'PENDING': '⏳ В ожидании',
-            'SUCCESS': '✅ Успешно',
-            'FAILED': '❌ Ошибка',
-            'PARTIAL': '⚠️ Частично'
-        }
-        return status_map.get(status, status)
+        return FULFILLMENT_STATUS_NAMES.get(status, status)
 
     def _get_status_emoji(self, status: str) -> str:
         """Get emoji for status"""
-        emoji_map = {
-            'NEW': '🆕',
-            'WAITING_PAYMENT': '⏳',
-            'PAID': '✅',
-            'FULFILLING': '🚀',
-            'FULFILLED': '🎉',
-            'NEEDS_USERNAME': '❓',
-            'NEEDS_BALANCE': '💰',
-            'FAILED': '❌',
-            'PARTIALLY_FULFILLED': '⚠️'
-        }
-        return emoji_map.get(status, '📋')
+        return STATUS_EMOJI.get(status, '📋')
+
+
+STATUS_NAMES = {
+    'NEW': '🆕 Новый',
+    'WAITING_PAYMENT': '⏳ Ожидает оплаты',
+    'PAID': '✅ Оплачен',
+    'FULFILLING': '🚀 Выполняется',
+    'FULFILLED': '🎉 Выполнен',
+    'NEEDS_USERNAME': '❓ Нужен юзернейм',
+    'NEEDS_BALANCE': '💰 Ожидает пополнения',
+    'FAILED': '❌ Ошибка',
+    'PARTIALLY_FULFILLED': '⚠️ Частично выполнен',
+    'PARKED': '⏸ Отложен'
+}
+
+FULFILLMENT_STATUS_NAMES = {
+    'PENDING': '⏳ В ожидании',
+    'SUCCESS': '✅ Успешно',
+    'FAILED': '❌ Ошибка',
+    'PARTIAL': '⚠️ Частично'
+}
+
+STATUS_EMOJI = {
+    'NEW': '🆕',
+    'WAITING_PAYMENT': '⏳',
+    'PAID': '✅',
+    'FULFILLING': '🚀',
+    'FULFILLED': '🎉',
+    'NEEDS_USERNAME': '❓',
+    'NEEDS_BALANCE': '💰',
+    'FAILED': '❌',
+    'PARTIALLY_FULFILLED': '⚠️'
+}
+
+# Static texts depend only on config, so they are rendered once at import
+START_MESSAGE = MessageTemplates()._render_start_message()
+HELP_MESSAGE = MessageTemplates()._render_help_message()
+TERMS_MESSAGE = MessageTemplates()._render_terms_message()
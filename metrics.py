@@ -0,0 +1,187 @@
+"""
+Реестр метрик бота (счётчики, gauge и гистограммы) и их вывод в текстовом формате Prometheus
+"""
+
+import bisect
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, description: str = ''):
+        self.name = name
+        self.description = description
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels: Dict) -> Tuple:
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def get(self, **labels) -> float:
+        """Текущее значение для набора меток"""
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[Tuple[Dict, float]]:
+        """Все значения метрики в виде (метки, значение)"""
+        with self._lock:
+            return [(dict(key), value) for key, value in self._values.items()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, description: str = '', buckets: Tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, Dict] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                self._series[key] = series
+            # Счётчики по корзинам не накопительные, суммируются при выводе
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                series['counts'][index] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    def get(self, **labels) -> float:
+        """Количество наблюдений для набора меток"""
+        series = self._series.get(self._key(labels))
+        return series['count'] if series else 0
+
+    def samples(self) -> List[Tuple[Dict, Dict]]:
+        with self._lock:
+            return [(dict(key), {'counts': list(s['counts']), 'sum': s['sum'], 'count': s['count']})
+                    for key, s in self._series.items()]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, description: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, description, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError(f"Метрика {name} уже зарегистрирована как {metric.kind}")
+            return metric
+
+    def counter(self, name: str, description: str = '') -> Counter:
+        return self._get_or_create(Counter, name, description)
+
+    def gauge(self, name: str, description: str = '') -> Gauge:
+        return self._get_or_create(Gauge, name, description)
+
+    def histogram(self, name: str, description: str = '', buckets: Tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, description, buckets=buckets)
+
+    def register_collector(self, collector: Callable[[], None]):
+        """Функция, обновляющая метрики перед выводом (дорогие значения считаются только при запросе)"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                print(f"⚠️ Ошибка сбора метрик: {e}")
+
+        lines = []
+        for metric in sorted(self.all(), key=lambda m: m.name):
+            lines.append(f"# HELP {metric.name} {_escape_help(metric.description)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if isinstance(metric, Histogram):
+                for labels, series in metric.samples():
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets, series['counts']):
+                        cumulative += count
+                        lines.append(f"{metric.name}_bucket{_labels(labels, le=_number(bound))} {cumulative}")
+                    lines.append(f"{metric.name}_bucket{_labels(labels, le='+Inf')} {series['count']}")
+                    lines.append(f"{metric.name}_sum{_labels(labels)} {_number(series['sum'])}")
+                    lines.append(f"{metric.name}_count{_labels(labels)} {series['count']}")
+            else:
+                for labels, value in metric.samples():
+                    lines.append(f"{metric.name}{_labels(labels)} {_number(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def get(self, name: str) -> Optional[_Metric]:
+        return self._metrics.get(name)
+
+    def all(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+
+def _labels(labels: Dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    pairs = ','.join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# Глобальный реестр
+metrics = MetricsRegistry()
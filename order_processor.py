@@ -1,15 +1,24 @@
 import asyncio
+import hashlib
 from typing import Dict, List, Optional
 from datetime import datetime, timedelta
 
 from config import (
     OrderStatus, FulfillmentStatus, CURRENCY, PAYMENT_WAIT_MINUTES,
-    REMIND_EACH_MIN, FRAGMENT_MIN, FRAGMENT_MAX, MAX_RETRY, MAX_RETRY_VERIFY
+    REMIND_EACH_MIN, FRAGMENT_MIN, FRAGMENT_MAX, MAX_RETRY_VERIFY
 )
 from database import db
 from integrations import funpay, fragment, utils
+from balance_service import balance_service
+from retry_policy import payment_check_retry, transfer_retry
+from circuit_breaker import breakers, CircuitOpenError
+from outbox import notification
 from message_templates import MessageTemplates
 from logging_system import OrderLogger
+import tracing
+
+# Floor for re-probing a parked order, so a zero retry_in cannot turn into a busy loop
+PROBE_MIN_DELAY_SEC = 1
 
 class OrderProcessor:
     def __init__(self, notification_service):
@@ -17,6 +26,14 @@ class OrderProcessor:
         self.message_templates = MessageTemplates()
         self.order_logger = OrderLogger(notification_service)
         self.processing_orders = set()  # Prevent duplicate processing
+        
+        # Orders parked while an upstream breaker is open: {order_id: (chat_id, breaker_name)}
+        self.parked_orders: Dict[str, tuple] = {}
+        self._probe_tasks: Dict[str, asyncio.Task] = {}
+        self._resumed_tasks = set()
+        self._redriving = set()  # Parked orders being re-driven: re-parking them must not notify again
+        for breaker in breakers.values():
+            breaker.on_close(self.resume_parked)
     
     async def process_order(self, order_id: str, chat_id: int = None):
         """Main order processing method"""
@@ -26,14 +43,32 @@ class OrderProcessor:
         self.processing_orders.add(order_id)
         
         try:
+            # Every span below is correlated with this order in the trace file
+            with tracing.trace(order_id), tracing.span('order.process', order_id=order_id):
+                await self._process_order(order_id, chat_id)
+        finally:
+            self.processing_orders.discard(order_id)
+    
+    async def _process_order(self, order_id: str, chat_id: int = None):
+        try:
+            # Fail fast instead of scraping while FunPay is known to be down
+            breakers['funpay_read'].check()
+            
             # Step 1: Get order details
             order_data = await self._get_order_details(order_id)
             if not order_data:
                 await self._handle_error(order_id, "Order not found", chat_id)
                 return
             
+            # A username confirmed in the bot fills in a missing one from FunPay
+            if not self._validate_username(order_data.get('attached_telegram_username')):
+                saved = db.get_order(order_id)
+                if saved and self._validate_username(saved.get('attached_telegram_username')):
+                    order_data['attached_telegram_username'] = saved['attached_telegram_username']
+            
             # Save order to database
-            db.save_order(order_data)
+            with tracing.span('order.save'):
+                db.save_order(order_data)
             
             # Step 2: Check username
             if not self._validate_username(order_data.get('attached_telegram_username')):
@@ -46,26 +81,51 @@ class OrderProcessor:
                 await self._handle_waiting_payment(order_data, chat_id)
                 return
             
-            # Step 4: Check Fragment balance
-            balance = await fragment.get_balance()
+            # Step 4: Reserve stars against the cached Fragment balance
             stars_total = order_data['stars_amount_total']
+            breakers['fragment_transfer'].check()
+            
+            with tracing.span('order.reserve_balance', stars=stars_total):
+                reserved = await balance_service.try_reserve(order_id, stars_total)
+            if not reserved:
+                await self._handle_needs_balance(order_data, balance_service.snapshot(), chat_id)
+                return
             
-            if balance['stars_balance'] < stars_total:
-                await self._handle_needs_balance(order_data, balance, chat_id)
+            if not fragment.transfer_limiter.has_quota(stars_total):
+                balance_service.release(order_id)
+                await self._handle_needs_balance(
+                    order_data, balance_service.snapshot(), chat_id,
+                    reason=f"Дневной лимит переводов: осталось {fragment.transfer_limiter.remaining()} ⭐"
+                )
                 return
             
-            # Step 5: Process fulfillment
-            await self._process_fulfillment(order_data, chat_id)
+            try:
+                # Step 5: Final payment check right before stars are spent: always a fresh page,
+                # so a refund or cancellation since step 1 stops the transfer
+                with tracing.span('order.verify_payment'):
+                    payment_status = await funpay.verify_payment(order_id, force_refresh=True)
+                if not payment_status['paid']:
+                    await self._handle_waiting_payment(order_data, chat_id)
+                    return
+                
+                # Step 6: Process fulfillment
+                await self._process_fulfillment(order_data, chat_id)
+            finally:
+                # No-op when fulfillment already released the reservation
+                balance_service.release(order_id)
             
+        except CircuitOpenError as e:
+            await self._handle_parked(order_id, e, chat_id)
         except Exception as e:
             await self._handle_error(order_id, str(e), chat_id)
-        finally:
-            self.processing_orders.discard(order_id)
     
+    @tracing.traced('order.details')
     async def _get_order_details(self, order_id: str) -> Optional[Dict]:
         """Get order details from FunPay"""
         try:
             order_data = await funpay.get_order(order_id)
+            if not order_data:
+                return None
             
             # Get offer details to calculate total stars
             offers = await funpay.list_offers()
@@ -77,6 +137,9 @@ class OrderProcessor:
                 order_data['stars_amount_total'] = 0
             
             return order_data
+        except CircuitOpenError:
+            # FunPay is down, not the order missing: the caller parks it
+            raise
         except Exception as e:
             print(f"Error getting order details: {e}")
             return None
@@ -85,53 +148,70 @@ class OrderProcessor:
         """Validate Telegram username"""
         return utils.validate_username(username)
     
+    @tracing.traced('order.check_payment')
     async def _check_payment(self, order_id: str, retries: int = MAX_RETRY_VERIFY) -> Dict:
         """Check payment status with retries"""
-        for attempt in range(retries):
-            try:
-                payment_status = await funpay.verify_payment(order_id)
-                return payment_status
-            except Exception as e:
-                if attempt == retries - 1:
-                    raise e
-                await utils.sleep(1000 * (2 ** attempt))  # Exponential backoff
+        attempts = 0
         
-        return {'paid': False}
+        async def check():
+            nonlocal attempts
+            attempts += 1
+            # First attempt reuses the order page loaded in step 1, retries reload it
+            return await funpay.verify_payment(order_id, force_refresh=attempts > 1)
+        
+        return await payment_check_retry.run(check, max_attempts=retries)
+    
+    def _notifications(self, order_id: str, event: str, key: str, chat_id: int = None,
+                       user_message: str = None, admin_message: str = None, admin_meta: Dict = None) -> List[Dict]:
+        """Outbox rows for one order event; delivered by OutboxDispatcher, never awaited here.
+        The key must describe the state (not the time), so replays and re-drives are not sent twice"""
+        notifications = []
+        if chat_id and user_message:
+            notifications.append(notification(order_id, event, 'user', user_message, key, chat_id=chat_id))
+        if admin_message:
+            notifications.append(notification(order_id, event, 'admin', admin_message, key, meta=admin_meta))
+        return notifications
     
     async def _handle_needs_username(self, order_data: Dict, chat_id: int):
         """Handle case when username is missing or invalid"""
         order_id = order_data['order_id']
-        db.update_order_status(order_id, OrderStatus.NEEDS_USERNAME)
-        
-        if chat_id:
-            message = self.message_templates.needs_username(order_data)
-            await self.notification_service.notify_user(chat_id, message)
+        db.update_order_status(order_id, OrderStatus.NEEDS_USERNAME, self._notifications(
+            order_id, 'needs_username', order_data.get('attached_telegram_username') or 'missing', chat_id,
+            user_message=self.message_templates.needs_username(order_data)
+        ))
     
     async def _handle_waiting_payment(self, order_data: Dict, chat_id: int):
         """Handle waiting payment status"""
         order_id = order_data['order_id']
-        db.update_order_status(order_id, OrderStatus.WAITING_PAYMENT)
+        db.update_order_status(order_id, OrderStatus.WAITING_PAYMENT, self._notifications(
+            order_id, 'waiting_payment', 'unpaid', chat_id,
+            user_message=self.message_templates.waiting_payment(order_data)
+        ))
         
-        if chat_id:
-            message = self.message_templates.waiting_payment(order_data)
-            await self.notification_service.notify_user(chat_id, message)
+        # Next check must see the fresh payment state
+        funpay.invalidate_order(order_id)
     
-    async def _handle_needs_balance(self, order_data: Dict, balance: Dict, chat_id: int):
+    async def _handle_needs_balance(self, order_data: Dict, balance: Dict, chat_id: int, reason: str = None):
         """Handle insufficient balance"""
         order_id = order_data['order_id']
-        db.update_order_status(order_id, OrderStatus.NEEDS_BALANCE)
-        
-        # Notify user
-        if chat_id:
-            message = self.message_templates.needs_balance(order_data)
-            await self.notification_service.notify_user(chat_id, message)
         
-        # Notify admin
         admin_message = f"⚠️ Недостаточно баланса для заказа {order_id}\n"
         admin_message += f"Нужно: {order_data['stars_amount_total']} ⭐\n"
-        admin_message += f"Доступно: {balance['stars_balance']} ⭐"
-        await self.notification_service.notify_admin(admin_message)
+        admin_message += f"Доступно: {balance.get('available', balance['stars_balance'])} ⭐"
+        if balance.get('reserved'):
+            admin_message += f" (зарезервировано: {balance['reserved']} ⭐)"
+        if reason:
+            admin_message += f"\n{reason}"
+        
+        # Alert again only when the situation changes: new balance reading or another day's limit
+        key = f"limit:{datetime.now():%Y-%m-%d}" if reason else f"balance:{balance['stars_balance']}"
+        db.update_order_status(order_id, OrderStatus.NEEDS_BALANCE, self._notifications(
+            order_id, 'needs_balance', key, chat_id,
+            user_message=self.message_templates.needs_balance(order_data),
+            admin_message=admin_message, admin_meta={'urgent': True}
+        ))
     
+    @tracing.traced('order.fulfillment')
     async def _process_fulfillment(self, order_data: Dict, chat_id: int):
         """Process stars fulfillment"""
         order_id = order_data['order_id']
@@ -141,9 +221,10 @@ class OrderProcessor:
         # Check if already fulfilled
         existing_fulfillment = db.get_fulfillment_by_order(order_id)
         if existing_fulfillment and existing_fulfillment['status'] == FulfillmentStatus.SUCCESS:
-            if chat_id:
-                message = self.message_templates.fulfillment_success(order_data, existing_fulfillment)
-                await self.notification_service.notify_user(chat_id, message)
+            db.enqueue_notifications(self._notifications(
+                order_id, 'already_fulfilled', existing_fulfillment['fulfillment_id'], chat_id,
+                user_message=self.message_templates.fulfillment_success(order_data, existing_fulfillment)
+            ))
             return
         
         # Update order status
@@ -168,7 +249,8 @@ class OrderProcessor:
         successful_batches = []
         failed_batches = []
         
-        for i, batch_amount in enumerate(batches):
+        # Transfers are paced by fragment.transfer_limiter, no fixed delay between batches
+        for batch_amount in batches:
             try:
                 # Generate idempotency key
                 idempotency_key = utils.generate_idempotency_key(order_id, to_username, batch_amount)
@@ -177,6 +259,7 @@ class OrderProcessor:
                 result = await self._transfer_stars_with_retry(to_username, batch_amount, idempotency_key)
                 
                 if result['ok']:
+                    balance_service.record_sent(order_id, batch_amount)
                     successful_batches.append({
                         'amount': batch_amount,
                         'transfer_id': result['transfer_id'],
@@ -188,115 +271,194 @@ class OrderProcessor:
                         'error': result.get('error_message', 'Unknown error'),
                         'status': 'failed'
                     })
+                    balance_service.request_resync()
                 
-                # Small delay between batches
-                if i < len(batches) - 1:
-                    await utils.sleep(1000)
-                    
+            except CircuitOpenError as e:
+                if not successful_batches:
+                    # Nothing sent yet: park the whole order instead of failing it
+                    db.update_fulfillment_status(fulfillment_id, FulfillmentStatus.FAILED, {
+                        'batches': [],
+                        'notes': f"Parked: {e.breaker} circuit open"
+                    })
+                    raise
+                failed_batches.append({
+                    'amount': batch_amount,
+                    'error': str(e),
+                    'status': 'failed'
+                })
             except Exception as e:
                 failed_batches.append({
                     'amount': batch_amount,
                     'error': str(e),
                     'status': 'failed'
                 })
+                balance_service.request_resync()
         
         # Update fulfillment status
         all_batches = successful_batches + failed_batches
         total_sent = sum(batch['amount'] for batch in successful_batches)
+        balance_service.release(order_id)
         
         if failed_batches:
             if successful_batches:
                 # Partial fulfillment
                 status = FulfillmentStatus.PARTIAL
                 notes = f"Partial: {total_sent}/{stars_total} sent"
-                await self._handle_partial_fulfillment(order_data, total_sent, stars_total - total_sent, chat_id)
+                await self._handle_partial_fulfillment(order_data, total_sent, stars_total - total_sent, chat_id,
+                                                       fulfillment_id)
             else:
                 # Complete failure
                 status = FulfillmentStatus.FAILED
                 notes = f"Failed: {', '.join([b['error'] for b in failed_batches])}"
-                await self._handle_fulfillment_failure(order_data, failed_batches, chat_id)
+                await self._handle_fulfillment_failure(order_data, failed_batches, chat_id, fulfillment_id)
         else:
             # Complete success
             status = FulfillmentStatus.SUCCESS
             notes = f"Success: {total_sent} sent"
-            db.update_order_status(order_id, OrderStatus.FULFILLED)
-            await self._handle_fulfillment_success(order_data, chat_id)
         
         # Update fulfillment record
         db.update_fulfillment_status(fulfillment_id, status, {
             'batches': all_batches,
             'notes': notes
         })
+        
+        if status == FulfillmentStatus.SUCCESS:
+            await self._handle_fulfillment_success(order_data, chat_id, fulfillment_id)
+        
+        funpay.invalidate_order(order_id)
     
+    @tracing.traced('fulfillment.transfer')
     async def _transfer_stars_with_retry(self, to_username: str, stars_amount: int, idempotency_key: str) -> Dict:
         """Transfer stars with retry logic"""
-        for attempt in range(MAX_RETRY):
-            try:
-                result = await fragment.transfer_stars(to_username, stars_amount, idempotency_key)
-                
-                if result['ok']:
-                    return result
-                
-                # Check for rate limiting
-                if result.get('error_code') in ['rate_limited', 'daily_limit_exceeded']:
-                    wait_time = 1000 * (2 ** attempt)  # Exponential backoff
-                    await utils.sleep(wait_time)
-                    continue
-                
-                # For other errors, return immediately
-                return result
-                
-            except Exception as e:
-                if attempt == MAX_RETRY - 1:
-                    return {
-                        'ok': False,
-                        'error_message': str(e)
-                    }
-                wait_time = 1000 * (2 ** attempt)
-                await utils.sleep(wait_time)
-        
-        return {'ok': False, 'error_message': 'Max retries exceeded'}
+        try:
+            return await transfer_retry.run(
+                lambda: fragment.transfer_stars(to_username, stars_amount, idempotency_key)
+            )
+        except CircuitOpenError:
+            raise
+        except Exception as e:
+            return {
+                'ok': False,
+                'error_message': str(e)
+            }
     
-    async def _handle_fulfillment_success(self, order_data: Dict, chat_id: int):
+    async def _handle_fulfillment_success(self, order_data: Dict, chat_id: int, fulfillment_id: str):
         """Handle successful fulfillment"""
-        if chat_id:
-            message = self.message_templates.fulfillment_success(order_data)
-            await self.notification_service.notify_user(chat_id, message)
+        order_id = order_data['order_id']
+        db.update_order_status(order_id, OrderStatus.FULFILLED, self._notifications(
+            order_id, 'fulfilled', fulfillment_id, chat_id,
+            user_message=self.message_templates.fulfillment_success(order_data)
+        ))
         
         # Логирование выполненного заказа
-        fulfillment_data = db.get_fulfillment_by_order(order_data['order_id'])
+        fulfillment_data = db.get_fulfillment(fulfillment_id)
         if fulfillment_data:
             await self.order_logger.log_order_completion(order_data, fulfillment_data)
     
-    async def _handle_partial_fulfillment(self, order_data: Dict, sent: int, left: int, chat_id: int):
+    async def _handle_partial_fulfillment(self, order_data: Dict, sent: int, left: int, chat_id: int,
+                                          fulfillment_id: str):
         """Handle partial fulfillment"""
         order_id = order_data['order_id']
-        db.update_order_status(order_id, OrderStatus.PARTIALLY_FULFILLED)
-        
-        if chat_id:
-            message = self.message_templates.partial_fulfillment(order_data, sent, left)
-            await self.notification_service.notify_user(chat_id, message)
         
-        # Notify admin
         admin_message = f"⚠️ Частичная выдача заказа {order_id}\n"
         admin_message += f"Отправлено: {sent} ⭐\n"
         admin_message += f"Осталось: {left} ⭐"
-        await self.notification_service.notify_admin(admin_message)
+        
+        db.update_order_status(order_id, OrderStatus.PARTIALLY_FULFILLED, self._notifications(
+            order_id, 'partial', fulfillment_id, chat_id,
+            user_message=self.message_templates.partial_fulfillment(order_data, sent, left),
+            admin_message=admin_message,
+            admin_meta={'event': 'partial', 'urgent': True, 'order_id': order_id, 'stars': sent}
+        ))
     
-    async def _handle_fulfillment_failure(self, order_data: Dict, failed_batches: List[Dict], chat_id: int):
+    async def _handle_fulfillment_failure(self, order_data: Dict, failed_batches: List[Dict], chat_id: int,
+                                          fulfillment_id: str):
         """Handle fulfillment failure"""
         order_id = order_data['order_id']
-        db.update_order_status(order_id, OrderStatus.FAILED)
-        
-        if chat_id:
-            error_message = ', '.join([b['error'] for b in failed_batches])
-            message = self.message_templates.fulfillment_failure(order_data, error_message)
-            await self.notification_service.notify_user(chat_id, message)
+        error_message = ', '.join([b['error'] for b in failed_batches])
         
-        # Notify admin
         admin_message = f"❌ Ошибка выдачи заказа {order_id}\n"
-        admin_message += f"Ошибки: {', '.join([b['error'] for b in failed_batches])}"
-        await self.notification_service.notify_admin(admin_message)
+        admin_message += f"Ошибки: {error_message}"
+        
+        db.update_order_status(order_id, OrderStatus.FAILED, self._notifications(
+            order_id, 'failed', fulfillment_id, chat_id,
+            user_message=self.message_templates.fulfillment_failure(order_data, error_message),
+            admin_message=admin_message,
+            admin_meta={'event': 'failed', 'urgent': True, 'order_id': order_id}
+        ))
+    
+    async def _handle_parked(self, order_id: str, error: CircuitOpenError, chat_id: int):
+        """Park order until the open breaker recovers instead of burning retries"""
+        already_parked = order_id in self.parked_orders or order_id in self._redriving
+        self.parked_orders[order_id] = (chat_id, error.breaker)
+        
+        notifications = []
+        if not already_parked:
+            notifications = self._notifications(
+                order_id, 'parked', error.breaker, chat_id,
+                user_message=self.message_templates.order_parked(order_id),
+                admin_message=f"⏸ Заказ {order_id} отложен: breaker {error.breaker} разомкнут",
+                admin_meta={'event': 'parked', 'order_id': order_id}
+            )
+        db.update_order_status(order_id, OrderStatus.PARKED, notifications)
+        
+        self._schedule_probe(error.breaker, error.retry_in)
+    
+    def _schedule_probe(self, breaker_name: str, delay: float):
+        """Re-drive one parked order when the breaker turns half-open"""
+        task = self._probe_tasks.get(breaker_name)
+        if task and not task.done():
+            return
+        # A zero delay (half-open with someone else's probe in flight) would spin
+        delay = max(delay, PROBE_MIN_DELAY_SEC)
+        self._probe_tasks[breaker_name] = asyncio.create_task(self._probe_after(breaker_name, delay))
+    
+    async def _probe_after(self, breaker_name: str, delay: float):
+        await asyncio.sleep(delay)
+        self._probe_tasks.pop(breaker_name, None)
+        
+        parked = [order_id for order_id, (_, name) in self.parked_orders.items() if name == breaker_name]
+        if not parked:
+            return
+        
+        # Still open, or another caller's probe is in flight: wait instead of re-parking the order
+        breaker = breakers[breaker_name]
+        state = breaker.state
+        if state == breaker.OPEN or (state == breaker.HALF_OPEN and breaker.probe_in_flight):
+            self._schedule_probe(breaker_name, breaker.retry_in())
+            return
+        
+        # The first parked order is the single half-open probe
+        order_id = parked[0]
+        chat_id, _ = self.parked_orders.pop(order_id)
+        await self._redrive(order_id, chat_id)
+        
+        # Probe failed and reopened the breaker: try again later
+        if breaker.state != breaker.CLOSED and any(name == breaker_name for _, name in self.parked_orders.values()):
+            self._schedule_probe(breaker_name, breaker.retry_in())
+    
+    async def _redrive(self, order_id: str, chat_id: int):
+        """Process a parked order again; if it parks once more, the user is not told twice"""
+        self._redriving.add(order_id)
+        try:
+            await self.process_order(order_id, chat_id)
+        finally:
+            self._redriving.discard(order_id)
+    
+    def load_parked(self) -> List[tuple]:
+        """Orders a previous run left PARKED: [(order_id, chat_id)] to re-drive on startup"""
+        # parked_orders lives in memory only, while breakers start closed after a restart
+        return db.get_orders_with_chat(OrderStatus.PARKED)
+    
+    def resume_parked(self, breaker_name: str):
+        """Breaker closed: re-drive every order parked on it"""
+        for order_id, (chat_id, name) in list(self.parked_orders.items()):
+            if name != breaker_name:
+                continue
+            del self.parked_orders[order_id]
+            task = asyncio.create_task(self._redrive(order_id, chat_id))
+            self._resumed_tasks.add(task)
+            task.add_done_callback(self._resumed_tasks.discard)
     
     async def _handle_error(self, order_id: str, error_message: str, chat_id: int):
         """Handle general errors"""
@@ -305,13 +467,12 @@ class OrderProcessor:
         # Логирование ошибки
         self.order_logger.log_error(error_message, order_id)
         
-        if chat_id:
-            message = f"❌ Произошла ошибка при обработке заказа {order_id}:\n{error_message}"
-            await self.notification_service.notify_user(chat_id, message)
-        
-        # Notify admin
-        admin_message = f"❌ Ошибка обработки заказа {order_id}:\n{error_message}"
-        await self.notification_service.notify_admin(admin_message)
+        db.enqueue_notifications(self._notifications(
+            order_id, 'error', hashlib.sha256(error_message.encode()).hexdigest()[:16], chat_id,
+            user_message=f"❌ Произошла ошибка при обработке заказа {order_id}:\n{error_message}",
+            admin_message=f"❌ Ошибка обработки заказа {order_id}:\n{error_message}",
+            admin_meta={'event': 'failed', 'urgent': True, 'order_id': order_id}
+        ))
     
     async def check_pending_orders(self):
         """Check and process pending orders"""
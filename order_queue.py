@@ -0,0 +1,87 @@
+"""
+Очередь заказов на обработку: фиксированное число воркеров, повторный ID в очередь не попадает
+"""
+
+import asyncio
+import time
+from typing import Optional, Set
+
+from config import ORDER_WORKERS, ORDER_QUEUE_MAX
+from metrics import metrics
+
+order_jobs = metrics.counter('order_jobs_total', 'Заказы очереди по результату: queued/duplicate/rejected/done/error')
+order_queue_depth = metrics.gauge('order_queue_depth', 'Заказов в очереди на обработку')
+order_workers_busy = metrics.gauge('order_workers_busy', 'Воркеры, занятые заказом')
+order_workers_total = metrics.gauge('order_workers', 'Запущенные воркеры очереди заказов')
+order_job_wait_seconds = metrics.histogram('order_job_wait_seconds', 'Ожидание заказа в очереди до начала обработки')
+
+
+class OrderJobQueue:
+    def __init__(self, order_processor, workers: int = ORDER_WORKERS, maxsize: int = ORDER_QUEUE_MAX):
+        self.order_processor = order_processor
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: Optional[asyncio.Queue] = None
+        self._queued: Set[str] = set()
+        self._tasks = []
+
+    def __len__(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def submit(self, order_id: str, chat_id: int = None) -> bool:
+        """Постановка заказа в очередь; False, если он уже ждёт или очередь заполнена"""
+        self._ensure_started()
+        if order_id in self._queued:
+            order_jobs.inc(result='duplicate')
+            return False
+        try:
+            self._queue.put_nowait((order_id, chat_id, time.monotonic()))
+        except asyncio.QueueFull:
+            order_jobs.inc(result='rejected')
+            return False
+
+        self._queued.add(order_id)
+        order_jobs.inc(result='queued')
+        order_queue_depth.set(self._queue.qsize())
+        return True
+
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.maxsize)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            order_workers_total.set(self.workers)
+
+    async def start(self):
+        self._ensure_started()
+
+    async def stop(self, timeout: float = 30):
+        """Дообработка очереди при остановке, затем отмена воркеров"""
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"⚠️ Не обработано заказов из очереди: {self._queue.qsize()}")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        order_workers_total.set(0)
+
+    async def _worker(self):
+        while True:
+            order_id, chat_id, queued_at = await self._queue.get()
+            self._queued.discard(order_id)
+            order_queue_depth.set(self._queue.qsize())
+            order_job_wait_seconds.observe(time.monotonic() - queued_at)
+            order_workers_busy.inc()
+            try:
+                await self.order_processor.process_order(order_id, chat_id)
+                order_jobs.inc(result='done')
+            except Exception as e:
+                order_jobs.inc(result='error')
+                print(f"⚠️ Ошибка обработки заказа {order_id} из очереди: {e}")
+            finally:
+                order_workers_busy.dec()
+                self._queue.task_done()
@@ -0,0 +1,123 @@
+"""
+Outbox уведомлений: строки пишутся вместе со сменой статуса заказа, доставляются в фоне
+"""
+
+import asyncio
+import time
+from functools import partial
+from typing import Dict, List, Optional
+
+from config import OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL_SEC, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_DAYS
+from database import db
+from metrics import metrics
+import tracing
+
+outbox_deliveries = metrics.counter('outbox_deliveries_total', 'Уведомления outbox по результату: sent/dropped/retry/failed')
+outbox_inflight = metrics.gauge('outbox_inflight', 'Уведомления outbox, переданные в очередь Telegram')
+outbox_batch_seconds = metrics.histogram('outbox_batch_seconds', 'Длительность выборки пачки из outbox')
+
+# Потолок паузы между повторами доставки
+MAX_RETRY_DELAY_SEC = 300
+
+
+def notification(order_id: str, event: str, audience: str, text: str, key: str,
+                 chat_id: int = None, meta: Dict = None) -> Dict:
+    """Строка outbox; повторная запись с тем же ключом игнорируется (meta - аргументы notify_admin)"""
+    return {
+        'dedupe_key': f"{order_id}:{event}:{audience}:{key}",
+        'audience': audience,
+        'chat_id': chat_id,
+        'text': text,
+        'meta': meta or {}
+    }
+
+
+class OutboxDispatcher:
+    """Доставка at-least-once: строка помечается отправленной только после ответа Telegram"""
+
+    def __init__(self, notification_service, batch_size: int = OUTBOX_BATCH_SIZE,
+                 interval: float = OUTBOX_POLL_INTERVAL_SEC, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 retention_days: int = OUTBOX_RETENTION_DAYS):
+        self.notification_service = notification_service
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retention_days = retention_days
+
+        self._inflight: Dict[int, int] = {}  # {outbox_id: attempts до этой доставки}
+        self._results: List[tuple] = []  # [(outbox_id, result)] от очереди Telegram
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        db.prune_outbox(self.retention_days)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка выборки; недоставленное останется в базе до следующего запуска"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
+
+    async def _run(self):
+        while True:
+            try:
+                claimed = await self.dispatch_once()
+            except Exception as e:
+                print(f"⚠️ Ошибка доставки outbox: {e}")
+                claimed = 0
+            # Полная пачка - в базе, вероятно, есть ещё: забираем без паузы
+            if claimed < self.batch_size:
+                await asyncio.sleep(self.interval)
+
+    async def dispatch_once(self) -> int:
+        """Фиксация итогов прошлых доставок и передача новой пачки в очередь Telegram"""
+        self.flush()
+
+        start = time.monotonic()
+        rows = db.get_pending_outbox(self.batch_size, exclude=list(self._inflight))
+        outbox_batch_seconds.observe(time.monotonic() - start)
+
+        for row in rows:
+            self._inflight[row['id']] = row['attempts']
+            on_result = partial(self._on_result, row['id'])
+            # Спан доставки попадает в трассу заказа: ключ начинается с order_id
+            with tracing.trace(row['dedupe_key'].split(':', 1)[0]):
+                if row['audience'] == 'user':
+                    await self.notification_service.notify_user(row['chat_id'], row['text'], on_result=on_result)
+                else:
+                    await self.notification_service.notify_admin(row['text'], on_result=on_result, **row['meta'])
+
+        outbox_inflight.set(len(self._inflight))
+        return len(rows)
+
+    def _on_result(self, outbox_id: int, result: str):
+        self._results.append((outbox_id, result))
+
+    def flush(self):
+        """Запись итогов доставки в базу одной пачкой"""
+        if not self._results:
+            return
+        results, self._results = self._results, []
+
+        done = []
+        retries = []
+        for outbox_id, result in results:
+            attempts = self._inflight.pop(outbox_id, 0) + 1
+            if result == 'failed' and attempts < self.max_attempts:
+                retries.append((outbox_id, min(MAX_RETRY_DELAY_SEC, 2 ** attempts)))
+                outbox_deliveries.inc(result='retry')
+            else:
+                done.append((outbox_id, result))
+                outbox_deliveries.inc(result=result)
+
+        if done:
+            db.mark_outbox_sent(done)
+        if retries:
+            db.reschedule_outbox(retries)
+        outbox_inflight.set(len(self._inflight))
@@ -0,0 +1,202 @@
+"""
+Профилирование по запросу: сэмплирующий профайлер потока event loop (collapsed stacks для flamegraph)
+и монитор event loop - задержка, медленные колбэки, задачи по времени жизни
+"""
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import Counter, deque
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    LOOP_MONITOR_INTERVAL_SEC, LOOP_SLOW_CALLBACK_SEC, LOOP_DEBUG, PROFILE_SAMPLE_INTERVAL_SEC
+)
+from metrics import metrics
+
+event_loop_lag_seconds = metrics.histogram('event_loop_lag_seconds', 'Опоздание event loop относительно таймера')
+loop_slow_callbacks = metrics.counter('loop_slow_callbacks_total', 'Колбэки дольше LOOP_SLOW_CALLBACK_SEC (в debug-режиме)')
+
+
+class SamplingProfiler:
+    """Фоновый поток раз в interval снимает стек целевого потока через sys._current_frames"""
+
+    def __init__(self, interval: float = PROFILE_SAMPLE_INTERVAL_SEC, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.samples = 0
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self.thread_id is None:
+            self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[_collapse(frame)] += 1
+                self.samples += 1
+            del frame
+
+    def collapsed(self) -> str:
+        """Формат collapsed stacks (flamegraph.pl, speedscope): 'корень;...;лист количество'"""
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def top_functions(self, limit: int = 5) -> List[Tuple[str, int]]:
+        """Самые частые верхушки стека"""
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        return leaves.most_common(limit)
+
+
+def _collapse(frame) -> str:
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+async def profile(seconds: float, interval: float = PROFILE_SAMPLE_INTERVAL_SEC) -> SamplingProfiler:
+    """Профиль потока текущего event loop за seconds секунд"""
+    profiler = SamplingProfiler(interval)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.stop()
+    return profiler
+
+
+class _SlowCallbackHandler(logging.Handler):
+    """asyncio в debug-режиме пишет 'Executing <Handle> took N seconds' - сохраняем эти записи"""
+
+    def __init__(self, monitor: 'LoopMonitor'):
+        super().__init__(logging.WARNING)
+        self.monitor = monitor
+
+    def emit(self, record: logging.LogRecord):
+        if isinstance(record.msg, str) and record.msg.startswith('Executing') and len(record.args or ()) == 2:
+            handle, duration = record.args
+            self.monitor.slow_callbacks.append((time.time(), str(handle)[:200], float(duration)))
+            loop_slow_callbacks.inc()
+
+
+class LoopMonitor:
+    def __init__(self, interval: float = LOOP_MONITOR_INTERVAL_SEC, slow_callback: float = LOOP_SLOW_CALLBACK_SEC,
+                 debug: bool = LOOP_DEBUG, history: int = 1000):
+        self.interval = interval
+        self.slow_callback = slow_callback
+        self.debug = debug
+        self.lags: deque = deque(maxlen=history)
+        self.slow_callbacks: deque = deque(maxlen=50)
+        # Время жизни задач: у живых - с момента создания, у завершённых - сумма по корутине
+        self._started: 'weakref.WeakKeyDictionary[asyncio.Task, float]' = weakref.WeakKeyDictionary()
+        self.finished: Dict[str, List[float]] = {}  # {корутина: [количество, суммарно секунд, максимум]}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._previous_debug = False
+        self._task: Optional[asyncio.Task] = None
+        self._handler = _SlowCallbackHandler(self)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._previous_debug = self._loop.get_debug()
+        self._loop.slow_callback_duration = self.slow_callback
+        self.set_debug(self.debug)
+        logging.getLogger('asyncio').addHandler(self._handler)
+        if self._loop.get_task_factory() is None:
+            self._loop.set_task_factory(self._task_factory)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        logging.getLogger('asyncio').removeHandler(self._handler)
+        if self._loop:
+            self._loop.set_debug(self._previous_debug)
+            if self._loop.get_task_factory() == self._task_factory:
+                self._loop.set_task_factory(None)
+
+    def set_debug(self, enabled: bool):
+        """Debug-режим asyncio нужен для поиска медленных колбэков, но замедляет loop"""
+        self.debug = enabled
+        if self._loop:
+            self._loop.set_debug(enabled)
+
+    def _task_factory(self, loop, coro, context=None):
+        # Task принимает context только с Python 3.11
+        if context is None:
+            task = asyncio.Task(coro, loop=loop)
+        else:
+            task = asyncio.Task(coro, loop=loop, context=context)
+        self._started[task] = time.monotonic()
+        task.add_done_callback(self._on_task_done)
+        return task
+
+    def _on_task_done(self, task: asyncio.Task):
+        started = self._started.pop(task, None)
+        if started is None:
+            return
+        elapsed = time.monotonic() - started
+        stats = self.finished.setdefault(_coro_name(task), [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+    async def _run(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.monotonic() - expected)
+            self.lags.append(lag)
+            event_loop_lag_seconds.observe(lag)
+
+    def stats(self, limit: int = 5) -> Dict:
+        lags = sorted(self.lags)
+        now = time.monotonic()
+        running = sorted(((now - started, _coro_name(task)) for task, started in list(self._started.items())
+                          if not task.done()), reverse=True)
+        finished = sorted(self.finished.items(), key=lambda item: item[1][1], reverse=True)
+        lag = None
+        if lags:
+            lag = {
+                'last': self.lags[-1] * 1000,
+                'p50': lags[len(lags) // 2] * 1000,
+                'p99': lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000,
+                'max': lags[-1] * 1000,
+            }
+        return {
+            'lag_ms': lag,
+            'debug': self.debug,
+            'slow_callbacks': list(self.slow_callbacks)[-limit:],
+            'tasks': len(asyncio.all_tasks(self._loop)) if self._loop else 0,
+            'running': running[:limit],
+            'finished': [(name, int(count), total, longest) for name, (count, total, longest) in finished[:limit]],
+        }
+
+
+def _coro_name(task: asyncio.Task) -> str:
+    coro = task.get_coro()
+    return getattr(coro, '__qualname__', None) or type(coro).__name__
@@ -0,0 +1,237 @@
+"""
+Проактивные лимиты запросов: token bucket в секунду, суточная квота на аккаунт
+и скользящее окно для дорогих команд бота
+"""
+
+import asyncio
+import hashlib
+import time
+from datetime import datetime
+from typing import Dict, Hashable, Optional
+
+from config import (
+    FRAGMENT_TRANSFERS_PER_SEC, FRAGMENT_TRANSFER_BURST, FRAGMENT_DAILY_STARS_LIMIT,
+    FUNPAY_PAGE_LOADS_PER_SEC, FUNPAY_PAGE_LOAD_BURST, FUNPAY_DAILY_PAGE_LOADS,
+    FRAGMENT_PAGE_LOADS_PER_SEC, FRAGMENT_PAGE_LOAD_BURST,
+    COMMAND_RATE_WINDOW_SEC, COMMAND_USER_LIMIT, COMMAND_GLOBAL_LIMIT
+)
+from database import db
+from metrics import metrics
+
+rate_limit_wait_seconds = metrics.histogram('rate_limit_wait_seconds', 'Ожидание токена лимитера перед запросом')
+rate_limit_rejected = metrics.counter('rate_limit_rejected_total', 'Запросы, отклонённые суточной квотой')
+rate_limit_daily_used = metrics.gauge('rate_limit_daily_used', 'Израсходовано суточной квоты')
+command_rate_limited = metrics.counter('command_rate_limited_total', 'Команды, отклонённые лимитом (scope: user/global)')
+
+
+class RateLimitExceeded(Exception):
+    """Суточная квота исчерпана"""
+
+    def __init__(self, limiter: str, remaining: int):
+        super().__init__(f"Суточный лимит {limiter} исчерпан (осталось {remaining})")
+        self.limiter = limiter
+        self.remaining = remaining
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self) -> float:
+        """Ожидание ровно до появления токена; возвращает время ожидания"""
+        if self.rate <= 0:
+            return 0.0
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        # Очередь FIFO: следующий запрос ждёт, пока токен получит предыдущий
+        async with self._lock:
+            waited = 0.0
+            self._refill()
+            if self.tokens < 1:
+                waited = (1 - self.tokens) / self.rate
+                await asyncio.sleep(waited)
+                self._refill()
+            self.tokens -= 1
+            return waited
+
+    def drain(self):
+        """Сброс накопленных токенов: следующий запрос выждет полный интервал"""
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+
+class DailyQuota:
+    """Суточная квота с учётом расхода в SQLite (переживает перезапуск)"""
+
+    def __init__(self, key: str, limit: int):
+        self.key = key
+        self.limit = limit
+        self._day = None
+        self._used = 0
+
+    def _sync_day(self):
+        day = datetime.now().strftime('%Y-%m-%d')
+        if day != self._day:
+            self._day = day
+            self._used = db.get_rate_usage(self.key, day)
+
+    def used(self) -> int:
+        self._sync_day()
+        return self._used
+
+    def remaining(self) -> Optional[int]:
+        """Остаток на сегодня (None - без ограничения)"""
+        if not self.limit:
+            return None
+        return max(0, self.limit - self.used())
+
+    def has(self, units: int) -> bool:
+        remaining = self.remaining()
+        return remaining is None or remaining >= units
+
+    def consume(self, units: int):
+        self._sync_day()
+        self._used += units
+        db.add_rate_usage(self.key, self._day, units)
+
+
+class RateLimiter:
+    """Лимитер одного аккаунта внешнего сервиса"""
+
+    def __init__(self, name: str, account: str, rate: float, burst: float = 1, daily_limit: int = 0):
+        account_hash = hashlib.sha256((account or '').encode()).hexdigest()[:12]
+        self.name = name
+        self.key = f"{name}:{account_hash}"
+        self.bucket = TokenBucket(rate, burst)
+        self.quota = DailyQuota(self.key, daily_limit)
+
+    def has_quota(self, units: int = 1) -> bool:
+        return self.quota.has(units)
+
+    def remaining(self) -> Optional[int]:
+        return self.quota.remaining()
+
+    async def acquire(self, units: int = 1):
+        """Проверка суточной квоты и ожидание токена перед запросом"""
+        if not self.quota.has(units):
+            rate_limit_rejected.inc(limiter=self.name)
+            raise RateLimitExceeded(self.name, self.quota.remaining())
+
+        waited = await self.bucket.acquire()
+        rate_limit_wait_seconds.observe(waited, limiter=self.name)
+
+    def record(self, units: int = 1):
+        """Учёт успешно выполненного запроса в суточной квоте"""
+        if self.quota.limit:
+            self.quota.consume(units)
+            rate_limit_daily_used.set(self.quota.used(), limiter=self.name)
+
+    def penalize(self):
+        """Сервис ответил rate_limited: выдерживаем полный интервал перед следующим запросом"""
+        self.bucket.drain()
+
+
+class SlidingWindowLimiter:
+    """Не больше limit событий за window секунд на ключ (скользящее окно из двух счётчиков)"""
+
+    def __init__(self, limit: int, window: float):
+        self.limit = limit
+        self.window = window
+        self._windows: Dict[Hashable, list] = {}  # {key: [начало окна, в прошлом окне, в текущем]}
+        self._last_sweep = time.monotonic()
+
+    def _current(self, key: Hashable, now: float) -> list:
+        entry = self._windows.get(key)
+        if entry is None:
+            entry = self._windows[key] = [now - now % self.window, 0, 0]
+        elapsed_windows = int((now - entry[0]) // self.window)
+        if elapsed_windows == 1:
+            entry[:] = [entry[0] + self.window, entry[2], 0]
+        elif elapsed_windows > 1:
+            entry[:] = [now - now % self.window, 0, 0]
+        return entry
+
+    def hit(self, key: Hashable) -> float:
+        """Учёт события; 0 - разрешено, иначе через сколько секунд повторить"""
+        if self.limit <= 0:
+            return 0.0
+        now = time.monotonic()
+        self._sweep(now)
+
+        start, previous, current = self._current(key, now)
+        elapsed = now - start
+        weight = 1 - elapsed / self.window
+        if previous * weight + current < self.limit:
+            self._windows[key][2] += 1
+            return 0.0
+
+        # Когда взвешенная сумма опустится ниже лимита
+        if current < self.limit and previous:
+            return max(0.0, self.window * (1 - (self.limit - current) / previous) - elapsed)
+        return (self.window - elapsed) + self.window * (1 - self.limit / max(current, 1))
+
+    def _sweep(self, now: float):
+        # Ключи без событий за два окна больше ни на что не влияют
+        if now - self._last_sweep < self.window:
+            return
+        self._last_sweep = now
+        for key in [k for k, (start, _, _) in self._windows.items() if now - start >= 2 * self.window]:
+            del self._windows[key]
+
+
+class CommandRateLimiter:
+    """Лимит дорогих команд бота: на пользователя и на всех вместе"""
+
+    def __init__(self, user_limit: int = COMMAND_USER_LIMIT, global_limit: int = COMMAND_GLOBAL_LIMIT,
+                 window: float = COMMAND_RATE_WINDOW_SEC):
+        self.per_user = SlidingWindowLimiter(user_limit, window)
+        self.global_ = SlidingWindowLimiter(global_limit, window)
+
+    def check(self, command: str, user_id: int) -> float:
+        """0 - команду можно выполнять, иначе секунд до повтора"""
+        retry_in = self.per_user.hit((command, user_id))
+        if retry_in:
+            command_rate_limited.inc(command=command, scope='user')
+            return retry_in
+
+        retry_in = self.global_.hit(command)
+        if retry_in:
+            command_rate_limited.inc(command=command, scope='global')
+        return retry_in
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def _get_or_create(name: str, account: str, **kwargs) -> RateLimiter:
+    key = f"{name}:{account}"
+    if key not in _limiters:
+        _limiters[key] = RateLimiter(name, account, **kwargs)
+    return _limiters[key]
+
+
+def transfer_limiter(account: str) -> RateLimiter:
+    """Переводы Fragment: квота в звёздах в сутки"""
+    return _get_or_create('fragment_transfer', account, rate=FRAGMENT_TRANSFERS_PER_SEC,
+                          burst=FRAGMENT_TRANSFER_BURST, daily_limit=FRAGMENT_DAILY_STARS_LIMIT)
+
+
+def page_load_limiter(service: str, account: str) -> RateLimiter:
+    """Загрузки страниц браузером: квота в переходах в сутки"""
+    if service == 'funpay':
+        return _get_or_create('funpay_page_load', account, rate=FUNPAY_PAGE_LOADS_PER_SEC,
+                              burst=FUNPAY_PAGE_LOAD_BURST, daily_limit=FUNPAY_DAILY_PAGE_LOADS)
+    return _get_or_create(f'{service}_page_load', account, rate=FRAGMENT_PAGE_LOADS_PER_SEC,
+                          burst=FRAGMENT_PAGE_LOAD_BURST)
@@ -0,0 +1,127 @@
+"""
+Единая политика повторов: decorrelated jitter, общий дедлайн и глобальный бюджет повторов
+"""
+
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+from config import (
+    MAX_RETRY, MAX_RETRY_VERIFY, RETRY_BUDGET_CAPACITY, RETRY_BUDGET_REFILL_PER_SEC,
+    RETRY_MAX_DELAY_SEC, RETRY_MAX_ELAPSED_SEC, TRANSFER_RETRYABLE_CODES
+)
+from metrics import metrics
+from circuit_breaker import CircuitOpenError
+
+retry_attempts = metrics.counter('retry_attempts_total', 'Попытки под политикой повторов: retry/success/giveup')
+retry_giveups = metrics.counter('retry_giveups_total', 'Отказы от повторов по причинам: attempts/deadline/budget/fatal')
+retry_delay_seconds = metrics.histogram('retry_delay_seconds', 'Паузы перед повторами')
+
+
+class RetryBudget:
+    """Token bucket повторов, общий для всех политик: при массовом сбое повторы не лавинятся"""
+
+    def __init__(self, capacity: float = RETRY_BUDGET_CAPACITY,
+                 refill_per_sec: float = RETRY_BUDGET_REFILL_PER_SEC):
+        self.capacity = capacity
+        self.refill_per_sec = refill_per_sec
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_sec)
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class RetryPolicy:
+    def __init__(self, name: str, max_attempts: int, base_delay: float = 1.0,
+                 max_delay: float = RETRY_MAX_DELAY_SEC, max_elapsed: float = RETRY_MAX_ELAPSED_SEC,
+                 retry_if: Callable[[Exception], bool] = None,
+                 retryable_codes: Iterable[str] = (), budget: Optional[RetryBudget] = None):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.retry_if = retry_if or (lambda e: True)
+        self.retryable_codes = frozenset(retryable_codes)
+        self.budget = budget if budget is not None else retry_budget
+
+    def is_retryable_result(self, result: Any) -> bool:
+        """Результат вида {'ok': False, 'error_code': ...} повторяется только для известных кодов"""
+        return (isinstance(result, dict) and not result.get('ok', True)
+                and result.get('error_code') in self.retryable_codes)
+
+    def next_delay(self, previous: float) -> float:
+        """Decorrelated jitter: случайная пауза между base и 3x предыдущей, не больше max_delay"""
+        return min(self.max_delay, random.uniform(self.base_delay, max(self.base_delay, previous * 3)))
+
+    async def run(self, fn: Callable[[], Awaitable], max_attempts: int = None) -> Any:
+        """Вызов fn с повторами; после отказа пробрасывает последнее исключение или возвращает последний результат"""
+        max_attempts = max_attempts or self.max_attempts
+        started = time.monotonic()
+        delay = self.base_delay
+
+        for attempt in range(1, max_attempts + 1):
+            try:
+                result = await fn()
+            except Exception as e:
+                # Разомкнутый breaker - быстрый отказ, повторять его бессмысленно
+                if isinstance(e, CircuitOpenError) or not self.retry_if(e):
+                    self._give_up('fatal')
+                    raise
+                delay = await self._backoff(attempt, max_attempts, started, delay)
+                if delay is None:
+                    raise
+            else:
+                if not self.is_retryable_result(result):
+                    retry_attempts.inc(policy=self.name, outcome='success')
+                    return result
+                delay = await self._backoff(attempt, max_attempts, started, delay)
+                if delay is None:
+                    return result
+
+    async def _backoff(self, attempt: int, max_attempts: int, started: float,
+                       previous: float) -> Optional[float]:
+        """Пауза перед повтором; None - повторять нельзя"""
+        if attempt >= max_attempts:
+            self._give_up('attempts')
+            return None
+
+        delay = self.next_delay(previous)
+        if time.monotonic() - started + delay > self.max_elapsed:
+            self._give_up('deadline')
+            return None
+
+        if not self.budget.try_acquire():
+            self._give_up('budget')
+            return None
+
+        retry_attempts.inc(policy=self.name, outcome='retry')
+        retry_delay_seconds.observe(delay, policy=self.name)
+        await asyncio.sleep(delay)
+        return delay
+
+    def _give_up(self, reason: str):
+        retry_attempts.inc(policy=self.name, outcome='giveup')
+        retry_giveups.inc(policy=self.name, reason=reason)
+
+
+# Глобальный бюджет повторов
+retry_budget = RetryBudget()
+
+# Проверка оплаты на FunPay: любое исключение парсера временное
+payment_check_retry = RetryPolicy('funpay_payment_check', max_attempts=MAX_RETRY_VERIFY, base_delay=1.0)
+
+# Перевод звёзд: исключения и безопасные для повтора коды (до отправки формы)
+transfer_retry = RetryPolicy('fragment_transfer', max_attempts=MAX_RETRY, base_delay=1.0,
+                             retryable_codes=TRANSFER_RETRYABLE_CODES)
@@ -0,0 +1,182 @@
+"""
+Кэш стратегий поиска элементов: запоминает, какой селектор сработал на каждой странице
+"""
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+from selenium.webdriver.common.by import By
+
+from config import SELECTOR_STATS_PATH, SELECTOR_MIN_HIT_RATE
+from metrics import metrics
+
+selector_lookups = metrics.counter('selector_lookups_total', 'Поиск элементов по результату (primary/fallback/miss)')
+selector_hit_rate = metrics.gauge('selector_hit_rate', 'Доля поисков, где сработал первый кандидат')
+selector_degraded = metrics.counter('selector_degraded_total', 'Падения hit rate ниже порога (смена вёрстки)')
+
+Candidate = Tuple[str, str]
+
+
+class SelectorResolver:
+    def __init__(self, stats_path: str = SELECTOR_STATS_PATH, implicit_wait: float = 10,
+                 min_hit_rate: float = SELECTOR_MIN_HIT_RATE, window: int = 50, min_samples: int = 10):
+        self.stats_path = stats_path
+        self.implicit_wait = implicit_wait
+        self.min_hit_rate = min_hit_rate
+        self.min_samples = min_samples
+        self.window = window
+
+        # {"page:key": {"winner": "css selector=...", "selectors": {"css selector=...": {"hits": 0, "misses": 0}}}}
+        self.stats: Dict[str, Dict] = {}
+        self._recent: Dict[str, deque] = {}
+        self._degraded = set()
+        self._unsaved = 0
+
+        self.load()
+
+    @staticmethod
+    def split_css(css: str) -> List[Candidate]:
+        """Разбивает CSS со списком альтернатив через запятую на отдельных кандидатов"""
+        return [(By.CSS_SELECTOR, part.strip()) for part in css.split(',') if part.strip()]
+
+    @staticmethod
+    def _selector_id(candidate: Candidate) -> str:
+        by, value = candidate
+        return f"{by}={value}"
+
+    def ordered(self, page_type: str, key: str, candidates: List[Candidate]) -> List[Candidate]:
+        """Кандидаты в порядке попыток: последний сработавший первым, затем по числу попаданий"""
+        entry = self.stats.get(f"{page_type}:{key}")
+        if not entry:
+            return list(candidates)
+
+        winner = entry.get('winner')
+        selectors = entry.get('selectors', {})
+
+        def rank(item):
+            position, candidate = item
+            selector_id = self._selector_id(candidate)
+            hits = selectors.get(selector_id, {}).get('hits', 0)
+            return (selector_id != winner, -hits, position)
+
+        return [candidate for _, candidate in sorted(enumerate(candidates), key=rank)]
+
+    async def find(self, driver, page_type: str, key: str, candidates: List[Candidate],
+                   predicate: Optional[Callable] = None, timeout: float = 0,
+                   poll: float = 0.25, required: bool = True):
+        """Поиск элемента без implicit wait: перебор кандидатов с опросом до таймаута"""
+        ordered = self.ordered(page_type, key, candidates)
+        deadline = time.monotonic() + timeout
+
+        driver.implicitly_wait(0)
+        try:
+            while True:
+                for position, candidate in enumerate(ordered):
+                    element = self._try_candidate(driver, candidate, predicate)
+                    if element is not None:
+                        self._record(page_type, key, ordered[:position], candidate, required)
+                        return element
+
+                if time.monotonic() >= deadline:
+                    break
+                await asyncio.sleep(poll)
+        finally:
+            driver.implicitly_wait(self.implicit_wait)
+
+        self._record(page_type, key, ordered, None, required)
+        return None
+
+    def _try_candidate(self, driver, candidate: Candidate, predicate: Optional[Callable]):
+        """Одна попытка поиска по кандидату"""
+        try:
+            for element in driver.find_elements(*candidate):
+                if predicate is None or predicate(element):
+                    return element
+        except Exception:
+            pass
+        return None
+
+    def _record(self, page_type: str, key: str, missed: List[Candidate],
+                matched: Optional[Candidate], required: bool):
+        """Обновление статистики после поиска"""
+        stat_key = f"{page_type}:{key}"
+        entry = self.stats.setdefault(stat_key, {'winner': None, 'selectors': {}})
+        selectors = entry['selectors']
+
+        for candidate in missed:
+            selector = selectors.setdefault(self._selector_id(candidate), {'hits': 0, 'misses': 0})
+            selector['misses'] += 1
+
+        if matched is not None:
+            matched_id = self._selector_id(matched)
+            selector = selectors.setdefault(matched_id, {'hits': 0, 'misses': 0})
+            selector['hits'] += 1
+            result = 'fallback' if missed else 'primary'
+
+            if entry['winner'] != matched_id:
+                entry['winner'] = matched_id
+                self._unsaved = self.window  # смена победителя сохраняется сразу
+        else:
+            result = 'miss'
+
+        selector_lookups.inc(page_type=page_type, key=key, result=result)
+        if required:
+            self._update_hit_rate(page_type, key, result == 'primary')
+
+        self._unsaved += 1
+        if self._unsaved >= self.window:
+            self.save()
+
+    def _update_hit_rate(self, page_type: str, key: str, primary_hit: bool):
+        """Скользящий hit rate и сигнал о деградации"""
+        stat_key = f"{page_type}:{key}"
+        recent = self._recent.setdefault(stat_key, deque(maxlen=self.window))
+        recent.append(primary_hit)
+
+        hit_rate = sum(recent) / len(recent)
+        selector_hit_rate.set(hit_rate, page_type=page_type, key=key)
+
+        if len(recent) < self.min_samples:
+            return
+
+        if hit_rate < self.min_hit_rate:
+            if stat_key not in self._degraded:
+                self._degraded.add(stat_key)
+                selector_degraded.inc(page_type=page_type, key=key)
+                print(f"⚠️ Селекторы {stat_key} деградировали: hit rate {hit_rate:.0%}. Возможно, изменилась вёрстка")
+        else:
+            self._degraded.discard(stat_key)
+
+    def hit_rate(self, page_type: str, key: str) -> Optional[float]:
+        """Текущий скользящий hit rate"""
+        recent = self._recent.get(f"{page_type}:{key}")
+        if not recent:
+            return None
+        return sum(recent) / len(recent)
+
+    def load(self):
+        """Загрузка статистики с диска"""
+        if not self.stats_path or not os.path.exists(self.stats_path):
+            return
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                self.stats = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить статистику селекторов: {e}")
+            self.stats = {}
+
+    def save(self):
+        """Атомарное сохранение статистики на диск"""
+        self._unsaved = 0
+        if not self.stats_path:
+            return
+        try:
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.stats, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.stats_path)
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить статистику селекторов: {e}")
@@ -0,0 +1,119 @@
+"""
+Хранилище сессий браузера: профили Chrome и cookie по аккаунтам
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+from typing import Dict, List, Optional
+
+from config import SESSION_DIR, SESSION_REFRESH_INTERVAL_MIN, SESSION_REFRESH_BEFORE_MIN
+
+
+class SessionStore:
+    def __init__(self, base_dir: str = SESSION_DIR):
+        self.base_dir = base_dir
+
+    def _account_dir(self, service: str, account: str) -> str:
+        """Каталог аккаунта (логин/телефон хранится только в виде хэша)"""
+        account_hash = hashlib.sha256(account.encode()).hexdigest()[:12]
+        path = os.path.join(self.base_dir, f"{service}_{account_hash}")
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def profile_dir(self, service: str, account: str) -> str:
+        """Каталог user-data-dir Chrome для аккаунта"""
+        path = os.path.join(self._account_dir(service, account), 'profile')
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        return path
+
+    def _cookie_path(self, service: str, account: str) -> str:
+        return os.path.join(self._account_dir(service, account), 'cookies.json')
+
+    def save_cookies(self, service: str, account: str, cookies: List[Dict]):
+        """Сохранение cookie jar (атомарно, с правами только для владельца)"""
+        path = self._cookie_path(service, account)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': time.time(), 'cookies': cookies}, f)
+        os.chmod(tmp_path, 0o600)
+        os.replace(tmp_path, path)
+
+    def _read(self, service: str, account: str) -> Optional[Dict]:
+        path = self._cookie_path(service, account)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось прочитать cookie {service}: {e}")
+            return None
+
+    def load_cookies(self, service: str, account: str) -> List[Dict]:
+        """Загрузка cookie без истёкших"""
+        data = self._read(service, account)
+        if not data:
+            return []
+        now = time.time()
+        return [cookie for cookie in data.get('cookies', [])
+                if not cookie.get('expiry') or cookie['expiry'] > now]
+
+    def needs_refresh(self, service: str, account: str,
+                      before_seconds: float = SESSION_REFRESH_BEFORE_MIN * 60) -> bool:
+        """Пора ли продлевать сессию: cookie скоро истекут или давно не обновлялись"""
+        data = self._read(service, account)
+        if not data:
+            return True
+
+        now = time.time()
+        if now - data.get('saved_at', 0) >= before_seconds:
+            return True
+
+        expiries = [cookie['expiry'] for cookie in data.get('cookies', []) if cookie.get('expiry')]
+        return bool(expiries) and min(expiries) - now < before_seconds
+
+    def clear(self, service: str, account: str):
+        """Удаление сохранённых cookie (например, после выхода из аккаунта)"""
+        path = self._cookie_path(service, account)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class SessionKeeper:
+    """Проверка сессий при старте и фоновое продление до истечения"""
+
+    def __init__(self, parsers: List, interval_seconds: float = SESSION_REFRESH_INTERVAL_MIN * 60):
+        self.parsers = parsers
+        self.interval_seconds = interval_seconds
+        self._task = None
+
+    async def start(self):
+        """Восстановление сохранённых сессий и запуск фонового продления"""
+        for parser in self.parsers:
+            try:
+                await parser.restore_session()
+            except Exception as e:
+                print(f"⚠️ Не удалось восстановить сессию {type(parser).__name__}: {e}")
+
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            for parser in self.parsers:
+                try:
+                    await parser.refresh_session()
+                except Exception as e:
+                    print(f"⚠️ Ошибка продления сессии {type(parser).__name__}: {e}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,88 @@
+"""
+Состояния диалога пользователей: LRU-кэш с TTL поверх таблицы user_states (write-through)
+"""
+
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from config import USER_STATE_TTL_SEC, USER_STATE_MAX_ENTRIES
+from database import db
+from metrics import metrics
+
+user_state_lookups = metrics.counter('user_state_lookups_total', 'Чтения состояний: hit/miss/cached_miss/expired')
+user_state_cache_size = metrics.gauge('user_state_cache_size', 'Состояний в памяти')
+
+
+class UserStateStore:
+    """Запись сразу идёт в SQLite, поэтому вытеснение из памяти и перезапуск не теряют диалог.
+    Отсутствие состояния тоже кэшируется (state=None), чтобы обычные сообщения не читали базу"""
+
+    def __init__(self, ttl: float = USER_STATE_TTL_SEC, max_entries: int = USER_STATE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._cache: 'OrderedDict[int, tuple]' = OrderedDict()  # {user_id: (state или None, expires_at)}
+
+    def __len__(self):
+        return len(self._cache)
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        """Состояние пользователя или None, если его нет или оно истекло"""
+        now = time.time()
+        entry = self._cache.get(user_id)
+        if entry is not None and entry[0] is None and entry[1] <= now:
+            # Истёкшая отметка «состояния нет»: перечитываем базу
+            del self._cache[user_id]
+            entry = None
+
+        if entry is None:
+            entry = db.get_user_state(user_id)
+            if entry is None:
+                user_state_lookups.inc(result='miss')
+                self._remember_missing(user_id, now)
+                return None
+            self._remember(user_id, entry)
+        else:
+            self._cache.move_to_end(user_id)
+
+        state, expires_at = entry
+        if state is None:
+            user_state_lookups.inc(result='cached_miss')
+            return None
+        if expires_at <= now:
+            user_state_lookups.inc(result='expired')
+            self.delete(user_id)
+            return None
+
+        user_state_lookups.inc(result='hit')
+        return dict(state)
+
+    def set(self, user_id: int, state: Dict):
+        """Сохранение состояния; TTL отсчитывается заново"""
+        expires_at = time.time() + self.ttl
+        db.save_user_state(user_id, state, expires_at)
+        self._remember(user_id, (dict(state), expires_at))
+
+    def delete(self, user_id: int):
+        db.delete_user_state(user_id)
+        self._remember_missing(user_id, time.time())
+
+    def prune(self) -> int:
+        """Удаление истёкших состояний из памяти и базы"""
+        now = time.time()
+        for user_id in [uid for uid, (_, expires_at) in self._cache.items() if expires_at <= now]:
+            del self._cache[user_id]
+        user_state_cache_size.set(len(self._cache))
+        return db.prune_user_states(now)
+
+    def _remember_missing(self, user_id: int, now: float):
+        # Все записи идут через этот объект, поэтому отметка верна до set(); TTL лишь ограничивает её жизнь
+        self._remember(user_id, (None, now + self.ttl))
+
+    def _remember(self, user_id: int, entry: tuple):
+        self._cache[user_id] = entry
+        self._cache.move_to_end(user_id)
+        # Сверх лимита из памяти уходят давно не использованные, в базе они остаются
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+        user_state_cache_size.set(len(self._cache))
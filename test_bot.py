@@ -182,7 +182,7 @@ async def test_order_processor():
         async def notify_user(self, chat_id, message):
             print(f"📱 Уведомление пользователю {chat_id}: {message[:50]}...")
         
-        async def notify_admin(self, message):
+        async def notify_admin(self, message, **kwargs):
             print(f"👨‍💼 Уведомление админу: {message[:50]}...")
     
     from order_processor import OrderProcessor
@@ -194,6 +194,923 @@ async def test_order_processor():
         print("✅ Обработка заказа завершена")
     except Exception as e:
         print(f"❌ Ошибка обработки заказа: {e}")
+    
+    # Последняя проверка оплаты перед переводом всегда читает страницу заново
+    from unittest.mock import patch
+    checks = []
+    original_verify = funpay.verify_payment
+    
+    async def recording_verify(order_id, **kwargs):
+        checks.append(kwargs)
+        return await original_verify(order_id, **kwargs)
+    
+    with patch.object(funpay, 'verify_payment', recording_verify):
+        await processor.process_order('test_order_recheck', 123456789)
+    assert checks and checks[-1].get('force_refresh') is True, checks
+    print("✅ Оплата перепроверяется по свежей странице перед выдачей")
+
+async def test_balance_service():
+    """Тест кэша баланса и резервов"""
+    print("\n🧪 Тестирование резервов баланса...")
+    
+    from balance_service import BalanceService
+    
+    class FakeFragment:
+        def __init__(self):
+            self.reads = 0
+            self.balance = 1000
+        
+        async def get_balance(self):
+            self.reads += 1
+            return {'stars_balance': self.balance, 'daily_limit_left': 5000 if self.balance else 0}
+    
+    fake = FakeFragment()
+    service = BalanceService(fake, refresh_interval=3600, max_age=3600)
+    
+    assert await service.try_reserve('order_a', 600)
+    assert not await service.try_reserve('order_b', 600), "Резерв сверх доступного"
+    assert await service.try_reserve('order_a', 600), "Повторный резерв того же заказа"
+    assert fake.reads == 1, "Баланс должен читаться один раз"
+    assert service.available() == 400
+    
+    # Первый батч отправлен, затем фоновое чтение уже видит его на странице
+    service.record_sent('order_a', 200)
+    assert service.reservations['order_a'] == 400 and service.available() == 400
+    fake.balance = 800
+    await service.refresh('background')
+    assert service.available() == 400, "Отправленный батч не должен учитываться дважды"
+    service.record_sent('order_a', 400)
+    service.release('order_a')
+    assert service.reserved == 0 and service.available() == 400
+    fake.balance = 1000
+    
+    assert await service.try_reserve('order_b', 300)
+    service.release('order_b')
+    assert service.available() == 400
+    
+    service.request_resync()
+    await service.ensure_fresh()
+    assert fake.reads == 3 and service.available() == 1000
+    
+    # Сбой чтения (нули) не затирает известный баланс и оставляет его устаревшим
+    fake.balance = 0
+    await service.refresh('background')
+    assert service.available() == 1000 and service.stale
+    print("✅ Доступно = баланс - резервы, ресинк после ошибки")
+
+async def test_http_client():
+    """Тест общего HTTP-клиента на локальном aiohttp-сервере"""
+    print("\n🧪 Тестирование HTTP-клиента...")
+    
+    from aiohttp import web
+    from http_client import HttpClient, HttpError
+    
+    peers = set()
+    calls = {'flaky': 0}
+    
+    async def handle_balance(request):
+        peers.add(request.transport.get_extra_info('peername'))
+        assert request.headers['Authorization'] == 'Bearer test-key'
+        assert 'gzip' in request.headers.get('Accept-Encoding', '')
+        response = web.json_response({'stars_balance': 1000, 'padding': 'x' * 2048})
+        response.enable_compression()
+        return response
+    
+    async def handle_flaky(request):
+        calls['flaky'] += 1
+        if calls['flaky'] == 1:
+            return web.Response(status=503)
+        return web.json_response({'ok': True, 'echo': await request.json()})
+    
+    async def handle_missing(request):
+        return web.Response(status=404)
+    
+    app = web.Application()
+    app.router.add_get('/balance', handle_balance)
+    app.router.add_post('/transfer', handle_flaky)
+    app.router.add_get('/missing', handle_missing)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    base_url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    
+    client = HttpClient(limit_per_host=2)
+    original = (fragment.api_url, fragment.api_key)
+    try:
+        await client.start()
+        headers = {'Authorization': 'Bearer test-key'}
+        for _ in range(5):
+            data = await client.request_json('GET', f"{base_url}/balance", headers=headers)
+            assert data['stars_balance'] == 1000
+        assert len(peers) == 1, "Соединение должно переиспользоваться (keep-alive)"
+        print("✅ Keep-alive и gzip работают")
+        
+        data = await client.request_json('POST', f"{base_url}/transfer", json={'amount': 50})
+        assert data['echo'] == {'amount': 50} and calls['flaky'] == 2
+        print("✅ Повтор после 5xx")
+        
+        try:
+            await client.request_json('GET', f"{base_url}/missing")
+            assert False, "404 не должен повторяться"
+        except HttpError as e:
+            assert e.status == 404
+        
+        # Интеграции ходят через общий клиент
+        fragment.api_url, fragment.api_key = base_url, 'test-key'
+        data = await fragment._make_request('GET', '/balance')
+        assert data['stars_balance'] == 1000
+        print("✅ FragmentAPI использует общий пул соединений")
+    finally:
+        fragment.api_url, fragment.api_key = original
+        await client.close()
+        from http_client import http_client
+        await http_client.close()
+        await runner.cleanup()
+
+async def test_retry_policy():
+    """Тест политики повторов"""
+    print("\n🧪 Тестирование политики повторов...")
+    
+    from retry_policy import RetryPolicy, RetryBudget
+    
+    budget = RetryBudget(capacity=100, refill_per_sec=0)
+    calls = []
+    
+    async def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ConnectionError("temporary")
+        return 'ok'
+    
+    policy = RetryPolicy('test', max_attempts=5, base_delay=0.001, max_delay=0.01, budget=budget)
+    assert await policy.run(flaky) == 'ok' and len(calls) == 3
+    delays = [policy.next_delay(0.004) for _ in range(50)]
+    assert all(0.001 <= d <= 0.01 for d in delays) and len(set(delays)) > 1, "Нужен jitter"
+    print("✅ Повтор с jitter до успеха")
+    
+    # Результаты с кодом ошибки: повторяются только известные коды
+    results = iter([{'ok': False, 'error_code': 'rate_limited'}, {'ok': False, 'error_code': 'transfer_failed'}])
+    policy = RetryPolicy('test_codes', max_attempts=5, base_delay=0.001, budget=budget,
+                         retryable_codes=['rate_limited'])
+    result = await policy.run(lambda: asyncio.sleep(0, next(results)))
+    assert result['error_code'] == 'transfer_failed'
+    
+    # Неповторяемое исключение пробрасывается сразу
+    calls.clear()
+    policy = RetryPolicy('test_fatal', max_attempts=5, base_delay=0.001, budget=budget,
+                         retry_if=lambda e: not isinstance(e, ValueError))
+    async def fatal():
+        calls.append(1)
+        raise ValueError("bad input")
+    try:
+        await policy.run(fatal)
+        assert False
+    except ValueError:
+        assert len(calls) == 1
+    
+    # Дедлайн и исчерпанный бюджет останавливают повторы
+    async def always_fail():
+        calls.append(1)
+        raise ConnectionError("down")
+    for policy in (RetryPolicy('test_deadline', max_attempts=100, base_delay=0.05, max_elapsed=0.01, budget=budget),
+                   RetryPolicy('test_budget', max_attempts=100, base_delay=0.001,
+                               budget=RetryBudget(capacity=2, refill_per_sec=0))):
+        calls.clear()
+        try:
+            await policy.run(always_fail)
+            assert False
+        except ConnectionError:
+            pass
+        assert len(calls) <= 3, f"{policy.name}: {len(calls)} попыток"
+    print("✅ Коды ошибок, дедлайн и бюджет повторов")
+
+async def test_circuit_breaker():
+    """Тест circuit breaker и парковки заказов"""
+    print("\n🧪 Тестирование circuit breaker...")
+    
+    from circuit_breaker import CircuitBreaker, CircuitOpenError, breakers
+    from database import order_status_changes
+    
+    closed = []
+    breaker = CircuitBreaker('test', failure_rate=0.5, min_calls=2, window=4, open_seconds=0.05,
+                             is_failure=lambda result: result is None)
+    breaker.on_close(closed.append)
+    
+    async def down():
+        return None
+    
+    await breaker.call(down)
+    await breaker.call(down)
+    assert breaker.state == breaker.OPEN
+    try:
+        await breaker.call(down)
+        assert False, "Разомкнутый breaker должен отказывать сразу"
+    except CircuitOpenError as e:
+        assert e.breaker == 'test'
+    
+    await asyncio.sleep(0.06)
+    assert breaker.state == breaker.HALF_OPEN
+    
+    # В HALF_OPEN проходит ровно один пробный запрос
+    release = asyncio.Event()
+    async def slow_ok():
+        await release.wait()
+        return 'ok'
+    probe = asyncio.create_task(breaker.call(slow_ok))
+    await asyncio.sleep(0)
+    try:
+        await breaker.call(slow_ok)
+        assert False, "Второй запрос в HALF_OPEN должен отклоняться"
+    except CircuitOpenError:
+        pass
+    release.set()
+    assert await probe == 'ok'
+    assert breaker.state == breaker.CLOSED and closed == ['test']
+    print("✅ Размыкание, быстрый отказ и пробный запрос")
+    
+    # Заказ паркуется, пока breaker перевода разомкнут, и продолжается после восстановления
+    notifications = []
+    
+    class MockNotificationService:
+        async def notify_user(self, chat_id, message):
+            notifications.append(message)
+        
+        async def notify_admin(self, message, **kwargs):
+            notifications.append(message)
+    
+    from order_processor import OrderProcessor
+    processor = OrderProcessor(MockNotificationService())
+    transfer_breaker = breakers['fragment_transfer']
+    transfer_breaker._open()
+    try:
+        await processor.process_order('test_order_parked', 123456789)
+        assert db.get_order('test_order_parked')['status'] == OrderStatus.PARKED
+        assert 'test_order_parked' in processor.parked_orders
+        assert db.get_fulfillment_by_order('test_order_parked') is None, "До выдачи дойти не должно"
+        
+        # Успешная проба замыкает breaker и запускает отложенные заказы
+        transfer_breaker._record(True, probe=True)
+        await asyncio.gather(*processor._resumed_tasks)
+        assert db.get_order('test_order_parked')['status'] == OrderStatus.FULFILLED
+        assert not processor.parked_orders
+        print("✅ Заказ отложен и выполнен после восстановления")
+        
+        # HALF_OPEN с чужой пробой в полёте: отложенный заказ ждёт, а не паркуется заново по кругу
+        transfer_breaker._open()
+        await processor.process_order('test_order_parked_spin', 123456789)
+        transfer_breaker._opened_at -= transfer_breaker.open_seconds
+        transfer_breaker._probe_in_flight = True
+        parked_changes = order_status_changes.get(status=OrderStatus.PARKED)
+        await processor._probe_after('fragment_transfer', 0)
+        await asyncio.sleep(0.05)
+        assert 'test_order_parked_spin' in processor.parked_orders
+        assert order_status_changes.get(status=OrderStatus.PARKED) == parked_changes, "Повторная парковка"
+        assert not processor._probe_tasks['fragment_transfer'].done(), "Проба перенесена, а не выполнена сразу"
+        transfer_breaker._probe_in_flight = False
+        print("✅ Чужая проба в полёте: повторной парковки и уведомлений нет")
+        
+        # Breaker чтения FunPay разомкнут посреди получения заказа: заказ паркуется, а не «не найден»
+        read_breaker = breakers['funpay_read']
+        original_check = read_breaker.check
+        read_checks = []
+        
+        def open_after_first_check():
+            # Быстрая проверка в начале обработки проходит, вызов парсера уже отклоняется
+            read_checks.append(1)
+            if len(read_checks) > 1:
+                original_check()
+        
+        read_breaker.check = open_after_first_check
+        read_breaker._open()
+        try:
+            await processor.process_order('test_order_parked_read', 123456789)
+            assert len(read_checks) > 1, "Вызов должен дойти до breaker чтения"
+            assert processor.parked_orders.get('test_order_parked_read') == (123456789, 'funpay_read')
+        finally:
+            del read_breaker.check
+            processor.parked_orders.pop('test_order_parked_read', None)
+            read_breaker._record(True, probe=True)
+        print("✅ Разомкнутый breaker FunPay паркует заказ вместо ошибки «не найден»")
+        
+        # Прайс во время сбоя не подменяется стандартными офферами
+        funpay._flight.forget('list_offers')
+        read_breaker._open()
+        try:
+            await funpay.list_offers()
+            assert False, "Разомкнутый breaker должен дойти до вызывающего"
+        except CircuitOpenError:
+            pass
+        finally:
+            read_breaker._record(True, probe=True)
+        print("✅ list_offers не выдаёт запасные офферы при разомкнутом breaker")
+        
+        # После перезапуска отложенные заказы находятся в базе вместе с чатом покупателя
+        restarted = OrderProcessor(MockNotificationService())
+        assert ('test_order_parked_spin', 123456789) in restarted.load_parked()
+        assert all(order_id != 'test_order_parked' for order_id, _ in restarted.load_parked())
+        print("✅ Отложенные заказы восстанавливаются из базы после перезапуска")
+    finally:
+        for task in processor._probe_tasks.values():
+            task.cancel()
+        transfer_breaker._record(True, probe=True)
+
+async def test_rate_limiter():
+    """Тест лимитеров переводов и загрузок страниц"""
+    print("\n🧪 Тестирование лимитеров...")
+    
+    import time
+    from rate_limiter import RateLimiter, RateLimitExceeded, TokenBucket
+    
+    bucket = TokenBucket(rate=50, capacity=1)
+    start = time.monotonic()
+    for _ in range(5):
+        await bucket.acquire()
+    elapsed = time.monotonic() - start
+    assert 0.07 <= elapsed < 0.5, f"Темп 50/с: {elapsed:.3f} с на 5 токенов"
+    print(f"✅ Token bucket держит темп ({elapsed * 1000:.0f} мс на 5 запросов)")
+    
+    account = f"test_{utils.now()}"
+    limiter = RateLimiter('test_transfer', account, rate=1000, daily_limit=100)
+    await limiter.acquire(60)
+    limiter.record(60)
+    
+    # Расход переживает перезапуск: новый лимитер читает его из базы
+    restarted = RateLimiter('test_transfer', account, rate=1000, daily_limit=100)
+    assert restarted.remaining() == 40
+    assert not restarted.has_quota(50)
+    try:
+        await restarted.acquire(50)
+        assert False, "Квота должна быть исчерпана"
+    except RateLimitExceeded as e:
+        assert e.remaining == 40
+    print("✅ Суточная квота сохраняется в базе")
+    
+    # Скользящее окно для команд бота
+    from rate_limiter import SlidingWindowLimiter, CommandRateLimiter
+    window = SlidingWindowLimiter(limit=3, window=0.2)
+    assert [window.hit('u') for _ in range(3)] == [0.0, 0.0, 0.0]
+    retry_in = window.hit('u')
+    assert 0 < retry_in <= 0.4, retry_in
+    assert window.hit('other') == 0.0, "Лимит считается по ключу"
+    await asyncio.sleep(retry_in + 0.01)
+    assert window.hit('u') == 0.0, "После паузы команда снова разрешена"
+    
+    commands = CommandRateLimiter(user_limit=2, global_limit=3, window=60)
+    assert not commands.check('order', 1) and not commands.check('order', 1)
+    assert commands.check('order', 1) > 0, "Лимит пользователя"
+    assert not commands.check('order', 2)
+    assert commands.check('order', 3) > 0, "Общий лимит"
+    assert not commands.check('price', 3), "Команды считаются раздельно"
+    print("✅ Лимит команд на пользователя и общий")
+
+async def test_outbound_queue():
+    """Тест очереди исходящих сообщений Telegram"""
+    print("\n🧪 Тестирование очереди сообщений...")
+    
+    import time
+    from telegram.error import RetryAfter, Forbidden
+    from message_queue import OutboundQueue, PRIORITY_USER, PRIORITY_ADMIN
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.flooded = False
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id == 3 and not self.flooded:
+                self.flooded = True
+                raise RetryAfter(0.1)
+            if chat_id == 4:
+                raise Forbidden("bot was blocked by the user")
+            self.sent.append((chat_id, text, time.monotonic()))
+    
+    bot = FakeBot()
+    queue = OutboundQueue(bot, global_rate=1000, per_chat_interval=0.05, max_attempts=2)
+    
+    queue.put(100, 'admin info', priority=PRIORITY_ADMIN, kind='admin')
+    queue.put(1, 'first', priority=PRIORITY_USER)
+    queue.put(1, 'second', priority=PRIORITY_USER)
+    queue.put(3, 'flood', priority=PRIORITY_USER)
+    queue.put(4, 'blocked', priority=PRIORITY_USER)
+    await queue.stop(timeout=2)
+    
+    texts = [text for _, text, _ in bot.sent]
+    assert texts[0] == 'first', f"Сообщения пользователям важнее админских: {texts}"
+    assert 'flood' in texts and 'blocked' not in texts
+    chat_1 = [sent_at for chat_id, _, sent_at in bot.sent if chat_id == 1]
+    assert chat_1[1] - chat_1[0] >= 0.045, "Интервал между сообщениями в один чат"
+    print(f"✅ Приоритет, per-chat интервал и RetryAfter ({texts})")
+
+async def test_admin_digest():
+    """Тест дайджест-режима уведомлений админов"""
+    print("\n🧪 Тестирование дайджеста админов...")
+    
+    from unittest.mock import patch
+    from integrations import NotificationService
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            self.sent.append((chat_id, text))
+    
+    bot = FakeBot()
+    service = NotificationService(bot, digest_enabled=True, digest_window_sec=3600)
+    with patch('config.ADMIN_IDS', [111, 222]):
+        acks = []
+        for i in range(5):
+            await service.notify_admin(f"🎉 Заказ {i} выполнен", event='completed',
+                                       order_id=f"ord_{i}", stars=100, revenue_rub=90.0, on_result=acks.append)
+        await service.notify_admin("❌ Ошибка выдачи заказа ord_x", event='failed', urgent=True, order_id='ord_x')
+        await service.notify_admin("⚠️ Недостаточно баланса", urgent=True)
+        await service.queue.stop(timeout=5)
+        
+        # Срочные уходят сразу обоим админам, рутинные копятся
+        assert len(bot.sent) == 4, bot.sent
+        assert {chat_id for chat_id, _ in bot.sent} == {111, 222}
+        assert not acks, "Событие дайджеста не подтверждается до отправки сводки"
+        
+        service.flush_digest()
+        await service.queue.stop(timeout=5)
+        assert acks == ['sent'] * 5, acks
+    
+    digests = [text for _, text in bot.sent if 'Дайджест' in text]
+    assert len(digests) == 2
+    assert '✅ Выполнено: <b>5</b>' in digests[0] and 'ord_x' in digests[0] and '500' in digests[0]
+    print("✅ Срочные в обход дайджеста, остальные одной сводкой")
+
+async def test_outbox():
+    """Тест outbox уведомлений"""
+    print("\n🧪 Тестирование outbox уведомлений...")
+    
+    from unittest.mock import patch
+    from integrations import NotificationService
+    from outbox import OutboxDispatcher, notification
+    
+    class FakeBot:
+        def __init__(self):
+            self.sent = []
+            self.fail = True
+        
+        async def send_message(self, chat_id, text, parse_mode=None):
+            if chat_id == 7 and self.fail:
+                self.fail = False
+                raise RuntimeError("telegram unavailable")
+            self.sent.append((chat_id, text))
+    
+    order_id = f"test_outbox_{utils.now()}"
+    row = notification(order_id, 'fulfilled', 'user', 'готово', 'f1', chat_id=5)
+    db.update_order_status(order_id, OrderStatus.FULFILLED, [row])
+    db.update_order_status(order_id, OrderStatus.FULFILLED, [row])
+    db.enqueue_notifications([notification(order_id, 'error', 'user', 'ошибка', 'e1', chat_id=7),
+                              notification(order_id, 'failed', 'admin', 'админу', 'f1',
+                                           meta={'event': 'failed', 'urgent': True, 'order_id': order_id})])
+    
+    bot = FakeBot()
+    service = NotificationService(bot)
+    dispatcher = OutboxDispatcher(service, batch_size=500, max_attempts=3)
+    with patch('config.ADMIN_IDS', [111]):
+        pending = [r for r in db.get_pending_outbox(500) if r['dedupe_key'].startswith(order_id)]
+        assert len(pending) == 3, "Повтор с тем же ключом не дублирует уведомление"
+        
+        await dispatcher.dispatch_once()
+        await service.queue.stop(timeout=5)
+        dispatcher.flush()
+    
+    ours = {'готово', 'ошибка', 'админу'}
+    assert sorted(m for m in bot.sent if m[1] in ours) == [(5, 'готово'), (111, 'админу')], bot.sent
+    pending = [r for r in db.get_pending_outbox(500) if r['dedupe_key'].startswith(order_id)]
+    assert not pending, "Неудачная доставка ждёт паузы перед повтором"
+    
+    # Повтор после паузы доставляет уведомление
+    with db.get_connection() as conn:
+        conn.execute("UPDATE outbox SET next_attempt_at = ? WHERE dedupe_key LIKE ?", (utils.now(), f"{order_id}%"))
+        conn.commit()
+    await dispatcher.dispatch_once()
+    await service.queue.stop(timeout=5)
+    dispatcher.flush()
+    assert sorted(m for m in bot.sent if m[1] in ours) == [(5, 'готово'), (7, 'ошибка'), (111, 'админу')]
+    print("✅ Уведомления пишутся со статусом, доставляются и повторяются")
+    
+    # Повторная обработка заказа в том же состоянии не ставит уведомления заново
+    from order_processor import OrderProcessor
+    processor = OrderProcessor(service)
+    replay_id = f"test_replay_{utils.now()}"
+    order = {'order_id': replay_id, 'attached_telegram_username': '', 'stars_amount_total': 100}
+    for _ in range(3):
+        await processor._handle_needs_username(order, 5)
+        await processor._handle_waiting_payment(order, 5)
+        await processor._handle_error(replay_id, "Order not found", 5)
+    keys = [r['dedupe_key'] for r in db.get_pending_outbox(500) if r['dedupe_key'].startswith(replay_id)]
+    assert len(keys) == 4, keys
+    print("✅ Повтор обработки в том же состоянии не дублирует уведомления")
+
+async def test_webhook_server():
+    """Тест webhook-сервера с локальным фейковым клиентом Telegram"""
+    print("\n🧪 Тестирование webhook-сервера...")
+    
+    import aiohttp
+    from telegram.ext import Application
+    from webhook_server import WebhookServer, SECRET_HEADER
+    
+    application = Application.builder().token('123456:TEST').build()
+    received = []
+    
+    async def order_handler(order_id, chat_id):
+        received.append((order_id, chat_id))
+    
+    server = WebhookServer(application, order_handler=order_handler, host='127.0.0.1', port=0,
+                           path='/telegram', secret_token='s3cret', order_token='orders-token', max_batch=3)
+    await server.start()
+    base_url = f"http://127.0.0.1:{server.port_bound}"
+    update = {
+        'update_id': 1001,
+        'message': {'message_id': 1, 'date': 1700000000, 'text': '/start',
+                    'chat': {'id': 42, 'type': 'private'}, 'from': {'id': 42, 'is_bot': False, 'first_name': 'T'}}
+    }
+    try:
+        async with aiohttp.ClientSession() as client:
+            async with client.post(f"{base_url}/telegram", json=update, headers={SECRET_HEADER: 'wrong'}) as r:
+                assert r.status == 403
+            async with client.post(f"{base_url}/telegram", json=update, headers={SECRET_HEADER: 's3cret'}) as r:
+                assert r.status == 200
+            
+            queued = application.update_queue.get_nowait()
+            assert queued.update_id == 1001 and queued.message.text == '/start'
+            assert server.pop_received_at(1001) is not None
+            print("✅ Обновления принимаются только с секретным токеном")
+            
+            orders_url = f"{base_url}/orders"
+            async with client.post(orders_url, json={'order_ids': ['a']}) as r:
+                assert r.status == 401
+            auth = {'Authorization': 'Bearer orders-token'}
+            async with client.post(orders_url, json={'order_ids': ['a', 'b', 'c', 'd']}, headers=auth) as r:
+                assert r.status == 413
+            async with client.post(orders_url, json={'orders': [{'chat_id': 7}]}, headers=auth) as r:
+                assert r.status == 400
+            batch = {'orders': [{'order_id': 'ord_1', 'chat_id': 7}, {'order_id': 'ord_2'}, {'order_id': 'ord_1'}]}
+            async with client.post(orders_url, json=batch, headers=auth) as r:
+                assert r.status == 202
+                assert (await r.json())['accepted'] == ['ord_1', 'ord_2']
+    finally:
+        await server.stop()
+    
+    assert ('ord_1', 7) in received and ('ord_2', None) in received
+    print("✅ Заказы пачкой через авторизованный endpoint")
+
+async def test_update_processor():
+    """Тест параллельной обработки обновлений"""
+    print("\n🧪 Тестирование обработки обновлений...")
+    
+    from types import SimpleNamespace
+    from update_processor import UserOrderedUpdateProcessor
+    
+    events = []
+    running = {'now': 0, 'max': 0}
+    
+    async def handler(name, delay):
+        running['now'] += 1
+        running['max'] = max(running['max'], running['now'])
+        events.append(('start', name))
+        await asyncio.sleep(delay)
+        events.append(('end', name))
+        running['now'] -= 1
+    
+    def update(user_id):
+        return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=None)
+    
+    processor = UserOrderedUpdateProcessor(concurrency=2)
+    async with processor:
+        await asyncio.gather(
+            processor.process_update(update(1), handler('a1', 0.05)),
+            processor.process_update(update(1), handler('a2', 0.01)),
+            processor.process_update(update(2), handler('b1', 0.01)),
+            processor.process_update(update(3), handler('c1', 0.01)),
+        )
+    
+    assert events.index(('end', 'a1')) < events.index(('start', 'a2')), "Один пользователь - по порядку"
+    assert events.index(('end', 'b1')) < events.index(('end', 'a1')), "Другие пользователи не ждут медленного"
+    assert running['max'] == 2, f"Не больше 2 обработчиков одновременно: {running['max']}"
+    assert not processor._user_locks, "Блокировки пользователей освобождаются"
+    print("✅ Параллельно между пользователями, по порядку внутри пользователя")
+
+async def test_user_state_store():
+    """Тест хранилища состояний диалога"""
+    print("\n🧪 Тестирование состояний пользователей...")
+    
+    from state_store import UserStateStore
+    
+    store = UserStateStore(ttl=3600, max_entries=2)
+    for user_id in (9001, 9002, 9003):
+        store.set(user_id, {'state': 'waiting_username', 'order_id': f"ord_{user_id}"})
+    assert len(store) == 2, "Лимит памяти"
+    assert store.get(9001)['order_id'] == 'ord_9001', "Вытесненное состояние читается из базы"
+    
+    # Перезапуск: новый экземпляр видит сохранённые диалоги
+    restarted = UserStateStore(ttl=3600)
+    assert restarted.get(9002)['state'] == 'waiting_username'
+    
+    short = UserStateStore(ttl=0.05)
+    short.set(9004, {'state': 'confirming_username', 'order_id': 'ord_9004', 'username': '@example'})
+    await asyncio.sleep(0.1)
+    assert short.get(9004) is None, "Истёкшее состояние"
+    assert UserStateStore().get(9004) is None, "Истёкшее удаляется из базы"
+    
+    for user_id in (9001, 9002, 9003):
+        store.delete(user_id)
+    assert UserStateStore().get(9003) is None
+    
+    # Отсутствие состояния запоминается: повторное сообщение не читает базу
+    from unittest.mock import patch
+    fresh = UserStateStore(ttl=3600)
+    assert fresh.get(9005) is None
+    with patch.object(db, 'get_user_state', side_effect=AssertionError("чтение базы")):
+        assert fresh.get(9005) is None
+    fresh.set(9005, {'state': 'waiting_username', 'order_id': 'ord_9005'})
+    assert fresh.get(9005)['order_id'] == 'ord_9005', "set() заменяет отметку об отсутствии"
+    fresh.delete(9005)
+    print("✅ TTL, лимит памяти и сохранение в базе")
+
+async def test_order_queue():
+    """Тест очереди заказов"""
+    print("\n🧪 Тестирование очереди заказов...")
+    
+    from order_queue import OrderJobQueue
+    
+    class FakeProcessor:
+        def __init__(self):
+            self.processed = []
+        
+        async def process_order(self, order_id, chat_id=None):
+            await asyncio.sleep(0.01)
+            if order_id == 'boom':
+                raise RuntimeError("processing failed")
+            self.processed.append((order_id, chat_id))
+    
+    processor = FakeProcessor()
+    queue = OrderJobQueue(processor, workers=2, maxsize=3)
+    assert queue.submit('ord_1', 1)
+    assert not queue.submit('ord_1', 1), "Заказ уже в очереди"
+    assert queue.submit('boom')
+    assert queue.submit('ord_2')
+    assert not queue.submit('ord_3'), "Очередь заполнена"
+    await queue.stop(timeout=5)
+    
+    assert sorted(processor.processed) == [('ord_1', 1), ('ord_2', None)]
+    print("✅ Дедупликация, лимит очереди и дообработка при остановке")
+
+async def test_unknown_orders():
+    """Тест негативного кэша и фильтра Блума для неизвестных заказов"""
+    print("\n🧪 Тестирование поиска неизвестных заказов...")
+    
+    from bloom_filter import BloomFilter
+    
+    bloom = BloomFilter.from_items((f"order_{i}" for i in range(1000)), capacity=1000, error_rate=0.01)
+    assert all(f"order_{i}" in bloom for i in range(1000)), "Без ложноотрицательных"
+    false_positives = sum(f"other_{i}" in bloom for i in range(10000))
+    assert false_positives < 300, f"Доля ложноположительных: {false_positives / 10000:.3f}"
+    print(f"✅ Фильтр Блума: {false_positives / 100:.2f}% ложноположительных")
+    
+    # Неизвестный ID отсекается фильтром без запроса к базе, сохранённый находится
+    order_id = f"bloom_{utils.now()}"
+    assert not db.might_have_order(order_id) and db.get_order(order_id) is None
+    db.save_order({'order_id': order_id, 'offer_id': 'stars_100', 'quantity': 1, 'buyer_username': 'u',
+                   'buyer_funpay_login': 'u', 'total_price': 100.0, 'currency': 'RUB', 'status': OrderStatus.NEW,
+                   'created_at': utils.now()})
+    assert db.get_order(order_id)['order_id'] == order_id
+    db.rebuild_order_filter()
+    assert db.might_have_order(order_id), "Фильтр восстанавливается из базы"
+    
+    # Промах FunPay кэшируется и не сохраняется в базу
+    class MissingParser:
+        def __init__(self):
+            self.calls = 0
+        
+        async def get_order_details(self, order_id):
+            self.calls += 1
+            return None
+    
+    from integrations import FunPayAPI
+    api = FunPayAPI()
+    api.parser = MissingParser()
+    assert await api.get_order('NOSUCH123') is None
+    assert await api.get_order('NOSUCH123') is None
+    assert api.parser.calls == 1, "Повторный запрос отвечается негативным кэшем"
+    assert await api.get_order('NOSUCH123', force_refresh=True) is None and api.parser.calls == 2
+    print("✅ Негативный кэш отвечает без загрузки страницы")
+    
+    # Несуществующие ID не считаются сбоем FunPay и не размыкают breaker
+    from circuit_breaker import breakers
+    for i in range(10):
+        assert await api.get_order(f"TYPO{i}") is None
+    assert breakers['funpay_read'].state == breakers['funpay_read'].CLOSED
+    assert breakers['funpay_read'].error_rate() == 0
+    print("✅ Опечатки в ID заказа не размыкают breaker FunPay")
+
+async def test_template_cache():
+    """Тест предрендера и мемоизации шаблонов"""
+    print("\n🧪 Тестирование кэша шаблонов...")
+    
+    from message_templates import clear_template_caches
+    clear_template_caches()
+    templates = MessageTemplates()
+    assert templates.help_message() is templates.help_message(), "Статичный текст рендерится один раз"
+    
+    offers = [{'offer_id': 'offer_1', 'title': '100 Stars', 'stars_amount': 100, 'price': 100.0,
+               'currency': 'RUB', 'is_active': True}]
+    first = templates.price_message(offers)
+    assert templates.price_message([dict(offers[0])]) is first, "Тот же каталог - тот же текст"
+    changed = templates.price_message([dict(offers[0], price=90.0)])
+    assert changed is not first and '90.0' in changed, "Смена цены перерисовывает прайс"
+    
+    order = {'order_id': 'tmpl_001', 'status': OrderStatus.FULFILLING, 'stars_amount_total': 100,
+             'total_price': 100.0, 'currency': 'RUB', 'created_at': utils.now(),
+             'attached_telegram_username': '@testuser'}
+    fulfillment = {'status': FulfillmentStatus.PENDING, 'batches': [{'status': 'ok'}, {'status': 'pending'}]}
+    status_msg = templates.order_status(order, fulfillment)
+    assert templates.order_status(dict(order), fulfillment) is status_msg
+    assert '1/2' in status_msg
+    fulfillment['batches'][1]['status'] = 'ok'
+    assert '2/2' in templates.order_status(order, fulfillment), "Прогресс выдачи входит в ключ"
+    assert 'Выполнен' in templates.order_status(dict(order, status=OrderStatus.FULFILLED), fulfillment)
+    print("✅ Кэш шаблонов сбрасывается при смене каталога и состояния заказа")
+
+async def test_tracing():
+    """Тест трассировки этапов обработки заказа"""
+    print("\n🧪 Тестирование трассировки...")
+    
+    import json
+    import tempfile
+    from collections import deque
+    import tracing
+    
+    path = os.path.join(tempfile.mkdtemp(), 'traces.jsonl')
+    tracer = tracing.Tracer(path=path, window=100, enabled=True, flush_batch=1000, flush_interval=3600)
+    global_tracer, tracing.tracer = tracing.tracer, tracer
+    try:
+        @tracing.traced('stage.inner')
+        async def inner():
+            await asyncio.sleep(0)
+        
+        with tracing.trace('ORD1'), tracing.span('stage.root') as root:
+            await asyncio.gather(inner(), inner())
+            try:
+                with tracing.span('stage.failing'):
+                    raise ValueError('boom')
+            except ValueError:
+                pass
+        delivery = tracing.start_span('stage.delivery')
+        results = []
+        tracing.finish_on_result(delivery, results.append)('failed')
+        tracer.flush()
+        
+        with open(path, encoding='utf-8') as f:
+            spans = [json.loads(line) for line in f]
+        by_name = {}
+        for item in spans:
+            by_name.setdefault(item['name'], []).append(item)
+        assert len(by_name['stage.inner']) == 2
+        assert all(item['parent_id'] == root.span_id for item in by_name['stage.inner']), "Спаны задач вложены в корень"
+        assert {item['order_id'] for item in by_name['stage.inner']} == {'ORD1'}
+        assert by_name['stage.failing'][0]['status'] == 'error' and by_name['stage.failing'][0]['attrs']['error'] == 'ValueError'
+        assert by_name['stage.delivery'][0]['status'] == 'failed' and results == ['failed']
+        assert by_name['stage.delivery'][0]['trace_id'] is None
+        
+        tracer.reset()
+        for ms in range(1, 101):
+            tracer._durations.setdefault('stage.synthetic', deque(maxlen=100)).append(ms / 1000)
+        summary = tracer.summary()['stage.synthetic']
+        assert (round(summary['p50']), round(summary['p95']), round(summary['p99'])) == (50, 95, 99)
+        print("✅ Спаны коррелируются по заказу, пишутся в JSONL и сводятся в p50/p95/p99")
+        
+        print(MessageTemplates().admin_perf(tracer.summary()))
+        
+        import threading
+        writers = []
+        batch_tracer = tracing.Tracer(path=path, window=100, enabled=True, flush_batch=1, flush_interval=3600)
+        write = batch_tracer._write
+        batch_tracer._write = lambda spans: (writers.append(threading.current_thread()), write(spans))
+        tracing.tracer = batch_tracer
+        with tracing.span('stage.batched'):
+            pass
+        for _ in range(100):
+            if writers:
+                break
+            await asyncio.sleep(0.01)
+        assert writers and writers[0] is not threading.main_thread(), "Пачка спанов пишется вне event loop"
+        with open(path, encoding='utf-8') as f:
+            assert any(json.loads(line)['name'] == 'stage.batched' for line in f)
+        print("✅ Пачка спанов дописывается в пуле потоков, а не в event loop")
+    finally:
+        tracing.tracer = global_tracer
+
+async def test_metrics_endpoint():
+    """Тест вывода метрик в формате Prometheus"""
+    print("\n🧪 Тестирование endpoint метрик...")
+    
+    import aiohttp
+    from telegram.ext import Application
+    from metrics import MetricsRegistry
+    from webhook_server import WebhookServer
+    
+    registry = MetricsRegistry()
+    registry.counter('jobs_total', 'Jobs').inc(3, result='ok')
+    registry.gauge('depth', 'Depth "quoted"').set(2.5, queue='a"b')
+    latency = registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 7):
+        latency.observe(value, op='x')
+    collected = []
+    registry.register_collector(lambda: collected.append(True))
+    text = registry.render()
+    assert collected, "Сборщики вызываются перед выводом"
+    assert '# TYPE jobs_total counter\njobs_total{result="ok"} 3' in text
+    assert 'depth{queue="a\\"b"} 2.5' in text
+    assert 'latency_seconds_bucket{op="x",le="0.1"} 2' in text
+    assert 'latency_seconds_bucket{op="x",le="1.0"} 3' in text
+    assert 'latency_seconds_bucket{op="x",le="+Inf"} 4' in text
+    assert 'latency_seconds_count{op="x"} 4' in text
+    print("✅ Накопительные корзины гистограмм и экранирование меток")
+    
+    application = Application.builder().token('123456:TEST').build()
+    server = WebhookServer(application, host='127.0.0.1', port=0, metrics_enabled=True, metrics_token='m-token')
+    await server.start()
+    try:
+        async with aiohttp.ClientSession() as client:
+            url = f"http://127.0.0.1:{server.port_bound}/metrics"
+            async with client.get(url) as r:
+                assert r.status == 401
+            async with client.get(url, headers={'Authorization': 'Bearer m-token'}) as r:
+                assert r.status == 200 and r.content_type == 'text/plain'
+                body = await r.text()
+    finally:
+        await server.stop()
+    
+    for name in ('orders_by_status', 'db_query_seconds_bucket', 'order_status_changes_total', 'telegram_send_seconds'):
+        assert f"# TYPE {name[:-len('_bucket')] if name.endswith('_bucket') else name} " in body, name
+    assert 'op="get_order"' in body and 'op="init_database"' not in body, "Время пишется только для запросов"
+    print(f"✅ /metrics отдаёт {body.count(chr(10))} строк")
+    
+    # Статус без заказов выводится нулём, а не последним ненулевым значением
+    from database import orders_by_status
+    orders_by_status.set(5, status='STALE_STATUS')
+    db.collect_metrics()
+    assert orders_by_status.get(status='STALE_STATUS') == 0
+    assert orders_by_status.get(status=OrderStatus.PARKED) == db.count_orders_by_status().get(OrderStatus.PARKED, 0)
+    assert f'orders_by_status{{status="{OrderStatus.NEEDS_BALANCE}"}}' in body
+    print("✅ Опустевшие статусы заказов обнуляются")
+
+async def test_profiler():
+    """Тест сэмплирующего профайлера и монитора event loop"""
+    print("\n🧪 Тестирование профилирования...")
+    
+    import time
+    from profiler import LoopMonitor, profile
+    
+    def busy_wait(seconds):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline:
+            pass
+    
+    async def blocker():
+        await asyncio.sleep(0.05)
+        busy_wait(0.3)
+    
+    task = asyncio.create_task(blocker())
+    profiler = await profile(0.5, interval=0.002)
+    await task
+    assert profiler.samples > 0
+    collapsed = profiler.collapsed()
+    assert 'busy_wait' in collapsed and 'blocker' in collapsed, "Блокирующий код виден в стеке потока loop"
+    line = collapsed.splitlines()[0]
+    assert line.rsplit(' ', 1)[1].isdigit() and ';' in line
+    print(f"✅ Профиль: {profiler.samples} сэмплов, чаще всего {profiler.top_functions(1)[0][0]}")
+    
+    monitor = LoopMonitor(interval=0.02, slow_callback=0.05, debug=True)
+    await monitor.start()
+    try:
+        async def short_job():
+            await asyncio.sleep(0.01)
+        
+        await asyncio.gather(*(asyncio.create_task(short_job()) for _ in range(3)))
+        await asyncio.sleep(0.05)
+        await blocker()
+        await asyncio.sleep(0.1)
+        stats = monitor.stats()
+    finally:
+        await monitor.stop()
+    
+    assert stats['lag_ms']['max'] >= 200, f"Задержка loop: {stats['lag_ms']}"
+    assert stats['slow_callbacks'] and stats['slow_callbacks'][-1][2] >= 0.25, "Медленный колбэк пойман в debug-режиме"
+    finished = {name: count for name, count, _, _ in stats['finished']}
+    assert finished.get('test_profiler.<locals>.short_job') == 3
+    assert not asyncio.get_running_loop().get_debug(), "Debug-режим выключается при остановке"
+    print(f"✅ Loop: задержка до {stats['lag_ms']['max']:.0f} мс, медленных колбэков {len(stats['slow_callbacks'])}")
+    
+    message = MessageTemplates().admin_loopstats(stats)
+    assert 'Задержка, мс' in message and 'Медленные колбэки</b> (debug вкл)' in message
+    assert 'short_job' in message and message.count('<code>') == message.count('</code>')
 
 async def main():
     """Основная функция тестирования"""
@@ -205,6 +1122,23 @@ async def main():
         await test_utils()
         await test_message_templates()
         await test_order_processor()
+        await test_balance_service()
+        await test_http_client()
+        await test_retry_policy()
+        await test_circuit_breaker()
+        await test_rate_limiter()
+        await test_outbound_queue()
+        await test_admin_digest()
+        await test_outbox()
+        await test_webhook_server()
+        await test_update_processor()
+        await test_user_state_store()
+        await test_order_queue()
+        await test_unknown_orders()
+        await test_template_cache()
+        await test_tracing()
+        await test_metrics_endpoint()
+        await test_profiler()
         
         print("\n🎉 Все тесты завершены успешно!")
         
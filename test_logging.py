@@ -20,7 +20,7 @@ class MockNotificationService:
     async def notify_user(self, chat_id, message):
         print(f"📱 Уведомление пользователю {chat_id}: {message[:50]}...")
     
-    async def notify_admin(self, message):
+    async def notify_admin(self, message, **kwargs):
         print(f"👨‍💼 Уведомление админу: {message[:100]}...")
 
 async def test_logging_system():
@@ -127,6 +127,70 @@ async def test_database_logs():
     except Exception as e:
         print(f"❌ Ошибка работы с базой данных: {e}")
 
+async def test_log_pipeline():
+    """Тест фоновой записи логов, JSON-формата и ротации"""
+    print("\n🧪 Тестирование конвейера логирования...")
+    
+    import gzip
+    import json
+    import logging
+    import tempfile
+    import time
+    import tracing
+    from logging_system import CompressingRotatingFileHandler, JsonFormatter, setup_logging, shutdown_logging
+    
+    # Повторная настройка (OrderLogger в боте и в OrderProcessor) не дублирует строки
+    shutdown_logging()
+    log_dir = tempfile.mkdtemp()
+    setup_logging(log_dir=log_dir)
+    setup_logging(log_dir=log_dir)
+    OrderLogger(MockNotificationService())
+    queue_handlers = [h for h in logging.getLogger().handlers if type(h).__name__ == 'NonBlockingQueueHandler']
+    assert len(queue_handlers) == 1, f"Хендлеров очереди: {len(queue_handlers)}"
+    
+    logger = logging.getLogger('telegram_stars_bot')
+    with tracing.trace('LOG1'):
+        logger.info("pipeline check %s", 42, extra={'order_id': 'LOG1'})
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("pipeline failure")
+    shutdown_logging()
+    
+    with open(os.path.join(log_dir, 'bot_operations.log'), encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    checks = [r for r in records if r['message'] == 'pipeline check 42']
+    assert len(checks) == 1, "Каждая запись пишется один раз"
+    assert checks[0]['order_id'] == 'LOG1' and checks[0]['trace_id'].startswith('LOG1-')
+    failure = next(r for r in records if r['message'] == 'pipeline failure')
+    assert 'ValueError: boom' in failure['exc']
+    print("✅ Записи пишутся фоновым потоком один раз, в JSON с trace_id и extra-полями")
+    
+    # Ротация по размеру: сжатые копии, не больше backup_count
+    path = os.path.join(tempfile.mkdtemp(), 'rotate.log')
+    handler = CompressingRotatingFileHandler(path, max_bytes=300, interval_hours=0, backup_count=2, retention_days=0)
+    handler.setFormatter(JsonFormatter())
+    for i in range(30):
+        handler.emit(logging.LogRecord('t', logging.INFO, __file__, 0, f"line {i} " + 'x' * 50, (), None))
+    assert os.path.exists(path + '.1.gz') and os.path.exists(path + '.2.gz')
+    assert not os.path.exists(path + '.3.gz'), "Лишние копии удаляются"
+    with gzip.open(path + '.1.gz', 'rt', encoding='utf-8') as f:
+        assert json.loads(f.readline())['logger'] == 't'
+    
+    # Ротация по времени и удаление копий старше срока хранения
+    handler.interval = 3600
+    handler.rollover_at = time.time() - 1
+    handler.backupCount = 3
+    handler.retention_days = 1
+    os.utime(path + '.1.gz', (time.time() - 3 * 86400,) * 2)
+    handler.emit(logging.LogRecord('t', logging.INFO, __file__, 0, "after interval", (), None))
+    handler.close()
+    with open(path, encoding='utf-8') as f:
+        assert json.loads(f.read())['message'] == "after interval"
+    assert os.path.exists(path + '.1.gz'), "Свежая копия остаётся"
+    assert not os.path.exists(path + '.2.gz'), "Копия старше срока хранения удалена"
+    print("✅ Ротация по размеру и времени со сжатием и сроком хранения")
+
 async def main():
     """Основная функция тестирования"""
     print("🚀 Тестирование системы логирования и статистики\n")
@@ -135,6 +199,7 @@ async def main():
         await test_logging_system()
         await test_currency_conversion()
         await test_database_logs()
+        await test_log_pipeline()
         
         print("\n🎉 Все тесты логирования завершены успешно!")
         
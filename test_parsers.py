@@ -13,13 +13,18 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from funpay_parser import FunPayParser, MockFunPayParser
 from fragment_parser import FragmentParser, MockFragmentParser
-from integrations import FunPayAPI, FragmentAPI
+from integrations import FunPayAPI, FragmentAPI, SingleFlight
+from selector_cache import SelectorResolver
+from session_store import SessionStore
+from browser import SupervisedBrowser, apply_resource_blocking, process_tree_rss
+from selenium.common.exceptions import WebDriverException
+from browser_supervisor import BrowserSupervisor
 
 class MockNotificationService:
     async def notify_user(self, chat_id, message):
         print(f"📱 Уведомление пользователю {chat_id}: {message[:50]}...")
     
-    async def notify_admin(self, message):
+    async def notify_admin(self, message, **kwargs):
         print(f"👨‍💼 Уведомление админу: {message[:100]}...")
 
 async def test_funpay_parser():
@@ -88,6 +93,171 @@ async def test_fragment_parser():
     # Очистка
     parser.close()
 
+class FakeElement:
+    def __init__(self, text):
+        self.text = text
+
+class FakeDriver:
+    """Драйвер-заглушка: отдаёт элементы по словарю селекторов"""
+    def __init__(self, pages):
+        self.pages = pages
+        self.implicit_waits = []
+        self.crashed = False
+    
+    def get(self, url):
+        if self.crashed:
+            from selenium.common.exceptions import WebDriverException
+            raise WebDriverException("chrome not reachable")
+    
+    @property
+    def window_handles(self):
+        if self.crashed:
+            raise RuntimeError("session deleted")
+        return ['main']
+    
+    def quit(self):
+        pass
+    
+    def implicitly_wait(self, seconds):
+        self.implicit_waits.append(seconds)
+    
+    def find_elements(self, by, value):
+        return [FakeElement(text) for text in self.pages.get(value, [])]
+    
+    def execute_cdp_cmd(self, cmd, params):
+        self.cdp_commands = getattr(self, 'cdp_commands', []) + [(cmd, params)]
+        return {}
+
+async def test_selector_resolver():
+    """Тест кэша селекторов"""
+    print("\n🧪 Тестирование кэша селекторов...")
+    
+    import tempfile
+    stats_path = os.path.join(tempfile.mkdtemp(), 'selector_stats.json')
+    resolver = SelectorResolver(stats_path=stats_path, min_samples=3)
+    candidates = resolver.split_css('.stars-balance, .balance-stars')
+    
+    # Работает только запасной селектор
+    driver = FakeDriver({'.balance-stars': ['1 500 Stars']})
+    element = await resolver.find(driver, 'balance', 'stars_balance', candidates)
+    print(f"✅ Найден запасной селектор: {element.text}")
+    print(f"✅ Implicit wait во время поиска: {driver.implicit_waits}")
+    
+    # Победитель пробуется первым
+    ordered = resolver.ordered('balance', 'stars_balance', candidates)
+    status = "✅" if ordered[0][1] == '.balance-stars' else "❌"
+    print(f"{status} Первым пробуется: {ordered[0][1]}")
+    
+    # Статистика переживает перезапуск
+    resolver.save()
+    restored = SelectorResolver(stats_path=stats_path)
+    status = "✅" if restored.ordered('balance', 'stars_balance', candidates)[0][1] == '.balance-stars' else "❌"
+    print(f"{status} Статистика восстановлена с диска")
+    
+    # Смена вёрстки: ни один селектор не находит элемент
+    broken = FakeDriver({})
+    for _ in range(5):
+        await resolver.find(broken, 'balance', 'stars_balance', candidates)
+    print(f"✅ Hit rate после смены вёрстки: {resolver.hit_rate('balance', 'stars_balance'):.0%}")
+
+async def test_session_store():
+    """Тест хранилища сессий"""
+    print("\n🧪 Тестирование хранилища сессий...")
+    
+    import tempfile
+    import time
+    store = SessionStore(base_dir=tempfile.mkdtemp())
+    
+    print(f"✅ Без cookie нужна авторизация: {store.needs_refresh('funpay', 'test_login')}")
+    
+    cookies = [
+        {'name': 'golden_key', 'value': 'abc', 'domain': '.funpay.com', 'expiry': int(time.time()) + 86400},
+        {'name': 'old', 'value': 'x', 'domain': '.funpay.com', 'expiry': int(time.time()) - 10},
+        {'name': 'PHPSESSID', 'value': 'y', 'domain': 'funpay.com'}
+    ]
+    store.save_cookies('funpay', 'test_login', cookies)
+    
+    loaded = store.load_cookies('funpay', 'test_login')
+    status = "✅" if [c['name'] for c in loaded] == ['golden_key', 'PHPSESSID'] else "❌"
+    print(f"{status} Загружено cookie без истёкших: {len(loaded)}")
+    
+    status = "✅" if store.needs_refresh('funpay', 'test_login', before_seconds=3600) else "❌"
+    print(f"{status} Истекающие cookie требуют продления")
+    
+    store.save_cookies('funpay', 'test_login', loaded[:1])
+    status = "✅" if not store.needs_refresh('funpay', 'test_login', before_seconds=3600) else "❌"
+    print(f"{status} Свежая сессия не требует продления")
+    
+    profile_dir = store.profile_dir('funpay', 'test_login')
+    status = "✅" if 'test_login' not in profile_dir else "❌"
+    print(f"{status} Профиль Chrome: {profile_dir}")
+
+async def test_resource_blocking():
+    """Тест блокировки ресурсов через CDP"""
+    print("\n🧪 Тестирование блокировки ресурсов...")
+    
+    driver = FakeDriver({})
+    patterns = apply_resource_blocking(driver, ['images', 'fonts', 'analytics'])
+    commands = [cmd for cmd, _ in driver.cdp_commands]
+    print(f"✅ CDP команды: {commands}")
+    print(f"✅ Заблокировано шаблонов: {len(patterns)}")
+    
+    status = "✅" if '*.css' not in patterns and '*.woff2' in patterns else "❌"
+    print(f"{status} CSS не блокируется без явного указания")
+    
+    rss = process_tree_rss(os.getpid())
+    print(f"✅ RSS текущего процесса: {rss / (1024 * 1024):.1f} МБ")
+
+class FakeSupervisedParser(SupervisedBrowser):
+    browser_name = 'fake'
+    
+    def __init__(self):
+        self.driver = FakeDriver({})
+        self.is_logged_in = True
+        self.saved_sessions = 0
+    
+    def setup_driver(self):
+        self.driver = FakeDriver({})
+        return True
+    
+    def save_session(self):
+        self.saved_sessions += 1
+    
+    async def restore_session(self):
+        self.is_logged_in = True
+        return True
+
+async def test_browser_supervisor():
+    """Тест сторожа браузеров"""
+    print("\n🧪 Тестирование сторожа браузеров...")
+    
+    parser = FakeSupervisedParser()
+    supervisor = BrowserSupervisor([parser, MockFragmentParser("+1234567890")], max_navigations=3, max_rss_mb=0)
+    print(f"✅ Под наблюдением браузеров: {len(supervisor.parsers)}")
+    
+    for _ in range(3):
+        await parser._navigate("https://funpay.com/orders/")
+    first_driver = parser.driver
+    await supervisor.check(parser)
+    status = "✅" if parser.driver is not first_driver and parser.navigations == 0 else "❌"
+    print(f"{status} Перезапуск после лимита навигаций, сессия сохранена: {parser.saved_sessions}")
+    
+    # Упавший браузер перезапускается прозрачно во время навигации
+    parser.driver.crashed = True
+    await parser._navigate("https://funpay.com/orders/")
+    status = "✅" if not parser.driver.crashed and parser.is_logged_in else "❌"
+    print(f"{status} Упавший браузер перезапущен, навигаций: {parser.navigations}")
+    
+    # Перезапуск не создал драйвер: понятная ошибка вместо AttributeError
+    parser.driver.crashed = True
+    parser.setup_driver = lambda: False
+    try:
+        await parser._navigate("https://funpay.com/orders/")
+        status = "❌"
+    except WebDriverException as e:
+        status = "✅" if 'недоступен' in str(e) else "❌"
+    print(f"{status} Неудачный перезапуск браузера даёт понятную ошибку")
+
 async def test_integrations():
     """Тест интеграций с парсерами"""
     print("\n🧪 Тестирование интеграций...")
@@ -131,6 +301,144 @@ async def test_integrations():
     if transfer['ok']:
         print(f"   🆔 Transfer ID: {transfer['transfer_id']}")
 
+async def test_single_flight():
+    """Тест объединения одновременных запросов"""
+    print("\n🧪 Тестирование single-flight...")
+    
+    fragment_api = FragmentAPI()
+    calls = []
+    original_get_balance = fragment_api.parser.get_balance
+    
+    async def counting_get_balance():
+        calls.append(1)
+        return await original_get_balance()
+    
+    fragment_api.parser.get_balance = counting_get_balance
+    
+    balances = await asyncio.gather(*[fragment_api.get_balance() for _ in range(10)])
+    status = "✅" if len(calls) == 1 and len(balances) == 10 else "❌"
+    print(f"{status} 10 одновременных запросов баланса → {len(calls)} загрузка страницы")
+    
+    balances[0]['stars_balance'] = -1
+    status = "✅" if balances[1]['stars_balance'] != -1 else "❌"
+    print(f"{status} Каждый вызов получает свою копию результата")
+    
+    # Ошибка лидера получают все ожидающие
+    flight = SingleFlight()
+    
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("FunPay недоступен")
+    
+    results = await asyncio.gather(*[flight.do('fail', failing) for _ in range(3)], return_exceptions=True)
+    status = "✅" if all(isinstance(r, RuntimeError) for r in results) else "❌"
+    print(f"{status} Ошибка передана всем ожидающим: {len(results)}")
+    
+    # Запасные данные (cache_if отклоняет) не кэшируются
+    fetches = []
+    
+    async def fallback():
+        fetches.append(1)
+        return []
+    
+    await flight.do('offers', fallback, ttl=60, cache_if=bool)
+    await flight.do('offers', fallback, ttl=60, cache_if=bool)
+    status = "✅" if len(fetches) == 2 else "❌"
+    print(f"{status} Запасной результат не кэшируется: {len(fetches)} загрузки")
+    
+    # Отмена лидера не отменяет ожидающих: один из них становится лидером
+    started = []
+    
+    async def slow():
+        started.append(1)
+        await asyncio.sleep(0.05)
+        return 'ok'
+    
+    leader = asyncio.create_task(flight.do('slow', slow))
+    await asyncio.sleep(0.01)
+    followers = [asyncio.create_task(flight.do('slow', slow)) for _ in range(3)]
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    results = await asyncio.gather(*followers, return_exceptions=True)
+    status = "✅" if results == ['ok'] * 3 and len(started) == 2 else "❌"
+    print(f"{status} Отмена лидера: ожидающие получили {results}, загрузок {len(started)}")
+    
+    # Упавший парсер баланса (нули) не кэшируется как реальный баланс
+    fragment_api = FragmentAPI()
+    reads = []
+    
+    async def broken_balance():
+        reads.append(1)
+        return {'stars_balance': 0, 'daily_limit_left': 0}
+    
+    fragment_api.parser.get_balance = broken_balance
+    await fragment_api.get_balance()
+    await fragment_api.get_balance()
+    status = "✅" if len(reads) == 2 else "❌"
+    print(f"{status} Нулевой баланс сбоя не кэшируется: {len(reads)} чтения")
+
+async def test_order_details_cache():
+    """Тест кэша страниц заказов FunPay"""
+    print("\n🧪 Тестирование кэша страниц заказов...")
+    
+    funpay_api = FunPayAPI()
+    page_loads = []
+    original_get_order_details = funpay_api.parser.get_order_details
+    
+    async def counting_get_order_details(order_id):
+        page_loads.append(order_id)
+        return await original_get_order_details(order_id)
+    
+    funpay_api.parser.get_order_details = counting_get_order_details
+    
+    await funpay_api.get_order("test_order_cache")
+    payment = await funpay_api.verify_payment("test_order_cache")
+    status = "✅" if len(page_loads) == 1 and payment['paid'] else "❌"
+    print(f"{status} Заказ + проверка оплаты → {len(page_loads)} загрузка страницы")
+    
+    await funpay_api.verify_payment("test_order_cache", force_refresh=True)
+    status = "✅" if len(page_loads) == 2 else "❌"
+    print(f"{status} Принудительное обновление перечитывает страницу")
+    
+    funpay_api.invalidate_order("test_order_cache")
+    await funpay_api.verify_payment("test_order_cache")
+    status = "✅" if len(page_loads) == 3 else "❌"
+    print(f"{status} После инвалидации страница загружается заново")
+
+async def test_missing_order_page():
+    """Тест: в негативный кэш попадает только подтверждённое отсутствие заказа"""
+    print("\n🧪 Тестирование страницы отсутствующего заказа...")
+    
+    from unittest.mock import patch, AsyncMock
+    from funpay_parser import OrderPageError
+    
+    parser = FunPayParser("test_login", "test_password")
+    funpay_api = FunPayAPI()
+    funpay_api.parser = parser
+    
+    with patch('funpay_parser.asyncio.sleep', new=AsyncMock()):
+        # Страница 404: заказа нет, ответ кэшируется
+        parser.driver = FakeDriver({'.page-404, .error-404': ['Заказ не найден']})
+        parser.driver.current_url = "https://funpay.com/orders/NOSUCH/"
+        parser.driver.title = "404"
+        status = "✅" if await parser.get_order_details("NOSUCH") is None else "❌"
+        print(f"{status} Страница 404 - заказа нет")
+        
+        # Редирект на вход: ошибка разбора, а не «заказа нет»
+        parser.driver = FakeDriver({})
+        parser.driver.current_url = "https://funpay.com/account/login/"
+        parser.driver.title = "Вход"
+        try:
+            await parser.get_order_details("PAID123")
+            status = "❌"
+        except OrderPageError:
+            status = "✅"
+        print(f"{status} Редирект на вход - ошибка разбора")
+        
+        assert await funpay_api.get_order("PAID123") is None
+        status = "✅" if "PAID123" not in funpay_api._missing_orders else "❌"
+        print(f"{status} Сбой разбора не попадает в негативный кэш")
+
 async def test_parser_workflow():
     """Тест полного workflow с парсерами"""
     print("\n🧪 Тестирование полного workflow...")
@@ -189,7 +497,14 @@ async def main():
     try:
         await test_funpay_parser()
         await test_fragment_parser()
+        await test_selector_resolver()
+        await test_session_store()
+        await test_resource_blocking()
+        await test_browser_supervisor()
         await test_integrations()
+        await test_single_flight()
+        await test_order_details_cache()
+        await test_missing_order_page()
         await test_parser_workflow()
         
         print("\n🎉 Все тесты парсеров завершены успешно!")
@@ -0,0 +1,219 @@
+"""
+Трассировка этапов обработки заказа: спаны с корреляцией по заказу через contextvars,
+экспорт в JSONL и перцентили длительности по этапам для /admin perf
+"""
+
+import asyncio
+import functools
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Deque, Dict, List, Optional
+
+from config import TRACE_ENABLED, TRACE_FILE, TRACE_WINDOW, TRACE_FLUSH_BATCH, TRACE_FLUSH_INTERVAL_SEC
+from metrics import metrics
+
+trace_span_seconds = metrics.histogram('trace_span_seconds', 'Длительность этапов по имени спана')
+
+# Корреляция: {'trace_id', 'order_id'} текущего заказа и открытый спан текущей задачи
+_trace: ContextVar[Optional[Dict]] = ContextVar('trace', default=None)
+_current_span: ContextVar[Optional['Span']] = ContextVar('current_span', default=None)
+
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'order_id', 'span_id', 'parent_id', 'attrs',
+                 'started_at', '_start', 'duration', 'status')
+
+    def __init__(self, name: str, attrs: Dict):
+        trace = _trace.get()
+        parent = _current_span.get()
+        self.name = name
+        self.trace_id = trace['trace_id'] if trace else None
+        self.order_id = trace['order_id'] if trace else None
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.status = 'ok'
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, status: str = None):
+        """Закрытие спана; повторный вызов ничего не делает"""
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._start
+        if status:
+            self.status = status
+        tracer.record(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name, 'trace_id': self.trace_id, 'order_id': self.order_id,
+            'span_id': self.span_id, 'parent_id': self.parent_id, 'start': self.started_at,
+            'duration_ms': round(self.duration * 1000, 3), 'status': self.status, 'attrs': self.attrs
+        }
+
+
+class Tracer:
+    """Копит закрытые спаны и дописывает их в JSONL пачками, а не построчно"""
+
+    def __init__(self, path: str = TRACE_FILE, window: int = TRACE_WINDOW, enabled: bool = TRACE_ENABLED,
+                 flush_batch: int = TRACE_FLUSH_BATCH, flush_interval: float = TRACE_FLUSH_INTERVAL_SEC):
+        self.path = path
+        self.window = window
+        self.enabled = enabled
+        self.flush_batch = flush_batch
+        self.flush_interval = flush_interval
+        self._durations: Dict[str, Deque[float]] = {}
+        self._buffer: List[Dict] = []
+        self._last_flush = time.monotonic()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+    def record(self, span: Span):
+        trace_span_seconds.observe(span.duration, span=span.name)
+        with self._lock:
+            durations = self._durations.get(span.name)
+            if durations is None:
+                durations = self._durations[span.name] = deque(maxlen=self.window)
+            durations.append(span.duration)
+            if not self.path:
+                return
+            self._buffer.append(span.to_dict())
+            due = (len(self._buffer) >= self.flush_batch
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            spans = self._take()
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._write(spans)
+            else:
+                # record() вызывается из __exit__ спана прямо в event loop - файл пишем в пуле потоков
+                loop.run_in_executor(None, self._write, spans)
+
+    def flush(self):
+        """Синхронная дозапись накопленных спанов в файл трассировки (например, при остановке)"""
+        self._write(self._take())
+
+    def _take(self) -> List[Dict]:
+        with self._lock:
+            spans, self._buffer = self._buffer, []
+            self._last_flush = time.monotonic()
+        return spans
+
+    def _write(self, spans: List[Dict]):
+        if not spans or not self.path:
+            return
+        try:
+            with self._write_lock:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(json.dumps(span, ensure_ascii=False, default=str) + '\n' for span in spans))
+        except OSError as e:
+            print(f"⚠️ Не удалось записать трассировку: {e}")
+
+    def summary(self) -> Dict[str, Dict]:
+        """{этап: {count, p50, p95, p99, max}} по последним window спанам, в миллисекундах"""
+        with self._lock:
+            snapshot = {name: sorted(durations) for name, durations in self._durations.items()}
+        return {
+            name: {
+                'count': len(values),
+                'p50': _percentile(values, 50) * 1000,
+                'p95': _percentile(values, 95) * 1000,
+                'p99': _percentile(values, 99) * 1000,
+                'max': values[-1] * 1000,
+            }
+            for name, values in snapshot.items() if values
+        }
+
+    def reset(self):
+        with self._lock:
+            self._durations.clear()
+            self._buffer = []
+
+
+def _percentile(values: List[float], q: float) -> float:
+    """Перцентиль по рангу для отсортированного списка"""
+    index = max(0, math.ceil(q / 100 * len(values)) - 1)
+    return values[index]
+
+
+@contextmanager
+def trace(order_id: str):
+    """Корреляция всех спанов внутри блока (и созданных в нём задач) с заказом"""
+    token = _trace.set({'trace_id': f"{order_id}-{uuid.uuid4().hex[:8]}", 'order_id': order_id})
+    try:
+        yield
+    finally:
+        _trace.reset(token)
+
+
+def start_span(name: str, **attrs) -> Optional[Span]:
+    """Спан, который закрывается вручную (например, в колбэке доставки)"""
+    if not tracer.enabled:
+        return None
+    return Span(name, attrs)
+
+
+@contextmanager
+def span(name: str, **attrs):
+    if not tracer.enabled:
+        yield None
+        return
+    current = Span(name, attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        current.end('error')
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+def traced(name: str):
+    """Декоратор async-функции: весь вызов - один спан"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def finish_on_result(current: Optional[Span], on_result: Optional[Callable[[str], None]]):
+    """Колбэк результата доставки, который заодно закрывает спан"""
+    if current is None:
+        return on_result
+
+    def callback(result: str):
+        current.end('ok' if result == 'sent' else result)
+        if on_result:
+            on_result(result)
+    return callback
+
+
+def current_trace_id() -> Optional[str]:
+    trace_context = _trace.get()
+    return trace_context['trace_id'] if trace_context else None
+
+
+# Глобальный трассировщик
+tracer = Tracer()
@@ -0,0 +1,81 @@
+"""
+Параллельная обработка обновлений Telegram: общий лимит обработчиков и очерёдность по пользователю
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_CONCURRENCY, UPDATE_MAX_PENDING
+from metrics import metrics
+
+handlers_in_flight = metrics.gauge('telegram_handlers_in_flight', 'Обновления, обрабатываемые прямо сейчас')
+updates_waiting = metrics.gauge('telegram_updates_waiting', 'Обновления, ждущие своей очереди')
+update_queue_seconds = metrics.histogram('telegram_update_queue_seconds', 'Ожидание обновления до запуска обработчика')
+
+
+class UserOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных пользователей идут параллельно (не больше concurrency),
+    обновления одного пользователя - строго по порядку поступления"""
+
+    def __init__(self, concurrency: int = UPDATE_CONCURRENCY, max_pending: int = UPDATE_MAX_PENDING):
+        # Семафор базового класса ограничивает число принятых в работу обновлений,
+        # включая ждущих своего пользователя; обработчики ограничивает _slots
+        super().__init__(max_concurrent_updates=max(max_pending, concurrency, 2))
+        self.concurrency = concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._user_locks: Dict[Hashable, asyncio.Lock] = {}
+        self._user_waiters: Dict[Hashable, int] = {}
+        self._in_flight = 0
+
+    async def initialize(self) -> None:
+        self._slots = asyncio.Semaphore(self.concurrency)
+
+    async def shutdown(self) -> None:
+        self._user_locks.clear()
+        self._user_waiters.clear()
+
+    @staticmethod
+    def _key(update: object) -> Optional[Hashable]:
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return ('chat', chat.id) if chat else None
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        if self._slots is None:
+            await self.initialize()
+
+        queued_at = time.monotonic()
+        key = self._key(update)
+        updates_waiting.inc()
+        if key is None:
+            await self._run(coroutine, queued_at)
+            return
+
+        # Пока ждём предыдущее обновление пользователя, слот обработчика не занимаем
+        lock = self._user_locks.setdefault(key, asyncio.Lock())
+        self._user_waiters[key] = self._user_waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await self._run(coroutine, queued_at)
+        finally:
+            self._user_waiters[key] -= 1
+            if not self._user_waiters[key]:
+                del self._user_waiters[key]
+                del self._user_locks[key]
+
+    async def _run(self, coroutine: Awaitable[Any], queued_at: float):
+        async with self._slots:
+            updates_waiting.dec()
+            update_queue_seconds.observe(time.monotonic() - queued_at)
+            self._in_flight += 1
+            handlers_in_flight.set(self._in_flight)
+            try:
+                await coroutine
+            finally:
+                self._in_flight -= 1
+                handlers_in_flight.set(self._in_flight)
@@ -0,0 +1,183 @@
+"""
+HTTP-сервер бота: webhook Telegram и авторизованный приём заказов пачкой
+"""
+
+import asyncio
+import hmac
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN,
+    ORDER_WEBHOOK_PATH, ORDER_WEBHOOK_TOKEN, ORDER_WEBHOOK_MAX_BATCH, METRICS_ENABLED, METRICS_PATH, METRICS_TOKEN
+)
+from metrics import metrics
+
+telegram_updates = metrics.counter('telegram_updates_total', 'Входящие обновления Telegram по источнику')
+webhook_requests = metrics.counter('webhook_requests_total', 'Запросы к HTTP-серверу бота по маршруту и статусу')
+webhook_request_seconds = metrics.histogram('webhook_request_seconds', 'Время ответа HTTP-сервера бота')
+order_webhook_orders = metrics.counter('order_webhook_orders_total', 'Заказы, принятые через HTTP')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer:
+    def __init__(self, application, order_handler: Callable[[str, Optional[int]], Awaitable] = None,
+                 host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT, path: str = WEBHOOK_PATH,
+                 secret_token: str = WEBHOOK_SECRET_TOKEN, order_path: str = ORDER_WEBHOOK_PATH,
+                 order_token: str = ORDER_WEBHOOK_TOKEN, max_batch: int = ORDER_WEBHOOK_MAX_BATCH,
+                 metrics_enabled: bool = METRICS_ENABLED, metrics_path: str = METRICS_PATH,
+                 metrics_token: str = METRICS_TOKEN):
+        self.application = application
+        self.order_handler = order_handler
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.order_path = order_path
+        self.order_token = order_token
+        self.max_batch = max_batch
+        self.metrics_enabled = metrics_enabled
+        self.metrics_path = metrics_path
+        self.metrics_token = metrics_token
+
+        # Время приёма обновления: задержка до обработчика считается в bot.py
+        self.received_at: Dict[int, float] = {}
+        self._order_tasks = set()
+        self._runner: Optional[web.AppRunner] = None
+
+    def build_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._measure])
+        app.router.add_post(self.path, self._handle_update)
+        if self.order_handler and self.order_token:
+            app.router.add_post(self.order_path, self._handle_orders)
+        if self.metrics_enabled:
+            app.router.add_get(self.metrics_path, self._handle_metrics)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        print(f"✅ HTTP-сервер бота слушает {self.host}:{self.port}")
+
+    @property
+    def port_bound(self) -> Optional[int]:
+        """Фактический порт (при port=0 выбирается системой)"""
+        if not self._runner or not self._runner.addresses:
+            return None
+        return self._runner.addresses[0][1]
+
+    async def stop(self, timeout: float = 10):
+        """Остановка приёма и ожидание уже принятых заказов"""
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._order_tasks:
+            await asyncio.wait(list(self._order_tasks), timeout=timeout)
+
+    @web.middleware
+    async def _measure(self, request: web.Request, handler):
+        start = time.monotonic()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            route = request.match_info.route.resource.canonical if request.match_info.route.resource else 'unknown'
+            webhook_requests.inc(route=route, status=status)
+            webhook_request_seconds.observe(time.monotonic() - start, route=route)
+
+    async def _handle_update(self, request: web.Request) -> web.Response:
+        if self.secret_token and not _same(request.headers.get(SECRET_HEADER), self.secret_token):
+            return web.Response(status=403)
+
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except Exception:
+            update = None
+        if update is None:
+            return web.Response(status=400)
+
+        # Ответ Telegram сразу, обработка идёт в Application
+        self.received_at[update.update_id] = time.monotonic()
+        await self.application.update_queue.put(update)
+        telegram_updates.inc(source='webhook')
+        return web.Response()
+
+    async def _handle_orders(self, request: web.Request) -> web.Response:
+        if not _same(_bearer(request), self.order_token):
+            return web.json_response({'error': 'unauthorized'}, status=401)
+
+        try:
+            orders = _parse_orders(await request.json())
+        except (ValueError, TypeError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+
+        if len(orders) > self.max_batch:
+            return web.json_response({'error': f'batch larger than {self.max_batch}'}, status=413)
+
+        # Заказы обрабатываются в фоне; повторный ID игнорирует OrderProcessor
+        for order_id, chat_id in orders:
+            task = asyncio.create_task(self.order_handler(order_id, chat_id))
+            self._order_tasks.add(task)
+            task.add_done_callback(self._order_tasks.discard)
+        order_webhook_orders.inc(len(orders))
+
+        return web.json_response({'accepted': [order_id for order_id, _ in orders]}, status=202)
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        if self.metrics_token and not _same(_bearer(request), self.metrics_token):
+            return web.Response(status=401)
+        # Сборщики ходят в базу, поэтому вывод формируется вне event loop
+        body = await asyncio.get_running_loop().run_in_executor(None, metrics.render)
+        return web.Response(text=body, content_type='text/plain', charset='utf-8')
+
+    def pop_received_at(self, update_id: int) -> Optional[float]:
+        return self.received_at.pop(update_id, None)
+
+
+def _bearer(request: web.Request) -> str:
+    """Токен из заголовка Authorization: Bearer <token>"""
+    auth = request.headers.get('Authorization', '')
+    return auth[len('Bearer '):] if auth.startswith('Bearer ') else auth
+
+
+def _same(given: Optional[str], expected: str) -> bool:
+    return bool(given) and hmac.compare_digest(given.encode(), expected.encode())
+
+
+def _parse_orders(payload) -> List[tuple]:
+    """{"orders": [{"order_id": "...", "chat_id": 123}, ...]} или {"order_ids": ["...", ...]}"""
+    if not isinstance(payload, dict):
+        raise ValueError('expected JSON object')
+
+    if isinstance(payload.get('order_ids'), list):
+        items = [{'order_id': order_id} for order_id in payload['order_ids']]
+    else:
+        items = payload.get('orders')
+    if not isinstance(items, list) or not items:
+        raise ValueError('no orders in request')
+
+    orders = []
+    seen = set()
+    for item in items:
+        if not isinstance(item, dict):
+            raise ValueError('order must be an object')
+        order_id = str(item.get('order_id') or '').strip()
+        if not order_id:
+            raise ValueError('order_id is required')
+        chat_id = item.get('chat_id')
+        if order_id not in seen:
+            seen.add(order_id)
+            orders.append((order_id, int(chat_id) if chat_id is not None else None))
+    return orders